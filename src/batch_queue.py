@@ -0,0 +1,181 @@
+#! /usr/bin/python
+"""
+Batched transport of messages between processes.
+
+Putting every message to multiprocessing.Queue on its own costs a pickle, a pipe write and an
+unpickle per message, and the instances of the message classes pickle with their class and
+attribute names. BatchWriter collects the messages in their compact tuple form (see
+FhtMessage.to_tuple and HttpMessage.to_tuple) and puts them to the queue as one batch when
+
+- max_batch messages are collected,
+- the oldest collected message waits for max_delay seconds, or
+- flush() is called, which the producer does when it has nothing more to send at the moment.
+
+A batch is the tuple (time of the oldest message, list of messages), the time is from
+time.monotonic_ns, which is system-wide on Linux, so BatchReader can measure the latency of the
+whole hop including the time spent in the batch. Both ends count the batches in HopStats, and
+the messages and the latencies of the hops of the pipeline (HOPS) in the metrics served on
+/metrics, where the depth of the queues is the difference of the sent and received messages.
+"""
+
+import time
+import logging
+from multiprocessing import Queue
+from metrics import Metrics, Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# the hops of the pipeline in the metrics, by the names of the writers and readers
+HOPS = ('listener->dispatcher', 'dispatcher->http')
+
+
+class HopStats:
+    """Counters of batch sizes and latencies of one hop between processes."""
+
+    # upper bounds of the histogram buckets, the last bucket takes the rest
+    size_buckets = (1, 4, 16, 64, 256)
+    latency_buckets_ms = (1, 5, 10, 50, 100, 500)
+
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.messages = 0
+        self.max_batch = 0
+        self.sizes = [0] * (len(HopStats.size_buckets) + 1)
+        self.latencies = [0] * (len(HopStats.latency_buckets_ms) + 1)
+        self.latency_sum_ms = 0.0
+        self.latency_max_ms = 0.0
+
+    @staticmethod
+    def bucket(bounds, value):
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                return i
+        return len(bounds)
+
+    def add(self, size, latency_ms=None):
+        """Count one batch of size messages, with its latency if known."""
+        self.batches += 1
+        self.messages += size
+        self.max_batch = max(self.max_batch, size)
+        self.sizes[HopStats.bucket(HopStats.size_buckets, size)] += 1
+        if latency_ms is not None:
+            self.latencies[HopStats.bucket(HopStats.latency_buckets_ms, latency_ms)] += 1
+            self.latency_sum_ms += latency_ms
+            self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+
+    def as_dict(self):
+        """Return the counters as a dictionary (e.g. for JSON)."""
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'max_batch': self.max_batch,
+            'sizes': dict(zip([str(b) for b in HopStats.size_buckets] + ['+Inf'], self.sizes)),
+            'latency_ms': dict(zip([str(b) for b in HopStats.latency_buckets_ms] + ['+Inf'], self.latencies)),
+            'latency_sum_ms': round(self.latency_sum_ms, 3),
+            'latency_max_ms': round(self.latency_max_ms, 3)
+        }
+
+    def __str__(self):
+        mean_batch = self.messages / self.batches if self.batches else 0
+        mean_latency = self.latency_sum_ms / self.batches if self.batches else 0
+        return "%s: %d messages in %d batches, batch mean %.1f max %d, latency mean %.2f ms max %.2f ms" % (
+            self.name, self.messages, self.batches, mean_batch, self.max_batch, mean_latency, self.latency_max_ms)
+
+
+class BatchWriter:
+    """Sending end of the batched transport."""
+
+    max_batch = 64
+    max_delay = 0.005
+    sent = Counter('fht_hop_messages_sent_total', "Messages put to the queue of each hop", 'hop', HOPS)
+
+    def __init__(self, queue: Queue, encode, name='batches', max_batch=None, max_delay=None):
+        """
+        Prepare the writer.
+
+        :param queue: multiprocessing queue read by BatchReader
+        :param encode: function converting the message to its compact form, e.g. FhtMessage.to_tuple
+        :param name: name of the hop used in the statistics
+        :param max_batch: maximum number of messages in one batch, BatchWriter.max_batch by default
+        :param max_delay: maximum time in seconds a message waits in the batch, BatchWriter.max_delay
+                          by default
+        """
+        self.queue = queue
+        self.encode = encode
+        self.max_batch = BatchWriter.max_batch if max_batch is None else max_batch
+        self.max_delay_ns = int(1e9 * (BatchWriter.max_delay if max_delay is None else max_delay))
+        self.batch = []
+        self.oldest = 0
+        self.stats = HopStats(name)
+
+    def put(self, msg):
+        """Add the message to the batch, send the batch if it is full or its oldest message is due."""
+        if not self.batch:
+            self.oldest = time.monotonic_ns()
+        self.batch.append(self.encode(msg))
+        if len(self.batch) >= self.max_batch or time.monotonic_ns() - self.oldest >= self.max_delay_ns:
+            self.flush()
+
+    def flush(self):
+        """Send the collected messages, if there are any."""
+        if not self.batch:
+            return
+        self.queue.put((self.oldest, self.batch))
+        self.stats.add(len(self.batch))
+        BatchWriter.sent.inc(len(self.batch), self.stats.name)
+        self.batch = []
+
+
+class BatchReader:
+    """Receiving end of the batched transport."""
+
+    # how often the statistics are logged, in seconds
+    stats_interval = 600
+    received = Counter('fht_hop_messages_received_total', "Messages taken from the queue of each hop", 'hop', HOPS)
+    latency = Histogram('fht_hop_latency_seconds', "Time from putting the oldest message of a batch to the queue "
+                        "of each hop to taking the batch", 'hop', HOPS)
+
+    def __init__(self, queue: Queue, decode, name='batches'):
+        """
+        Prepare the reader.
+
+        :param queue: multiprocessing queue written by BatchWriter
+        :param decode: function reconstructing the message from its compact form, e.g. FhtMessage.from_tuple
+        :param name: name of the hop used in the statistics
+        """
+        self.queue = queue
+        self.decode = decode
+        self.stats = HopStats(name)
+        self.last_report = time.monotonic()
+        # time.monotonic_ns when the oldest message of the last batch was put
+        self.oldest = 0
+
+    def get(self, block=True, timeout=None):
+        """
+        Return the list of messages of the next batch.
+
+        Raises queue.Empty if there is no batch, as Queue.get does.
+        """
+        oldest, batch = self.queue.get(block, timeout)
+        now = time.monotonic_ns()
+        self.oldest = oldest
+        self.stats.add(len(batch), (now - oldest) / 1e6)
+        BatchReader.received.inc(len(batch), self.stats.name)
+        BatchReader.latency.observe((now - oldest) / 1e9, self.stats.name)
+        if now / 1e9 - self.last_report >= BatchReader.stats_interval:
+            self.last_report = now / 1e9
+            logger.info("%s", self.stats)
+        decode = self.decode
+        return [decode(t) for t in batch]
+
+
+queue_depth = Gauge('fht_queue_depth_messages', "Messages waiting in the queue of each hop", 'hop', HOPS)
+
+
+def collect_queue_depth():
+    for hop in HOPS:
+        queue_depth.set(BatchWriter.sent.get(hop) - BatchReader.received.get(hop), hop)
+
+
+Metrics.collectors.append(collect_queue_depth)
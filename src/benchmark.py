@@ -0,0 +1,403 @@
+#! /usr/bin/python
+"""
+Benchmarks of the listener -> dispatcher -> HTTP server pipeline.
+
+Every benchmark runs one stage on synthetic messages that cover all known message types and
+commands (and some unknown ones, as they come from a noisy neighbourhood), and reports the
+time per message. With --pipeline, the whole application is also started in
+both run modes (see main.py), fed with frames through a pseudo-terminal, and its memory and the
+latency from a frame to the JSON served by HTTP are reported. The results are written as JSON,
+so that runs on different commits can be compared with --compare:
+
+    python benchmark.py --output before.json
+    git checkout <other commit>
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import shutil
+import tempfile
+import subprocess
+import http.client
+from multiprocessing import Process, Queue
+from fht_analyzer import FhtAnalyzer
+from fht_listener import FhtListener
+from frame_source import PtySource
+from http_server import HttpServer, HttpHandler
+from message import FhtMessage, HttpMessage, RoomIds
+from history import History
+from schedule import Schedules
+from health import HealthMonitor
+from metrics import Metrics, stage_latency
+from batch_queue import BatchWriter
+from dedup import RepeatFilter
+from log_writer import LogWriter
+from main import Dispatcher
+
+ROOMS = ['Living room', 'Kitchen', 'Bedroom', 'Kotinec', 'Office', 'Bathroom']
+
+
+def make_ids():
+    """Create RoomIds with two addresses for each room, return them and the list of addresses."""
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        for i, room in enumerate(ROOMS):
+            f.write('[%s]\n%02d%02d\n%02d%02d\n' % (room, 10 + i, 1, 10 + i, 2))
+    ids = RoomIds(f.name)
+    os.remove(f.name)
+    return ids, sorted(ids.ids)
+
+
+def make_messages(addresses, n, seed=1):
+    """
+    Generate n messages with all known types and commands.
+
+    About one message in fifty has unknown address, type or command.
+    """
+    rnd = random.Random(seed)
+    types = list(FhtAnalyzer.message_types)
+    commands = list(FhtAnalyzer.commands)
+    messages = []
+    for _ in range(n):
+        address = rnd.choice(addresses)
+        msg_type = rnd.choice(types)
+        command = rnd.choice(commands)
+        value = rnd.randrange(256)
+        if msg_type == '44':
+            value = rnd.randrange(len(FhtAnalyzer.warnings))
+        if rnd.random() < 0.02:
+            address, msg_type, command = rnd.choice([('ABCD', msg_type, command), (address, '77', command),
+                                                     (address, msg_type, '1')])
+        flags = rnd.choice(['0', '2', '6', 'A', 'E'])
+        messages.append(FhtMessage(address, msg_type, flags + command, '%02X' % value))
+    return messages
+
+
+def frame(msg):
+    return ('T%s%s%s%s\r\n' % (msg.address, msg.msg_type, msg.command, msg.value)).encode('ascii')
+
+
+def measure(func, items, min_time=0.2, repeat=3):
+    """
+    Measure func called for every item, return the best time per item in ns.
+
+    The items are processed in rounds until a round takes at least min_time, the best of repeat
+    rounds is reported.
+    """
+    best = None
+    for _ in range(repeat):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            for item in items:
+                func(item)
+            count += len(items)
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        per_item = elapsed / count * 1e9
+        best = per_item if best is None else min(best, per_item)
+    return best
+
+
+def reset_state():
+    HttpHandler.error_counts.clear()
+    HttpHandler.recent_errors.clear()
+    HttpHandler.health = HealthMonitor()
+    HttpHandler.state = {}
+    HttpHandler.version = 0
+    HttpHandler.snapshot = None
+    HttpHandler.history = History()
+    HttpHandler.schedules = Schedules()
+
+
+def hop_worker(inbox: Queue, outbox: Queue, n, decode=None):
+    """
+    Receive n messages, send back the latencies in ns and the time the last one was received.
+
+    With decode the messages come in batches from BatchWriter, every message of a batch gets the
+    latency of the oldest one.
+    """
+    latencies = []
+    while len(latencies) < n:
+        sent, msg = inbox.get()
+        if decode is None:
+            latencies.append(time.monotonic_ns() - sent)
+        else:
+            batch = [decode(t) for t in msg]
+            latencies += [time.monotonic_ns() - sent] * len(batch)
+    outbox.put((latencies, time.monotonic_ns()))
+
+
+def measure_hop(messages, interval, encode=None, decode=None):
+    """
+    Measure latency of one hop across multiprocessing.Queue.
+
+    The messages are put in the queue with the time they were sent, the receiving process
+    computes the latencies. The monotonic clock is system-wide on Linux, so it can be compared
+    between processes. With interval 0 the messages are sent as fast as possible,
+    which measures the latency under a burst. With encode and decode the messages are sent in
+    batches as by BatchWriter, flushed at the end of the burst.
+    """
+    inbox = Queue()  # type: Queue
+    outbox = Queue()  # type: Queue
+    worker = Process(target=hop_worker, args=(inbox, outbox, len(messages), decode))
+    worker.start()
+    time.sleep(0.1)
+    start = time.monotonic_ns()
+    if encode is None:
+        for msg in messages:
+            inbox.put((time.monotonic_ns(), msg))
+            if interval:
+                time.sleep(interval)
+    else:
+        writer = BatchWriter(inbox, encode)
+        for msg in messages:
+            writer.put(msg)
+            if interval:
+                writer.flush()
+                time.sleep(interval)
+        writer.flush()
+    latencies, end = outbox.get()
+    latencies.sort()
+    worker.join()
+    return {
+        'n': len(latencies),
+        'median_ns': latencies[len(latencies) // 2],
+        'p99_ns': latencies[len(latencies) * 99 // 100],
+        'max_ns': latencies[-1],
+        'total_ms': round((end - start) / 1e6, 3)
+    }
+
+
+def run_benchmarks(n, pipeline=False):
+    ids, addresses = make_ids()
+    messages = make_messages(addresses, n)
+    frames = [frame(msg) for msg in messages]
+    dispatcher = Dispatcher(room_ids=ids)
+    http_messages = [dispatcher.analyze_msg(msg) for msg in messages]
+    server = HttpServer(None)
+    results = {}
+
+    def add(name, ns):
+        results[name] = {'ns_per_op': round(ns, 1), 'ops_per_s': round(1e9 / ns)}
+
+    add('parse_message', measure(FhtListener.parse_message, frames))
+    add('AnalyzeMessage', measure(FhtAnalyzer.AnalyzeMessage, messages))
+
+    def analyze_uncached(msg):
+        FhtAnalyzer.payload_cache.clear()
+        return FhtAnalyzer.AnalyzeMessage(msg)
+
+    add('AnalyzeMessage_uncached', measure(analyze_uncached, messages))
+    columns = ([m.msg_type for m in messages], [m.command for m in messages], [m.value for m in messages])
+    add('AnalyzeMessages', measure(lambda c: FhtAnalyzer.AnalyzeMessages(*c), [columns]) / len(messages))
+    add('analyze_msg', measure(dispatcher.analyze_msg, messages))
+    # every message is followed by its repetition
+    repeats = RepeatFilter()
+    repeated = [m for msg in messages for m in (msg, FhtMessage(msg.address, msg.msg_type, msg.command, msg.value))]
+    add('repeat_filter', measure(lambda msg: repeats.is_repeat(msg), repeated))
+
+    log_dir = tempfile.mkdtemp()
+    with open(os.path.join(log_dir, 'unbuffered.txt'), 'a') as f:
+        add('log_write_unbuffered', measure(lambda msg: msg.write(f), messages))
+    writer = LogWriter(log_dir)
+    add('log_write', measure(writer.write, messages))
+    writer.close()
+    shutil.rmtree(log_dir)
+    reset_state()
+    add('update_state', measure(server.update_state, http_messages))
+
+    # the state is full after update_state, as it is after some time of running
+    def get_json(_):
+        HttpHandler.snapshot = None
+        return HttpHandler.get_json()
+
+    add('get_json', measure(get_json, [None]))
+
+    def get_snapshot(_):
+        HttpHandler.version += 1
+        return HttpHandler.get_snapshot()
+
+    add('get_snapshot_after_update', measure(get_snapshot, [None]))
+    add('get_snapshot_cached', measure(lambda _: HttpHandler.get_snapshot(), [None]))
+    results['json_bytes'] = {'bytes': len(HttpHandler.get_snapshot()[1])}
+    add('metrics_counter', measure(lambda msg: Dispatcher.messages.inc(1, 'mode'), messages))
+    add('metrics_histogram', measure(lambda msg: stage_latency.observe(0.002, 'applied'), messages))
+    add('metrics_render', measure(lambda _: Metrics.render(), [None]))
+    add('history_query', measure(lambda key: HttpHandler.history.query(key[0], key[1], 0, time.time()),
+                                 list(HttpHandler.history.series)))
+    reset_state()
+
+    hop = messages[:2000]
+    results['queue_hop_idle'] = measure_hop(hop[:200], 0.001)
+    results['queue_hop_burst'] = measure_hop(hop, 0)
+    results['queue_hop_http_message_burst'] = measure_hop(http_messages[:2000], 0)
+    results['batch_hop_burst'] = measure_hop(hop, 0, FhtMessage.to_tuple, FhtMessage.from_tuple)
+    results['batch_hop_http_message_burst'] = measure_hop(http_messages[:2000], 0, HttpMessage.to_tuple,
+                                                          HttpMessage.from_tuple)
+    if pipeline:
+        # only messages with known addresses, types and commands, every one changes the state
+        known = [msg for msg in messages if msg.address in ids and msg.msg_type in FhtAnalyzer.message_types]
+        results['pipeline_processes'] = measure_pipeline(ids, known, False)
+        results['pipeline_single_process'] = measure_pipeline(ids, known, True)
+    return results
+
+
+def process_tree(pid):
+    """Return the list of pids of the process and all its descendants."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # the name in parentheses can contain spaces, ppid follows the state after it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids = [pid]
+    for p in pids:
+        pids += children.get(p, [])
+    return pids
+
+
+def memory_kb(pids):
+    """
+    Return the sums of resident and proportional set sizes of the processes in kB.
+
+    Forked processes share pages, which are counted in the resident set size of each of them,
+    the proportional set size divides them among the processes.
+    """
+    rss = pss = 0
+    for pid in pids:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    rss += int(line.split()[1])
+                elif line.startswith('Pss:'):
+                    pss += int(line.split()[1])
+    return rss, pss
+
+
+def run_pipeline(ids, path, port, single_process):
+    # the random messages can repeat, but every one has to reach the state
+    Dispatcher(PtySource(path), port, None, ids, single_process, repeat_window=0).start()
+
+
+def measure_pipeline(ids, messages, single_process, port=8790, n=200, burst=500):
+    """
+    Start the application in the run mode and measure it.
+
+    Reports the time until the HTTP server answers, the memory of all processes after the start,
+    the latency of single frames (written to the pseudo-terminal, visible in the JSON) and the
+    time until a burst of frames is visible.
+    """
+    master, path = PtySource.open_pair()
+    started = time.perf_counter()
+    pipeline = Process(target=run_pipeline, args=(ids, path, port, single_process))
+    pipeline.start()
+    conn = http.client.HTTPConnection('localhost', port, timeout=10)
+
+    def seq():
+        conn.request('GET', '/fht_data.json?since=%d' % 1e9)
+        return json.loads(conn.getresponse().read())['seq']
+
+    while True:
+        try:
+            last = seq()
+            break
+        except OSError:
+            conn.close()
+            time.sleep(0.01)
+    startup = time.perf_counter() - started
+    time.sleep(0.5)
+    pids = process_tree(pipeline.pid)
+    rss, pss = memory_kb(pids)
+
+    latencies = []
+    for msg in messages[:n]:
+        start = time.perf_counter()
+        os.write(master, frame(msg))
+        while seq() == last:
+            pass
+        latencies.append(time.perf_counter() - start)
+        last += 1
+    latencies.sort()
+    start = time.perf_counter()
+    os.write(master, b''.join(frame(msg) for msg in messages[:burst]))
+    while seq() < last + burst:
+        time.sleep(0.001)
+    burst_time = time.perf_counter() - start
+
+    conn.close()
+    for pid in process_tree(pipeline.pid):
+        os.kill(pid, 9)
+    pipeline.join()
+    os.close(master)
+    return {
+        'processes': len(pids),
+        'startup_s': round(startup, 3),
+        'rss_kb': rss,
+        'pss_kb': pss,
+        'latency_median_ms': round(1000 * latencies[len(latencies) // 2], 3),
+        'latency_max_ms': round(1000 * latencies[-1], 3),
+        'burst': burst,
+        'burst_ms': round(1000 * burst_time, 3)
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, old):
+    """Print the ratio of times per operation against the old results."""
+    for name, result in results.items():
+        if name not in old:
+            continue
+        for key in ['ns_per_op', 'median_ns', 'rss_kb', 'pss_kb', 'latency_median_ms', 'burst_ms']:
+            if key in result and key in old[name]:
+                print("%-32s %12.1f -> %12.1f  %6.2fx" % (name, old[name][key], result[key], old[name][key] / result[key]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the FHT pipeline.")
+    parser.add_argument('--messages', type=int, default=10000, help="number of synthetic messages")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="compare with results from this file")
+    parser.add_argument('--pipeline', action='store_true', help="measure the whole application in both run modes")
+    args = parser.parse_args(argv)
+
+    # errors about unknown values are logged as in production, but not printed
+    logging.basicConfig(stream=open(os.devnull, 'w'), level=logging.INFO)
+    report = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'messages': args.messages,
+        'results': run_benchmarks(args.messages, args.pipeline)
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f)['results'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#! /usr/bin/python
+"""
+Suppression of repeated FHT messages.
+
+FHT devices send every message again shortly after the first transmission, with the
+'repetitions' flag (8 in the high half of the command byte) set, and the CUL often receives
+the same message from several devices relaying it. RepeatFilter lets the first message through
+and suppresses the same message (address, type, command without the repetition flag, value)
+received within the window after it, so that the repetitions are not logged, analyzed and
+shown as history.
+"""
+
+import time
+import logging
+from message import FhtMessage
+
+logger = logging.getLogger(__name__)
+
+
+class RepeatFilter:
+    """Suppresses repetitions of a message within a time window."""
+
+    window = 2.0
+    # when more messages are remembered, the ones older than the window are forgotten; that is
+    # done at most once per window, so it takes constant time per message however many there are
+    max_seen = 1024
+    # the high hex digit of the command without the repetition flag
+    flag_digits = {c: '{:X}'.format(int(c, 16) & 7) for c in '0123456789ABCDEFabcdef'}
+
+    def __init__(self, window=None):
+        """
+        Create the filter.
+
+        :param window: seconds within which the same message is a repetition, RepeatFilter.window
+                       by default
+        """
+        self.window = RepeatFilter.window if window is None else window
+        self.seen = {}
+        self.pruned = float('-inf')
+        self.passed = 0
+        self.suppressed = 0
+
+    def key(self, msg: FhtMessage):
+        command = msg.command
+        command = RepeatFilter.flag_digits.get(command[:1], command[:1]) + command[1:]
+        return msg.address, msg.msg_type, command, msg.value
+
+    def is_repeat(self, msg: FhtMessage, now=None):
+        """Return True if the message repeats one let through less than window seconds ago."""
+        if now is None:
+            now = time.monotonic()
+        key = self.key(msg)
+        last = self.seen.get(key)
+        if last is not None and now - last < self.window:
+            self.suppressed += 1
+            return True
+        if len(self.seen) >= RepeatFilter.max_seen and now - self.pruned >= self.window:
+            self.seen = {k: t for k, t in self.seen.items() if now - t < self.window}
+            self.pruned = now
+        self.seen[key] = now
+        self.passed += 1
+        return False
+
+    @property
+    def rate(self):
+        """Return the fraction of messages that were suppressed."""
+        total = self.passed + self.suppressed
+        return self.suppressed / total if total else 0.0
+
+    def as_dict(self):
+        """Return the counters as a dictionary (e.g. for JSON)."""
+        return {'passed': self.passed, 'suppressed': self.suppressed, 'rate': round(self.rate, 4)}
+
+    def __str__(self):
+        return "%d messages passed, %d repetitions suppressed (%.1f %%)" % (
+            self.passed, self.suppressed, 100 * self.rate)
@@ -1,8 +1,14 @@
 #! /usr/bin/python
 """Class for analyzing FHT messages received by listener."""
 
+import time
 import logging
-from message import FhtMessage
+from message import FhtMessage, Payload
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 logger = logging.getLogger(__name__)
 
@@ -92,6 +98,16 @@ class FhtAnalyzer:
         8: 'repetitions'        # this is a repetition of previous signal
     }
 
+    # unknown values are logged at most once per log_interval seconds for each value, see
+    # LogUnknown; unknown_seen maps (kind, value) to [time logged, occurrences since]
+    log_interval = 60.0
+    MAX_UNKNOWN_SEEN = 1000
+    unknown_seen: dict = {}
+    # payloads of the messages seen recently by (type, command, value), they are immutable and
+    # can be shared; cleared when it has MAX_CACHED entries
+    MAX_CACHED = 4096
+    payload_cache: dict = {}
+
     @staticmethod
     def AnalyzeMessage(msg: FhtMessage):
         """
@@ -104,46 +120,254 @@ class FhtAnalyzer:
         low and high part of the byte -- in hexa it's simple, we just take the
         first and second character. The second character (lower 4 bits) is the
         actual command, the first character (high 4 bits) is set of flags.
+
+        Everything is looked up in the tables built by BuildTables, and the result is an
+        immutable Payload, which is shared by all messages with the same type, command and value.
         """
-        logger.debug("Analyzing a message")
-        msg_type = 'unknown'
-        if msg.msg_type in FhtAnalyzer.message_types:
-            msg_type = FhtAnalyzer.message_types[msg.msg_type]
+        A = FhtAnalyzer
+        key = (msg.msg_type, msg.command, msg.value)
+        payload = A.payload_cache.get(key)
+        if payload is not None:
+            return payload
+        msg_type, values, warnings, conversion = A.type_decoders.get(msg.msg_type, A.unknown_type_decoder)
+        b = A.hex_table.get(msg.value)
+        if b is not None:
+            value = values[b]
+            warning = warnings[b]
         else:
-            logger.error("New message type %s, cmnd: %s, val: %s", msg.msg_type, msg.command, msg.value)
-        try:
-            value = int(msg.value, 16)
-        except (ValueError, TypeError):
-            value = 0
-        if msg_type in FhtAnalyzer.conversions:
-            value = FhtAnalyzer.conversions[msg_type](value)
-        warning = ''
-        if msg_type == "warnings":
-            warningIndex = int(msg.value, 16)
-            if warningIndex < len(FhtAnalyzer.warnings):
-                warning = FhtAnalyzer.warnings[warningIndex]
-            else:
-                warning = 'unknown'
-                logger.error('Unknown warning index: %s', warningIndex)
-        command = 'unknown'
-        if (len(msg.command) > 1) and (msg.command[1] in FhtAnalyzer.commands):
-            command = FhtAnalyzer.commands[msg.command[1]]
+            b = A._parse_value(msg.value)
+            value = b if conversion is None else conversion(b)
+            warning = warnings[b] if 0 <= b < 256 else warnings[255]
+        command, flags = A.command_decoders.get(msg.command, A.unknown_command_decoder)
+        payload = Payload._make((msg_type, value, warning, command, flags))
+        if msg_type == 'unknown' or command == 'unknown' or warning == 'unknown':
+            if msg_type == 'unknown':
+                A.LogUnknown('message type', msg.msg_type)
+            if command == 'unknown':
+                A.LogUnknown('command', msg.command)
+            if warning == 'unknown':
+                A.LogUnknown('warning index', msg.value)
+            return payload
+        if len(A.payload_cache) >= A.MAX_CACHED:
+            A.payload_cache.clear()
+        A.payload_cache[key] = payload
+        return payload
+
+    @staticmethod
+    def LogUnknown(kind, value):
+        """
+        Log the unknown value (of a message type, command, room, ...).
+
+        The same value is logged again only after log_interval, with the number of times it was
+        seen since it was logged last.
+        """
+        A = FhtAnalyzer
+        now = time.monotonic()
+        seen = A.unknown_seen.get((kind, value))
+        if seen is None:
+            if len(A.unknown_seen) >= A.MAX_UNKNOWN_SEEN:
+                A.unknown_seen.clear()
+            A.unknown_seen[(kind, value)] = [now, 0]
+            logger.error("Unknown %s: %s", kind, value)
+        elif now - seen[0] >= A.log_interval:
+            logger.error("Unknown %s: %s (%d times in the last %.0f s)", kind, value, seen[1] + 1, now - seen[0])
+            seen[0] = now
+            seen[1] = 0
         else:
-            logger.error("Unknown command: %s", msg.command[1])
-        flags = []
-        for i in range(4):
-            f = int(msg.command[0], 16) & (1 << i)
-            if f in FhtAnalyzer.flags:
-                flags.append(FhtAnalyzer.flags[f])
-        logger.debug("Analysis complete")
+            seen[1] += 1
+
+    @staticmethod
+    def BuildTables():
+        """
+        Precompute the lookup tables used by AnalyzeMessage and AnalyzeMessages.
+
+        For AnalyzeMessages, types, commands and warnings are encoded as indices into type_names,
+        command_names and warning_names, flags are kept as the bitmask from the high half of the
+        command byte. Converted values are precomputed for each type and each possible byte value
+        with the conversions, so the results of both are identical.
+
+        For AnalyzeMessage, type_decoders map the type as hex string to (name, 256 values,
+        256 warnings, conversion for values over a byte or None), command_decoders map the
+        command as hex string (in both cases of the flags digit) to (name, tuple of flags).
+        """
+        A = FhtAnalyzer
+        A.type_names = ['unknown'] + list(A.message_types.values())
+        A.type_names_hex = [None] + list(A.message_types)
+        A.type_codes = {k: i + 1 for i, k in enumerate(A.message_types)}
+        A.type_table = [A.type_codes.get('{:02X}'.format(b), 0) for b in range(256)]
+        A.command_names = ['unknown'] + list(A.commands.values())
+        A.command_codes = {k: i + 1 for i, k in enumerate(A.commands)}
+        A.command_table = [A.command_codes.get('{:X}'.format(n), 0) for n in range(16)]
+        A.warning_names = [''] + A.warnings + ['unknown']
+        A.warning_table = [1 + w if w < len(A.warnings) else len(A.warning_names) - 1 for w in range(256)]
+        A.warning_code = A.type_names.index('warnings')
+        A.flag_tuples = [tuple(A.flags[1 << i] for i in range(4) if mask & (1 << i)) for mask in range(16)]
+        A.value_tables = [
+            [A.conversions[name](v) for v in range(256)] if name in A.conversions else None
+            for name in A.type_names
+        ]
+        A.hex_table = {}
+        for b in range(256):
+            A.hex_table['{:02X}'.format(b)] = b
+            A.hex_table['{:02x}'.format(b)] = b
+        byte_values = list(range(256))
+        no_warnings = [''] * 256
+        A.type_decoders = {}
+        for code, name in enumerate(A.type_names):
+            table = A.value_tables[code]
+            warnings = no_warnings
+            if code == A.warning_code:
+                warnings = [A.warning_names[w] for w in A.warning_table]
+            A.type_decoders[A.type_names_hex[code]] = (name, byte_values if table is None else table, warnings,
+                                                       A.conversions.get(name))
+        A.unknown_type_decoder = A.type_decoders.pop(None)
+        # command_string_codes are the same for AnalyzeMessages: (code of the command, flags bitmask)
+        A.command_decoders = {}
+        A.command_string_codes = {}
+        for n in range(16):
+            for high in {'{:X}'.format(n), '{:x}'.format(n)}:
+                for low in {'{:X}'.format(m) for m in range(16)} | {'{:x}'.format(m) for m in range(16)}:
+                    A.command_decoders[high + low] = (A.commands.get(low, 'unknown'), A.flag_tuples[n])
+                    A.command_string_codes[high + low] = (A.command_codes.get(low, 0), n)
+        A.unknown_command_decoder = ('unknown', ())
+        A.unknown_command_codes = (0, 0)
+        if np is not None:
+            A.np_type_table = np.array(A.type_table, dtype=np.uint8)
+            A.np_command_table = np.array(A.command_table, dtype=np.uint8)
+            A.np_warning_table = np.array(A.warning_table, dtype=np.uint8)
+
+    @staticmethod
+    def AnalyzeMessages(msg_types, commands=None, values=None):
+        """
+        Translate a batch of messages at once.
+
+        The messages are given as columns: either sequences of hex strings as they are stored in
+        the text log, or arrays of integers (e.g. from LogArchive.read_columns). A NumPy structured
+        array or a dict with fields 'msg_type', 'command' and 'value' can be given as the only
+        argument instead. Returns dictionary of columns:
+        {
+            'type': codes into FhtAnalyzer.type_names,
+            'value': converted values,
+            'warning': codes into FhtAnalyzer.warning_names,
+            'command': codes into FhtAnalyzer.command_names,
+            'flags': bitmask of FhtAnalyzer.flags
+        }
+        If all columns are NumPy integer arrays, the work is done by NumPy and the columns are
+        NumPy arrays, otherwise they are lists. FhtAnalyzer.ResultRow converts one row of the
+        result to the dictionary returned by AnalyzeMessage.
+        """
+        if commands is None:
+            msg_types, commands, values = msg_types['msg_type'], msg_types['command'], msg_types['value']
+        if np is not None and all(isinstance(c, np.ndarray) and c.dtype.kind in 'iu'
+                                  for c in (msg_types, commands, values)):
+            result = FhtAnalyzer._analyze_arrays(msg_types, commands, values)
+        else:
+            result = FhtAnalyzer._analyze_lists(msg_types, commands, values)
+        FhtAnalyzer._log_unknown(result)
+        return result
+
+    @staticmethod
+    def _analyze_lists(msg_types, commands, values):
+        A = FhtAnalyzer
+        if len(msg_types) and isinstance(msg_types[0], str):
+            type_codes = A.type_codes
+            msg_types = [type_codes.get(t, 0) for t in msg_types]
+        else:
+            type_table = A.type_table
+            msg_types = [type_table[t] for t in msg_types]
+        if len(commands) and isinstance(commands[0], str):
+            # decoded like in AnalyzeMessage, malformed commands are unknown without flags
+            string_codes, unknown = A.command_string_codes, A.unknown_command_codes
+            decoded = [string_codes.get(c, unknown) for c in commands]
+            command_column = [code for code, _ in decoded]
+            flags_column = [flags for _, flags in decoded]
+        else:
+            command_table = A.command_table
+            command_column = [command_table[c & 0xF] for c in commands]
+            flags_column = [c >> 4 for c in commands]
+        if len(values) and isinstance(values[0], str):
+            values = [A._parse_value(v) for v in values]
+        value_tables = A.value_tables
+        warning_code = A.warning_code
+        warning_table = A.warning_table
+        warning_column = [0] * len(values)
+        value_column = list(values)
+        for i, t in enumerate(msg_types):
+            table = value_tables[t]
+            if table is not None:
+                v = values[i]
+                value_column[i] = table[v] if 0 <= v < 256 else A.conversions[A.type_names[t]](v)
+            elif t == warning_code:
+                v = values[i]
+                warning_column[i] = warning_table[v] if v < 256 else len(A.warning_names) - 1
         return {
-            'type': msg_type,
-            'value': value,
-            'warning': warning,
-            'command': command,
-            'flags': flags
+            'type': msg_types,
+            'value': value_column,
+            'warning': warning_column,
+            'command': command_column,
+            'flags': flags_column
         }
 
+    @staticmethod
+    def _analyze_arrays(msg_types, commands, values):
+        A = FhtAnalyzer
+        type_column = A.np_type_table[msg_types]
+        value_column = values.astype(np.float64)
+        for code, name in enumerate(A.type_names):
+            if name in A.conversions:
+                mask = type_column == code
+                if mask.any():
+                    value_column[mask] = A.conversions[name](values[mask])
+        warning_column = np.zeros(len(values), dtype=np.uint8)
+        mask = type_column == A.warning_code
+        warning_column[mask] = A.np_warning_table[np.minimum(values[mask], 255)]
+        return {
+            'type': type_column,
+            'value': value_column,
+            'warning': warning_column,
+            'command': A.np_command_table[commands & 0xF],
+            'flags': (commands >> 4).astype(np.uint8)
+        }
+
+    @staticmethod
+    def _parse_value(v):
+        b = FhtAnalyzer.hex_table.get(v)
+        if b is not None:
+            return b
+        try:
+            return int(v, 16)
+        except (ValueError, TypeError):
+            return 0
+
+    @staticmethod
+    def _log_unknown(result):
+        """Log the unknown values found in a batch once per batch, not once per message."""
+        unknown = (('type', 0), ('command', 0), ('warning', len(FhtAnalyzer.warning_names) - 1))
+        for key, code in unknown:
+            column = result[key]
+            if np is not None and isinstance(column, np.ndarray):
+                count = int(np.count_nonzero(column == code))
+            else:
+                count = column.count(code)
+            if count:
+                logger.error("%d messages with unknown %s in batch", count, key)
+
+    @staticmethod
+    def ResultRow(result, i):
+        """Convert i-th row of the result of AnalyzeMessages to the Payload returned by AnalyzeMessage."""
+        A = FhtAnalyzer
+        msg_type = result['type'][i]
+        value = result['value'][i]
+        if np is not None and isinstance(value, np.generic):
+            value = value.item()
+        if A.value_tables[msg_type] is None:
+            value = int(value)
+        return Payload(A.type_names[msg_type], value, A.warning_names[result['warning'][i]],
+                       A.command_names[result['command'][i]], A.flag_tuples[result['flags'][i]])
+
+
+FhtAnalyzer.BuildTables()
+
 if __name__ == "__main__":
     msg = FhtAnalyzer.AnalyzeMessage(FhtMessage("FFFF", "00", "AA", "00"))
     print(msg)
@@ -2,11 +2,16 @@
 """Implementation of the FHT Listener."""
 
 from multiprocessing import Process, Queue
+import os.path
+import time
 import logging
 import datetime
-import RPi.GPIO as GPIO
-import serial
 from message import FhtMessage
+from frame_source import SerialSource
+from batch_queue import BatchWriter
+from dedup import RepeatFilter
+from log_writer import LogWriter
+from metrics import Counter, register_process
 
 logger = logging.getLogger(__name__)
 
@@ -14,37 +19,55 @@ logger = logging.getLogger(__name__)
 class FhtListener(Process):
     """Listens for FHT messages and send them to dispatcher."""
 
-    def __init__(self, queue: Queue):
+    # how often the statistics of suppressed repetitions are logged, in seconds
+    stats_interval = 600
+    # a source that fails to read (e.g. the CUL was unplugged) is reopened after reopen_interval
+    # seconds, the listener stops when it cannot be reopened in reopen_attempts attempts
+    reopen_interval = 5.0
+    reopen_attempts = 12
+    frames_read = Counter('fht_frames_read_total', "Frames read from the source")
+    bytes_read = Counter('fht_frame_bytes_read_total', "Bytes of the frames read from the source")
+    parse_failures = Counter('fht_parse_failures_total', "Frames that are not valid FHT messages")
+    repeats_suppressed = Counter('fht_repeats_suppressed_total', "Messages suppressed as repetitions")
+
+    def __init__(self, queue, source=None, log_dir="../data", repeat_window=None, log_fsync=False,
+                 compress_logs=False):
         """
         Initialize the listener.
 
         Perform following operations:
-        - pull down pin 17 to enable CUL board
-        - open serial port
-        - open message log for adding messages
+        - open the source of frames, by default SerialSource, which pulls up pin 17 to enable
+          CUL board and opens serial port
+        - note the start in the message log, unless log_dir is None (e.g. for replays); the
+          messages are written by LogWriter created in run, as its thread has to run in the
+          listener process
+        - prepare the filter of repeated messages, which are neither logged nor sent further
+
+        :param queue: where the messages are sent, an object with put(message) and flush(), which
+                      is called after the frames received at once were put: BatchWriter of the
+                      queue to the dispatcher, or the dispatcher itself in the single-process mode
+        :param source: source of frames, see frame_source
+        :param log_dir: directory of the message logs
+        :param repeat_window: seconds within which the same message is suppressed as a repetition,
+                              RepeatFilter.window by default, 0 to keep all messages
+        :param log_fsync: force the groups written to the message log to the disk, see LogWriter
+        :param compress_logs: compact the closed rotations of the message log, see LogWriter
         """
         Process.__init__(self)
         self.msg_queue = queue
+        self.source = SerialSource() if source is None else source
+        self.source.open()
+        self.repeats = None
+        if repeat_window != 0:
+            self.repeats = RepeatFilter(repeat_window)
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        GPIO.setup(17, GPIO.OUT)
-        GPIO.output(17, GPIO.HIGH)
-
-        self.port = serial.Serial("/dev/ttyAMA0", baudrate=38400, timeout=30.0)
-        self.message_log_name = ""
-        self.message_log = open("../data/fht_message_log.txt", "a")
-        self.message_log.write("Starting the Listener process on %s\n" % datetime.datetime.now().isoformat())
-        self.check_log()
-
-    def check_log(self):
-        """Check and rotate the log."""
-        d = datetime.datetime.now()
-        s = "{:04}{:02}{:02}-{:01}".format(d.year, d.month, d.day, d.hour // 4)
-        if self.message_log_name != s:
-            self.message_log.close()
-            self.message_log_name = s
-            self.message_log = open("../data/fht_message_log%s.txt" % self.message_log_name, "a")
+        self.log_dir = log_dir
+        self.log_fsync = log_fsync
+        self.compress_logs = compress_logs
+        self.message_log = None
+        if log_dir is not None:
+            with open(os.path.join(log_dir, "fht_message_log.txt"), "a") as f:
+                f.write("Starting the Listener process on %s\n" % datetime.datetime.now().isoformat())
 
     def run(self):
         r"""
@@ -53,28 +76,67 @@ class FhtListener(Process):
         Start the main loop.
         """
         logger.warning("FHT listener running")
-        self.port.write(b"X01\n")
-        msg = b''
+        register_process('listener')
+        if self.log_dir is not None:
+            self.message_log = LogWriter(self.log_dir, self.log_fsync, self.compress_logs)
+        last_report = time.monotonic()
+        source_open = True
         while True:
-            b = self.port.read()
-            if b:
-                msg += b
-                if len(msg) > 1 and  msg[-1] == 10 and msg[-2] == 13:
-                    m = self.parse_message(msg)
-                    if m is None:
-                        msg = b''
-                        continue
-                    self.check_log()
-                    m.write(self.message_log)
-                    logger.debug("Listener observed a message: %s", msg.decode("ascii"))
-                    self.msg_queue.put(m)
-                    msg = b''
-                else:
-                    # logger.error("Non standard length message received %s", msg.decode("ascii"))
-                    pass
-            else:
+            try:
+                frames = self.source.read_frames()
+            except EOFError as e:
+                logger.warning("FHT listener stopping: %s", e)
+                break
+            except OSError as e:
+                logger.error("FHT listener cannot read the source: %s", e)
+                source_open = self.reopen()
+                if not source_open:
+                    logger.warning("FHT listener stopping, the source cannot be reopened")
+                    break
+                continue
+            if frames is None:
                 logger.debug("timeout")
-                pass  # timeout
+                continue
+            FhtListener.frames_read.inc(len(frames))
+            FhtListener.bytes_read.inc(sum(map(len, frames)))
+            for frame in frames:
+                m = self.parse_message(frame)
+                if m is None:
+                    continue
+                if self.repeats is not None and self.repeats.is_repeat(m):
+                    FhtListener.repeats_suppressed.inc()
+                    continue
+                if self.message_log is not None:
+                    self.message_log.write(m)
+                logger.debug("Listener observed a message: %s", frame.decode("ascii"))
+                self.msg_queue.put(m)
+            self.msg_queue.flush()
+            if self.repeats is not None and time.monotonic() - last_report >= FhtListener.stats_interval:
+                last_report = time.monotonic()
+                logger.info("%s", self.repeats)
+        if source_open:
+            self.source.close()
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.repeats is not None:
+            logger.warning("%s", self.repeats)
+
+    def reopen(self):
+        """Close the failed source and open it again, see reopen_interval; return True if it was reopened."""
+        try:
+            self.source.close()
+        except OSError as e:
+            logger.error("FHT source cannot be closed: %s", e)
+        for attempt in range(1, FhtListener.reopen_attempts + 1):
+            time.sleep(FhtListener.reopen_interval)
+            try:
+                self.source.open()
+            except OSError as e:
+                logger.error("FHT source cannot be reopened (attempt %d): %s", attempt, e)
+                continue
+            logger.warning("FHT source reopened")
+            return True
+        return False
 
     @staticmethod
     def parse_message(msg):
@@ -91,9 +153,15 @@ class FhtListener(Process):
         TAAAAMMCCPP
         T is literal, A is address, M is message type, C is command and P is parameter
         """
-        msg = msg.decode("ascii")[:-2]
-        if msg[0] != 'T':
+        try:
+            msg = msg.decode("ascii")[:-2]
+        except UnicodeDecodeError:
+            logger.error("Invalid message received: %s", msg)
+            FhtListener.parse_failures.inc()
+            return None
+        if not msg or msg[0] != 'T':
             logger.error("Invalid message received: %s", msg)
+            FhtListener.parse_failures.inc()
             return None
         return FhtMessage(msg[1:5], msg[5:7], msg[7:9], msg[9:])
 
@@ -102,7 +170,7 @@ if __name__ == "__main__":
     print("FHT Listener class")
     logging.basicConfig(level=logging.DEBUG)
     msg_queue = Queue()  # type: Queue
-    listener = FhtListener(msg_queue)
+    listener = FhtListener(BatchWriter(msg_queue, FhtMessage.to_tuple))
     listener.start()
     while True:
         pass
@@ -0,0 +1,450 @@
+#! /usr/bin/python
+r"""
+Sources of the raw FHT frames for FhtListener.
+
+A frame is the line sent by the CUL for every received FHT message: T<address><type><command>
+<value>\r\n, see FhtListener.parse_message. Every source has the same interface:
+- open() prepares the source (the listener calls it before reading, and again after close
+  when the source failed, see FhtListener.reopen)
+- read_frames() returns the list of frames received since the last call, None on timeout,
+  raises EOFError when the source is exhausted and OSError when the device fails
+- close()
+The sources are:
+- SerialSource: the CUL on the serial port of the Raspberry Pi
+- PtySource: any character device, e.g. a pseudo-terminal fed by a test or a benchmark
+- ReplaySource: frames reconstructed from the message logs, replayed at the original timing,
+  N times faster, or as fast as possible
+- MultiSource: several receivers (serial or pty sources) read at once, their frames merged
+  into one stream in which a frame heard by more than one receiver appears once
+"""
+
+import os
+import time
+import fcntl
+import select
+import selectors
+import struct
+import termios
+import tty
+import logging
+from message import FhtMessage
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+
+class FrameReader:
+    r"""
+    Splits the bytes from the serial port to frames terminated by \r\n.
+
+    Every read takes all bytes waiting in the port (or waits for the first one up to the port
+    timeout) into a buffer, and all complete frames are cut from it at once. Frames longer than
+    max_frame are noise; they are dropped, and so are the bytes of an unterminated noise until
+    the next terminator, so the buffer never grows beyond max_frame.
+
+    A CUL switched to reporting with the signal strength (X21) appends its RSSI byte in hex
+    to every frame; with rssi the reader cuts it off and keeps the RSSI values in dBm of the
+    frames of the last read in the list rssi_values.
+    """
+
+    MAX_FRAME = 64
+
+    def __init__(self, port, max_frame=MAX_FRAME, rssi=False):
+        """Initialize the reader of the port."""
+        self.port = port
+        self.max_frame = max_frame
+        self.rssi = rssi
+        self.rssi_values = []
+        self.buffer = bytearray()
+        self.discarding = False
+        self.dropped = 0
+
+    @staticmethod
+    def rssi_dbm(value):
+        """Convert the RSSI byte reported by the CUL to dBm."""
+        return (value - 256 if value >= 128 else value) / 2 - 74
+
+    def read_frames(self):
+        r"""
+        Read from the port and return the list of complete frames (including the \r\n).
+
+        Returns None if nothing was read before the port timeout.
+        """
+        data = self.port.read(self.port.in_waiting or 1)
+        if not data:
+            return None
+        buf = self.buffer
+        start = len(buf) - 1 if buf else 0  # the terminator could be split between two reads
+        buf += data
+        frames = []
+        begin = 0
+        while True:
+            end = buf.find(b'\r\n', start)
+            if end < 0:
+                break
+            if self.discarding:
+                self.discarding = False
+            elif end - begin <= self.max_frame:
+                frames.append(bytes(buf[begin:end + 2]))
+            else:
+                self.dropped += 1
+            begin = start = end + 2
+        del buf[:begin]
+        if self.rssi:
+            self.rssi_values = []
+            for i, frame in enumerate(frames):
+                try:
+                    self.rssi_values.append(FrameReader.rssi_dbm(int(frame[-4:-2], 16)))
+                except ValueError:
+                    self.rssi_values.append(None)
+                frames[i] = frame[:-4] + b'\r\n'
+        if len(buf) > self.max_frame:
+            if not self.discarding:
+                self.dropped += 1
+                self.discarding = True
+            # keep the last byte, it can be \r of the terminator
+            del buf[:-1]
+        return frames
+
+
+class SerialSource:
+    """The CUL board connected to the serial port of the Raspberry Pi."""
+
+    def __init__(self, device="/dev/ttyAMA0", enable_pin=17, timeout=30.0, rssi=False):
+        """
+        Remember the configuration, the port is opened by open().
+
+        :param device: serial port of the CUL
+        :param enable_pin: GPIO pin that has to be pulled up to enable the CUL, None if there is none
+        :param timeout: timeout of the port reads in seconds
+        :param rssi: let the CUL report the signal strength of the frames, see FrameReader
+        """
+        self.device = device
+        self.enable_pin = enable_pin
+        self.timeout = timeout
+        self.rssi = rssi
+        self.port = None
+        self.reader = None
+
+    def open(self):
+        """
+        Perform following operations.
+
+        - pull up the enable pin to enable CUL board
+        - open serial port
+        - switch the CUL to reporting of the FHT messages
+        """
+        # imported here, so that other sources work on machines without them
+        import serial
+        if self.enable_pin is not None:
+            import RPi.GPIO as GPIO
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setwarnings(False)
+            GPIO.setup(self.enable_pin, GPIO.OUT)
+            GPIO.output(self.enable_pin, GPIO.HIGH)
+        self.port = serial.Serial(self.device, baudrate=38400, timeout=self.timeout)
+        self.port.write(b"X21\n" if self.rssi else b"X01\n")
+        self.reader = FrameReader(self.port, rssi=self.rssi)
+
+    def fileno(self):
+        return self.port.fileno()
+
+    def read_frames(self):
+        return self.reader.read_frames()
+
+    def close(self):
+        self.port.close()
+
+
+class PtyPort:
+    """Minimal serial-port-like wrapper of a file descriptor of a character device."""
+
+    def __init__(self, fd, timeout):
+        self.fd = fd
+        self.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('i', fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def read(self, n=1):
+        """Read up to n bytes, wait for at least one up to timeout."""
+        ready, _, _ = select.select([self.fd], [], [], self.timeout)
+        if not ready:
+            return b''
+        try:
+            return os.read(self.fd, n)
+        except BlockingIOError:
+            return b''
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PtySource:
+    """Frames from a character device without the CUL specific setup, e.g. a pseudo-terminal."""
+
+    def __init__(self, device, timeout=1.0, rssi=False):
+        """
+        Remember the device, it is opened by open().
+
+        :param device: path of the device, e.g. the slave of the pty created by open_pair
+        :param timeout: timeout of the reads in seconds
+        :param rssi: the frames end with the RSSI byte, see FrameReader
+        """
+        self.device = device
+        self.timeout = timeout
+        self.rssi = rssi
+        self.port = None
+        self.reader = None
+
+    @staticmethod
+    def open_pair():
+        """
+        Create a pseudo-terminal in raw mode for feeding frames to PtySource.
+
+        Returns (master fd, slave path); the frames written to the master fd can be read by
+        PtySource(slave path).
+        """
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        path = os.ttyname(slave)
+        os.close(slave)
+        return master, path
+
+    def open(self):
+        fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        if os.isatty(fd):
+            tty.setraw(fd)
+        self.port = PtyPort(fd, self.timeout)
+        self.reader = FrameReader(self.port, rssi=self.rssi)
+
+    def fileno(self):
+        return self.port.fd
+
+    def read_frames(self):
+        return self.reader.read_frames()
+
+    def close(self):
+        self.port.close()
+
+
+class ReplaySource:
+    """Frames reconstructed from the message logs (text or archived)."""
+
+    # maximum number of frames returned by one read_frames
+    batch = 64
+
+    def __init__(self, paths, speed=1.0, timeout=1.0):
+        """
+        Prepare the replay of the logs.
+
+        :param paths: list of paths of the message logs, replayed in this order
+        :param speed: 1 for original timing, N for N times faster, 0 for as fast as possible
+        :param timeout: read_frames waits at most this long for the next frame
+        """
+        self.paths = paths
+        self.speed = speed
+        self.timeout = timeout
+        self.messages = None
+        self.next = None
+        self.start = None
+        self.count = 0
+
+    @staticmethod
+    def frame(msg: FhtMessage):
+        """Return the frame the CUL sent for the message."""
+        return ('T%s%s%s%s\r\n' % (msg.address, msg.msg_type, msg.command, msg.value)).encode('ascii')
+
+    def open(self):
+        self.messages = (msg for path in self.paths for msg in FhtMessage.read_log(path))
+        self.next = next(self.messages, None)
+        self.start = None
+
+    def due(self, msg):
+        """Return the wall clock time when the message has to be replayed."""
+        if self.start is None:
+            self.start = (time.monotonic(), msg.time)
+        return self.start[0] + (msg.time - self.start[1]).total_seconds() / self.speed
+
+    def read_frames(self):
+        if self.next is None:
+            raise EOFError("Replay finished after %d frames" % self.count)
+        frames = []
+        if self.speed:
+            wait = self.due(self.next) - time.monotonic()
+            if wait > 0:
+                time.sleep(min(wait, self.timeout))
+                if wait > self.timeout:
+                    return None
+        now = time.monotonic()
+        while self.next is not None and len(frames) < ReplaySource.batch:
+            if self.speed and self.due(self.next) > now:
+                break
+            frames.append(ReplaySource.frame(self.next))
+            self.next = next(self.messages, None)
+        self.count += len(frames)
+        return frames
+
+    def close(self):
+        self.messages = None
+
+
+class ReceiverStats:
+    """Counters of the frames of one receiver of MultiSource."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.frames = 0
+        self.duplicates = 0
+        self.bytes = 0
+        self.rssi_count = 0
+        self.rssi_sum = 0.0
+        self.rssi_last = None
+
+    def add(self, frame, rssi, duplicate):
+        self.frames += 1
+        self.bytes += len(frame)
+        if duplicate:
+            self.duplicates += 1
+        if rssi is not None:
+            self.rssi_count += 1
+            self.rssi_sum += rssi
+            self.rssi_last = rssi
+
+    @property
+    def rate(self):
+        """Return the number of frames per minute since the start."""
+        elapsed = time.monotonic() - self.started
+        return self.frames * 60 / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        """Return the counters as a dictionary (e.g. for JSON)."""
+        return {
+            'frames': self.frames,
+            'duplicates': self.duplicates,
+            'bytes': self.bytes,
+            'frames_per_min': round(self.rate, 2),
+            'rssi_mean_dbm': round(self.rssi_sum / self.rssi_count, 1) if self.rssi_count else None,
+            'rssi_last_dbm': self.rssi_last
+        }
+
+    def __str__(self):
+        rssi = " RSSI mean %.1f dBm" % (self.rssi_sum / self.rssi_count) if self.rssi_count else ""
+        return "receiver %s: %d frames (%.1f/min), %d heard first by another receiver%s" % (
+            self.name, self.frames, self.rate, self.duplicates, rssi)
+
+
+class MultiSource:
+    """
+    Frames from several receivers, e.g. CULs in different parts of the house.
+
+    The sources (SerialSource or PtySource) are read in one thread: read_frames waits with a
+    selector until any of them has data and reads all that have. Every frame is tagged with the
+    index of its receiver; a frame that another receiver delivered less than merge_window
+    seconds before is a duplicate and is dropped, so the listener gets every frame once, from
+    the receiver that heard it first. The repetitions sent by the devices themselves differ in
+    the command byte and are left to RepeatFilter.
+
+    The frames, duplicates and signal strength of every receiver are counted in ReceiverStats
+    and in the metrics (the receivers are labelled by their index), and logged every
+    stats_interval seconds. A receiver that fails is closed, the others are read on.
+    """
+
+    merge_window = 0.5
+    # frames older than merge_window are forgotten when more are remembered, at most once per
+    # merge_window as in RepeatFilter
+    max_seen = 1024
+    stats_interval = 600
+    # receivers with their own series in the metrics
+    RECEIVERS = tuple(str(i) for i in range(8))
+    frames = Counter('fht_receiver_frames_total', "Frames received by each receiver", 'receiver', RECEIVERS)
+    duplicates = Counter('fht_receiver_duplicates_total', "Frames of each receiver dropped as heard by another "
+                         "receiver first", 'receiver', RECEIVERS)
+    rssi = Gauge('fht_receiver_rssi_dbm', "Signal strength of the last frame of each receiver", 'receiver', RECEIVERS)
+
+    def __init__(self, sources, timeout=1.0):
+        """
+        Remember the sources, they are opened by open().
+
+        :param sources: list of the sources of the receivers
+        :param timeout: read_frames waits at most this long for a frame
+        """
+        self.sources = sources
+        self.timeout = timeout
+        self.selector = None
+        self.stats = [ReceiverStats('%d (%s)' % (i, getattr(source, 'device', source)))
+                      for i, source in enumerate(sources)]
+        self.seen = {}
+        self.pruned = float('-inf')
+        self.last_report = time.monotonic()
+
+    def open(self):
+        self.selector = selectors.DefaultSelector()
+        for i, source in enumerate(self.sources):
+            source.open()
+            self.selector.register(source.fileno(), selectors.EVENT_READ, i)
+
+    def read_frames(self):
+        if not self.selector.get_map():
+            raise EOFError("All receivers failed")
+        events = self.selector.select(self.timeout)
+        if not events:
+            return None
+        now = time.monotonic()
+        frames = []
+        for key, _ in sorted(events, key=lambda event: event[0].data):
+            i = key.data
+            try:
+                received = self.sources[i].read_frames()
+            except (OSError, EOFError) as e:
+                logger.error("Receiver %s failed, closing it: %s", self.stats[i].name, e)
+                self.selector.unregister(key.fd)
+                self.sources[i].close()
+                continue
+            if received:
+                frames += self.merge(i, received, now)
+        if now - self.last_report >= MultiSource.stats_interval:
+            self.last_report = now
+            for stats in self.stats:
+                logger.info("%s", stats)
+        return frames
+
+    def merge(self, receiver, received, now):
+        """Return the frames received by the receiver that no other one delivered within merge_window."""
+        reader = self.sources[receiver].reader
+        rssi_values = reader.rssi_values if reader is not None and reader.rssi else [None] * len(received)
+        stats = self.stats[receiver]
+        label = str(receiver)
+        merged = []
+        for frame, rssi in zip(received, rssi_values):
+            last = self.seen.get(frame)
+            duplicate = last is not None and last[1] != receiver and now - last[0] < MultiSource.merge_window
+            stats.add(frame, rssi, duplicate)
+            MultiSource.frames.inc(1, label)
+            if rssi is not None:
+                MultiSource.rssi.set(rssi, label)
+            if duplicate:
+                MultiSource.duplicates.inc(1, label)
+                continue
+            if len(self.seen) >= MultiSource.max_seen and now - self.pruned >= MultiSource.merge_window:
+                self.seen = {f: t for f, t in self.seen.items() if now - t[0] < MultiSource.merge_window}
+                self.pruned = now
+            self.seen[frame] = (now, receiver)
+            merged.append(frame)
+        return merged
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fd)
+            self.sources[key.data].close()
+        self.selector.close()
+        for stats in self.stats:
+            logger.warning("%s", stats)
@@ -0,0 +1,297 @@
+#! /usr/bin/python
+"""
+Health of the rooms: alerts about thermostats and valves that need attention.
+
+HealthMonitor keeps running statistics of every room, updated in constant time by each message
+(see add), and raises alerts when
+
+- a room sent nothing for silent_after seconds (silent),
+- the window has been reported open for window_after seconds (window-open),
+- the thermostat reports a low battery, low temperature or a window contact error
+  (battery-low, temp-low, window-error),
+- the valve stays open although the room is warmer than desired (valve-stuck-open), or stays
+  closed although the room is colder (valve-stuck-closed); the valve opening and the difference
+  of the desired and measured temperature are exponentially weighted moving averages.
+
+An alert is cleared when its condition is gone. The HTTP server feeds the monitor from
+update_state with the messages of the known rooms (a device of the neighbours that goes quiet
+would be alerted forever), calls check periodically (silence and durations need no message), serves the
+active alerts in the errors of its state and the statistics of the rooms on /health, and saves
+both with its state (see as_saved and load).
+
+Run as a command, the same monitor is run over the message logs to backtest the thresholds:
+every alert raised and cleared is printed with the time of the message that caused it, and the
+options override the thresholds.
+"""
+
+import sys
+import os.path
+import time
+import logging
+import argparse
+import datetime
+from message import RoomIds
+from fht_analyzer import FhtAnalyzer
+from log_archive import LogArchive
+
+logger = logging.getLogger(__name__)
+
+
+class RoomHealth:
+    """Running statistics of one room."""
+
+    __slots__ = ('last_seen', 'valve', 'delta', 'valve_samples', 'delta_samples', 'measured_low', 'desired',
+                 'warning', 'warning_since', 'warning_seconds')
+
+    def __init__(self, t):
+        self.last_seen = t
+        self.valve = 0.0
+        self.delta = 0.0
+        self.valve_samples = 0
+        self.delta_samples = 0
+        self.measured_low = None
+        self.desired = None
+        self.warning = 'OK'
+        self.warning_since = t
+        # total time spent in each warning, by the warning
+        self.warning_seconds = {}
+
+    def as_dict(self, now):
+        """Return the statistics as a dictionary (e.g. for JSON)."""
+        seconds = dict(self.warning_seconds)
+        if self.warning != 'OK':
+            seconds[self.warning] = seconds.get(self.warning, 0.0) + now - self.warning_since
+        return {
+            'last_seen': self.last_seen,
+            'valve': round(self.valve, 1),
+            'delta': round(self.delta, 2),
+            'warning': self.warning,
+            'warning_seconds': {w: round(s) for w, s in seconds.items()}
+        }
+
+    def as_saved(self):
+        """Return the statistics for saving, the values of __slots__ in their order."""
+        return [getattr(self, name) for name in RoomHealth.__slots__]
+
+    @staticmethod
+    def from_saved(saved):
+        """Return the RoomHealth with the statistics returned by as_saved."""
+        health = RoomHealth(0.0)
+        for name, value in zip(RoomHealth.__slots__, saved):
+            setattr(health, name, value)
+        return health
+
+
+class HealthMonitor:
+    """Alerts of the rooms computed from the stream of messages."""
+
+    silent_after = 3600.0
+    window_after = 1800.0
+    # weight of a new sample in the moving averages, and the samples needed before judging the valve
+    alpha = 0.1
+    min_samples = 10
+    # (valve opening in % at least, desired minus measured temperature at most) for a stuck open
+    # valve, (at most, at least) for a stuck closed one
+    stuck_open = (80.0, -1.0)
+    stuck_closed = (5.0, 2.0)
+    # warnings alerted at once, by the warning reported by the thermostat
+    warning_alerts = {'BATT LOW': 'battery-low', 'TEMP LOW': 'temp-low', 'WINDOW ERR': 'window-error'}
+    # how often the HTTP server calls check, in seconds
+    check_interval = 60.0
+
+    def __init__(self):
+        self.rooms = {}
+        # (room, kind) -> [room, kind, since, detail], the values are served in the state
+        self.alerts = {}
+        # set when an alert was raised or cleared, reset by the one who publishes the alerts
+        self.changed = False
+        # if a list, every alert raised and cleared is appended as (time, 'raised'/'cleared', alert)
+        self.events = None
+
+    def raise_alert(self, room, kind, t, detail=''):
+        if (room, kind) in self.alerts:
+            return
+        alert = [room, kind, t, detail]
+        self.alerts[(room, kind)] = alert
+        self.changed = True
+        if self.events is not None:
+            self.events.append((t, 'raised', alert))
+
+    def clear_alert(self, room, kind, t):
+        alert = self.alerts.pop((room, kind), None)
+        if alert is None:
+            return
+        self.changed = True
+        if self.events is not None:
+            self.events.append((t, 'cleared', alert))
+
+    def add(self, room, msg_type, value, warning, t):
+        """Update the statistics of the room with the message (type, value, warning) received at time t."""
+        health = self.rooms.get(room)
+        if health is None:
+            health = self.rooms[room] = RoomHealth(t)
+        health.last_seen = t
+        if self.alerts and (room, 'silent') in self.alerts:
+            self.clear_alert(room, 'silent', t)
+        if msg_type == 'all-valves':
+            if health.valve_samples:
+                health.valve += HealthMonitor.alpha * (value - health.valve)
+            else:
+                health.valve = value
+            health.valve_samples += 1
+            self.check_valve(room, health, t)
+        elif msg_type == 'measured-low':
+            health.measured_low = value
+        elif msg_type == 'measured-high':
+            if health.measured_low is not None and health.desired is not None:
+                delta = health.desired - (health.measured_low + value)
+                if health.delta_samples:
+                    health.delta += HealthMonitor.alpha * (delta - health.delta)
+                else:
+                    health.delta = delta
+                health.delta_samples += 1
+                self.check_valve(room, health, t)
+        elif msg_type == 'desired-temp':
+            health.desired = value
+        elif msg_type == 'warnings':
+            self.set_warning(room, health, warning, t)
+
+    @staticmethod
+    def alert_of(warning):
+        """Return the kind of the alert raised for the warning (at once or when it lasts)."""
+        return 'window-open' if warning == 'WINDOW OPEN' else HealthMonitor.warning_alerts.get(warning)
+
+    def set_warning(self, room, health, warning, t):
+        if warning == health.warning:
+            return
+        if health.warning != 'OK':
+            seconds = health.warning_seconds
+            seconds[health.warning] = seconds.get(health.warning, 0.0) + t - health.warning_since
+            self.clear_alert(room, HealthMonitor.alert_of(health.warning), t)
+        health.warning = warning
+        health.warning_since = t
+        if warning in HealthMonitor.warning_alerts:
+            self.raise_alert(room, HealthMonitor.warning_alerts[warning], t, warning)
+
+    def check_valve(self, room, health, t):
+        if health.valve_samples < HealthMonitor.min_samples or health.delta_samples < HealthMonitor.min_samples:
+            return
+        detail = 'valve %.0f %%, desired - measured %.1f' % (health.valve, health.delta)
+        valve_min, delta_max = HealthMonitor.stuck_open
+        if health.valve >= valve_min and health.delta <= delta_max:
+            self.raise_alert(room, 'valve-stuck-open', t, detail)
+        else:
+            self.clear_alert(room, 'valve-stuck-open', t)
+        valve_max, delta_min = HealthMonitor.stuck_closed
+        # a closed valve in a cold room is expected when the window is open
+        if health.valve <= valve_max and health.delta >= delta_min and health.warning != 'WINDOW OPEN':
+            self.raise_alert(room, 'valve-stuck-closed', t, detail)
+        else:
+            self.clear_alert(room, 'valve-stuck-closed', t)
+
+    def check(self, now):
+        """Raise the alerts that depend on time passing: silent rooms and windows open too long."""
+        for room, health in self.rooms.items():
+            if now - health.last_seen >= HealthMonitor.silent_after:
+                self.raise_alert(room, 'silent', health.last_seen, 'nothing received since')
+            if health.warning == 'WINDOW OPEN' and now - health.warning_since >= HealthMonitor.window_after:
+                self.raise_alert(room, 'window-open', now, 'open for %.0f s' % (now - health.warning_since))
+
+    def as_dict(self, now):
+        """Return the statistics of all rooms and the active alerts as a dictionary."""
+        return {
+            'rooms': {room: health.as_dict(now) for room, health in sorted(self.rooms.items())},
+            'alerts': list(self.alerts.values())
+        }
+
+    def as_saved(self):
+        """Return the statistics and the active alerts for saving, {'rooms': {...}, 'alerts': [...]}."""
+        return {
+            'rooms': {room: health.as_saved() for room, health in self.rooms.items()},
+            'alerts': list(self.alerts.values())
+        }
+
+    def load(self, saved):
+        """Restore the statistics and the alerts returned by as_saved."""
+        for room, values in saved['rooms'].items():
+            self.rooms[room] = RoomHealth.from_saved(values)
+        for alert in saved['alerts']:
+            self.alerts[(alert[0], alert[1])] = alert
+        logger.info("Health of %d rooms with %d alerts restored", len(saved['rooms']), len(saved['alerts']))
+
+
+def backtest(data_dir, ids, start=None, end=None):
+    """
+    Run HealthMonitor over the message logs in data_dir, return it with the list of its events.
+
+    The logs are read and analyzed column-wise (see parse_log.read_columns and
+    FhtAnalyzer.AnalyzeMessages), check runs every check_interval of the time of the messages.
+    Times are seconds since the epoch of the local times in the logs, see LogArchive.to_int.
+    Messages of the addresses not in ids are skipped, as in the HTTP server.
+    """
+    from parse_log import find_logs, read_columns
+    monitor = HealthMonitor()
+    monitor.events = []
+    A = FhtAnalyzer
+    type_names, warning_names = A.type_names, A.warning_names
+    next_check = None
+    count = 0
+    for log in find_logs(data_dir, start, end):
+        columns = read_columns(os.path.join(data_dir, log), None, start, end)
+        result = A.AnalyzeMessages(columns)
+        times = columns['time']
+        if times and isinstance(times[0], str):
+            times = [LogArchive.to_int(datetime.datetime.fromisoformat(t)) for t in times]
+        for address, t, msg_type, value, warning in zip(columns['address'], times, result['type'],
+                                                         result['value'], result['warning']):
+            t = int(t) / 1e6
+            if next_check is None or t >= next_check:
+                monitor.check(t)
+                next_check = t + HealthMonitor.check_interval
+            room = ids.get(address)
+            if room is not None:
+                monitor.add(room, type_names[msg_type], value, warning_names[warning], t)
+        count += len(times)
+    return monitor, count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backtest the health alerts over the message logs.")
+    parser.add_argument('--data', default='../data', help="directory with the message logs")
+    parser.add_argument('--from', dest='start', type=datetime.datetime.fromisoformat,
+                        help="only messages from this time on")
+    parser.add_argument('--to', dest='end', type=datetime.datetime.fromisoformat, help="only messages before this time")
+    parser.add_argument('--silent-after', type=float, default=HealthMonitor.silent_after,
+                        help="seconds without messages after which a room is silent")
+    parser.add_argument('--window-after', type=float, default=HealthMonitor.window_after,
+                        help="seconds of open window after which it is alerted")
+    parser.add_argument('--alpha', type=float, default=HealthMonitor.alpha,
+                        help="weight of new samples in the averages")
+    parser.add_argument('--stuck-open', type=float, nargs=2, default=HealthMonitor.stuck_open,
+                        metavar=('VALVE', 'DELTA'),
+                        help="valve opening at least and desired minus measured temperature at most")
+    parser.add_argument('--stuck-closed', type=float, nargs=2, default=HealthMonitor.stuck_closed,
+                        metavar=('VALVE', 'DELTA'),
+                        help="valve opening at most and desired minus measured temperature at least")
+    args = parser.parse_args(argv)
+    HealthMonitor.silent_after = args.silent_after
+    HealthMonitor.window_after = args.window_after
+    HealthMonitor.alpha = args.alpha
+    HealthMonitor.stuck_open = tuple(args.stuck_open)
+    HealthMonitor.stuck_closed = tuple(args.stuck_closed)
+
+    started = time.perf_counter()
+    monitor, count = backtest(args.data, RoomIds(os.path.join(args.data, 'known_ids.txt')), args.start, args.end)
+    elapsed = time.perf_counter() - started
+    kinds = {}
+    for t, event, (room, kind, since, detail) in monitor.events:
+        print("[%s] %s %s %s %s" % (LogArchive.to_datetime(int(t * 1e6)).isoformat(), event, room, kind, detail))
+        if event == 'raised':
+            kinds[kind] = kinds.get(kind, 0) + 1
+    print(dict(sorted(kinds.items())))
+    print("%d messages analyzed in %.2f s, %.0f messages/s" %
+          (count, elapsed, count / elapsed if elapsed > 0 else 0), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
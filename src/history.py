@@ -0,0 +1,280 @@
+#! /usr/bin/python
+"""
+History of the temperatures and valve positions of the rooms.
+
+The HTTP server keeps only the last few messages of each room and type. History keeps the
+values of the types in History.types for each room in three resolutions:
+
+- raw: the last RAW_POINTS values with their times,
+- 5 minutes and 1 hour: buckets with minimum, maximum, sum and count of the values in them,
+  for the last ROLLUPS[i][1] buckets.
+
+All of them are rings of preallocated arrays, so the memory taken by a series is fixed when
+it is created (about 93 kB), and at most max_series series are kept. Queries find the
+requested range by binary search and answer with at most max_points points, choosing the
+finest resolution that covers the range.
+
+The HTTP server saves the series with its state (see History.as_saved and load), the logs
+replayed after a restart only cover the time since the save.
+"""
+
+import sys
+import base64
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+
+class Ring:
+    """Fixed number of rows stored in parallel arrays, the oldest row is overwritten when full."""
+
+    def __init__(self, capacity, typecodes):
+        """
+        Allocate the arrays.
+
+        :param capacity: number of rows
+        :param typecodes: array type codes of the columns, the first column is the time in
+                          seconds since epoch, which must not decrease
+        """
+        self.capacity = capacity
+        self.columns = [array(t, bytes(array(t).itemsize * capacity)) for t in typecodes]
+        self.times = self.columns[0]
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def physical(self, i):
+        """Return the index into the arrays of the i-th oldest row."""
+        return (self.start + i) % self.capacity
+
+    def append(self, row):
+        """Add the row as the newest one, return its index into the arrays."""
+        i = (self.start + self.size) % self.capacity
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.size += 1
+        for column, value in zip(self.columns, row):
+            column[i] = value
+        return i
+
+    def bisect(self, t):
+        """Return the number of rows older than t."""
+        lo, hi = 0, self.size
+        times = self.times
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[self.physical(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def rows(self, start, end):
+        """Return the list of rows with times in [start, end)."""
+        lo = self.bisect(start)
+        hi = self.bisect(end)
+        return [tuple(column[self.physical(i)] for column in self.columns) for i in range(lo, hi)]
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self.columns)
+
+    def as_saved(self):
+        """Return the columns of the rows, oldest first, each as base64 of its bytes."""
+        return [base64.b64encode((column[self.start:] + column[:self.start])[:self.size].tobytes()).decode('ascii')
+                for column in self.columns]
+
+    def load(self, saved, byteorder=sys.byteorder):
+        """Replace the rows by the ones returned by as_saved (on a machine of the byteorder), keep the newest."""
+        rows = [array(column.typecode, base64.b64decode(data)) for column, data in zip(self.columns, saved)]
+        if byteorder != sys.byteorder:
+            for r in rows:
+                r.byteswap()
+        size = min([self.capacity] + [len(r) for r in rows])
+        for column, r in zip(self.columns, rows):
+            column[0:size] = r[len(r) - size:]
+        self.start = 0
+        self.size = size
+
+
+class Rollup(Ring):
+    """Ring of buckets of period seconds with minimum, maximum, sum and count of the values."""
+
+    def __init__(self, period, capacity):
+        # the count is 32 bits, a replay at full speed puts every message in the same bucket
+        Ring.__init__(self, capacity, 'IfffI')
+        self.period = period
+        # start and index of the newest bucket
+        self.last_start = -1
+        self.last = None
+
+    def add(self, t, value):
+        t = int(t)
+        start = t - t % self.period
+        if start == self.last_start:
+            i = self.last
+            _, low, high, total, count = self.columns
+            if value < low[i]:
+                low[i] = value
+            elif value > high[i]:
+                high[i] = value
+            total[i] += value
+            count[i] += 1
+        elif start > self.last_start:
+            self.last = self.append((start, value, value, value, 1))
+            self.last_start = start
+
+    def rows(self, start, end):
+        """
+        Return the buckets overlapping [start, end).
+
+        Each as [start of bucket, minimum, maximum, mean, count].
+        """
+        return [[t, round(low, 2), round(high, 2), round(total / count, 2), count]
+                for t, low, high, total, count in Ring.rows(self, start - self.period + 1, end)]
+
+    def load(self, saved, byteorder=sys.byteorder):
+        Ring.load(self, saved, byteorder)
+        if self.size:
+            # the newest bucket goes on
+            self.last = self.size - 1
+            self.last_start = self.times[self.last]
+
+
+class Series:
+    """History of one type of values of one room."""
+
+    def __init__(self):
+        self.raw = Ring(History.RAW_POINTS, 'If')
+        self.rollups = [Rollup(period, capacity) for period, capacity in History.ROLLUPS]
+        self.last = 0
+
+    def add(self, t, value):
+        t = int(t)
+        if t < self.last:
+            # older than what we have, e.g. replayed after a restart; the rings must stay ordered
+            return
+        self.last = t
+        self.raw.append((t, value))
+        for rollup in self.rollups:
+            rollup.add(t, value)
+
+    def query(self, start, end, resolution=None):
+        """
+        Return (resolution name, points) for the time range [start, end).
+
+        Without resolution the finest one is chosen that has all values of the range (its
+        oldest row is not newer than start, or it did not overwrite any row yet) in at most
+        History.max_points points; the coarsest one if there is none such.
+        """
+        rings = [self.raw] + self.rollups
+        if resolution is not None:
+            ring = rings[History.RESOLUTIONS.index(resolution)]
+        else:
+            ring = rings[-1]
+            for r in rings:
+                complete = len(r) < r.capacity or r.times[r.physical(0)] <= start
+                if complete and r.bisect(end) - r.bisect(start) <= History.max_points:
+                    ring = r
+                    break
+        if ring is self.raw:
+            # the values are stored as float, round away the noise of the conversion
+            return 'raw', [[t, round(v, 2)] for t, v in ring.rows(start, end)]
+        return History.RESOLUTIONS[rings.index(ring)], ring.rows(start, end)
+
+    def nbytes(self):
+        return self.raw.nbytes() + sum(r.nbytes() for r in self.rollups)
+
+    def as_saved(self):
+        return {'raw': self.raw.as_saved(), 'rollups': [[r.period, r.as_saved()] for r in self.rollups]}
+
+    def load(self, saved, byteorder):
+        """Restore the rows returned by as_saved, the rollups of other periods than now are dropped."""
+        self.raw.load(saved['raw'], byteorder)
+        if len(self.raw):
+            self.last = self.raw.times[self.raw.physical(len(self.raw) - 1)]
+        rollups = dict((period, rows) for period, rows in saved['rollups'])
+        for rollup in self.rollups:
+            if rollup.period in rollups:
+                rollup.load(rollups[rollup.period], byteorder)
+
+
+class History:
+    """Series of values by room and type, fed by HttpServer.update_state."""
+
+    types = ('measured-low', 'measured-high', 'desired-temp', 'all-valves')
+    RAW_POINTS = 1024
+    # (period in seconds, number of buckets): a week of 5 minutes, three months of hours
+    ROLLUPS = ((300, 2016), (3600, 2208))
+    ROLLUP_NAMES = ('5m', '1h')
+    RESOLUTIONS = ('raw',) + ROLLUP_NAMES
+    max_series = 48
+    max_points = 1000
+
+    def __init__(self):
+        self.series = {}
+        # series not started as there were max_series of them, each is logged once
+        self.refused = set()
+
+    def add(self, room, msg_type, value, t):
+        """Add the value of the type received for the room at time t (seconds since epoch)."""
+        if msg_type not in History.types:
+            return
+        series = self.series.get((room, msg_type))
+        if series is None:
+            if len(self.series) >= History.max_series:
+                if (room, msg_type) not in self.refused and len(self.refused) < History.max_series:
+                    self.refused.add((room, msg_type))
+                    logger.warning("History of %s %s not started, there are already %d series", room, msg_type,
+                                   len(self.series))
+                return
+            series = self.series[(room, msg_type)] = Series()
+            logger.info("History of %s %s started, %d series", room, msg_type, len(self.series))
+        series.add(t, value)
+
+    def query(self, room, msg_type, start, end, resolution=None):
+        """
+        Return the history of the type of values of the room in [start, end) as dictionary.
+
+        {'room': ..., 'type': ..., 'resolution': 'raw', 'points': [[time, value], ...]}, or for
+        the other resolutions 'points': [[start of bucket, minimum, maximum, mean, count], ...].
+        Returns None if there is no such series.
+        """
+        series = self.series.get((room, msg_type))
+        if series is None:
+            return None
+        resolution, points = series.query(start, end, resolution)
+        return {'room': room, 'type': msg_type, 'resolution': resolution, 'points': points}
+
+    def list(self):
+        """Return the list of the series with the number of points in each resolution."""
+        return [dict([('room', room), ('type', msg_type), ('raw', len(s.raw))] +
+                     [(name, len(r)) for name, r in zip(History.ROLLUP_NAMES, s.rollups)])
+                for (room, msg_type), s in sorted(self.series.items())]
+
+    def nbytes(self):
+        """Return the memory taken by the arrays of all series."""
+        return sum(s.nbytes() for s in self.series.values())
+
+    def as_saved(self):
+        """
+        Return the series for saving.
+
+        {'byteorder': 'little', 'series': [[room, type, {'raw': columns,
+                                                         'rollups': [[period, columns], ...]}], ...]}
+        with the columns of the rows as in Ring.as_saved, up to about 120 kB of JSON per series.
+        """
+        return {'byteorder': sys.byteorder,
+                'series': [[room, msg_type, s.as_saved()] for (room, msg_type), s in sorted(self.series.items())]}
+
+    def load(self, saved):
+        """Restore the series returned by as_saved, replacing the ones with the same room and type."""
+        for room, msg_type, rows in saved['series']:
+            if (room, msg_type) not in self.series and len(self.series) >= History.max_series:
+                break
+            series = self.series[(room, msg_type)] = Series()
+            series.load(rows, saved['byteorder'])
+        logger.info("History of %d series restored", len(self.series))
@@ -4,122 +4,771 @@
 import sys
 import logging
 import os.path
-from time import sleep, time
+import threading
+import gzip
+import json
+import socket
+import signal
+from collections import deque
+from time import sleep, time, monotonic_ns
 from multiprocessing import Queue, Process
 from queue import Empty
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from json import dumps
-from typing import Dict, Any
-from message import HttpMessage
+from urllib.parse import urlsplit, parse_qs
+from typing import Dict, Any, List
+from message import HttpMessage, Payload, PayloadErrors
+from history import History
+from schedule import Schedules
+from health import HealthMonitor, RoomHealth
+from metrics import Metrics, Histogram, register_process, stage_latency
+from batch_queue import BatchReader, BatchWriter
 
 logger = logging.getLogger(__name__)
 
 
+class StaticFile:
+    """
+    File from HttpHandler.configRoot, kept in memory together with its compressed variant.
+
+    The body, its ETag and the compressed body are replaced together as one tuple in content,
+    so a request served while the file is reloaded gets all three of the same version.
+    """
+
+    content_types = {
+        '.html': 'text/html; charset=utf-8',
+        '.js': 'application/javascript; charset=utf-8',
+        '.css': 'text/css; charset=utf-8',
+        '.json': 'application/json',
+        '.svg': 'image/svg+xml',
+        '.png': 'image/png',
+        '.ico': 'image/x-icon',
+    }
+    # variants smaller than this are not worth compressing
+    min_compress = 256
+
+    def __init__(self, path):
+        """Load the file at path."""
+        self.path = path
+        self.content_type = StaticFile.content_types.get(os.path.splitext(path)[1], 'application/octet-stream')
+        self.mtime = None
+        self.content = None
+        self.load()
+
+    def load(self):
+        """(Re)load the file from disk and prepare its compressed variant."""
+        stat = os.stat(self.path)
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        etag = '"%x-%x"' % (int(stat.st_mtime), len(body))
+        compressed = None
+        if len(body) >= StaticFile.min_compress:
+            compressed = gzip.compress(body, mtime=0)
+            if len(compressed) >= len(body):
+                compressed = None
+        self.content = (body, etag, compressed)
+        self.mtime = stat.st_mtime
+        logger.info("Static file %s loaded", self.path)
+
+    def check(self):
+        """Reload the file if it was modified on disk."""
+        try:
+            if os.path.getmtime(self.path) != self.mtime:
+                self.load()
+        except OSError:
+            logger.error("Static file %s cannot be reloaded", self.path)
+
+
+class Subscriber:
+    """Client of the /events stream, collects the events published since its last write."""
+
+    __slots__ = ('pending', 'overflow')
+
+    # a client that does not read this many events is dropped, it will reconnect and get full state
+    max_pending = 100
+
+    def __init__(self):
+        self.pending = deque()
+        self.overflow = False
+
+    def publish(self, event):
+        """Add encoded event, must be called with HttpHandler.lock held."""
+        if len(self.pending) >= Subscriber.max_pending:
+            self.overflow = True
+        else:
+            self.pending.append(event)
+
+
 class HttpHandler(BaseHTTPRequestHandler):
     """Implements the do_GET for handling HTTP requests."""
 
     configRoot = '../http'
+    # keep-alive, every response has Content-Length; idle connections are closed after timeout
+    protocol_version = 'HTTP/1.1'
+    timeout = 60
+    # headers and body are written separately, Nagle would delay the body on kept-alive connections
+    disable_nagle_algorithm = True
+
+    # files from configRoot by their URL path, loaded by load_static
+    static_files: Dict[str, StaticFile] = {}
+    # if set, static files are checked for modification at most once per this many seconds
+    reload_interval = 2.0
+    last_reload = 0.0
 
     MSG_TO_KEEP = 5
-    state: Dict[str, Any] = {'errors': []}
+    # errors are counted by (error flags, room, type) in error_counts, each as a list
+    # [error, room, type, count, first seen, last seen]; when there are MAX_ERROR_KEYS of them,
+    # errors of other rooms are counted under room '*'. The last ERRORS_TO_KEEP errors are kept
+    # in a ring as [error, room, type, time]. See errors.
+    MAX_ERROR_KEYS = 50
+    ERRORS_TO_KEEP = 20
+    error_counts: Dict[tuple, list] = {}
+    recent_errors: deque = deque(maxlen=ERRORS_TO_KEEP)
+    # alerts of the rooms by HealthMonitor, fed by HttpServer.update_state, each as a list
+    # [room, kind, since, detail]; the statistics of the rooms are served on /health
+    health = HealthMonitor()
+    # rooms -> types -> deque of the last MSG_TO_KEEP entries, each entry has its 'seq'; the
+    # deques are serialized as lists, and the errors are added when the state is served
+    state: Dict[str, Any] = {}
+    # requests are served in threads while the queue is drained in another one, the lock
+    # guards the state against being read while it is being updated
+    lock = threading.RLock()
+    # notified whenever events are published to the subscribers of /events
+    events = threading.Condition(lock)
+    subscribers: List[Subscriber] = []
+    # comment sent to idle /events streams so that dead clients are detected
+    ping_interval = 15.0
+    # version of the state, bumped by HttpServer.update_state, it is also the sequence number of
+    # the last entry; the serialized state is cached in snapshot until the version changes
+    version = 0
+    snapshot = None
+    # distinguishes ETags of different runs of the server, version starts from zero in each
+    etag_prefix = '%x' % int(time())
+    # temperatures and valve positions for /history, fed by HttpServer.update_state
+    history = History()
+    # range of /history if the request does not give it, in seconds
+    history_range = 86400
+    # weekly programs of the thermostats for /schedule, fed by HttpServer.update_state
+    schedules = Schedules()
+
+    ROUTES = ('data', 'changes', 'history', 'schedule', 'health', 'metrics', 'static')
+    request_latency = Histogram('fht_http_request_duration_seconds', "Time to serve the HTTP requests by route "
+                                "(without the /events streams)", 'route', ROUTES)
 
     def do_GET(self):
         """
         Serve data to client.
 
-        We only now how to server two kinds of data: the basic webpage and the JSON with data
-        If we are asked for JSON specifically, we return than, in all other cases we return
-        the basic page.
+        - /fht_data.json: the whole state with its ETag (send_json), or with ?since=&run= the
+          entries changed since the cursor (send_changes)
+        - /events: the changes pushed as Server-Sent Events (send_events)
+        - /history: the history of a room and type of values (send_history)
+        - /schedule: the weekly programs of the thermostats (Schedules.json)
+        - /health: the statistics of the rooms (HealthMonitor.as_dict)
+        - /metrics: the metrics in Prometheus text format (send_metrics)
+        - anything else: the static file of that name, the basic page if there is none
         """
+        started = monotonic_ns()
+        url = urlsplit(self.path)
+        path = url.path
+        if path == '/fht_data.json':
+            query = parse_qs(url.query)
+            if 'since' in query:
+                route = 'changes'
+                self.send_changes(query['since'][0], query.get('run', [None])[0])
+            else:
+                route = 'data'
+                self.send_json()
+        elif path == '/events':
+            self.send_events()
+            return
+        elif path == '/history':
+            route = 'history'
+            self.send_history(parse_qs(url.query))
+        elif path == '/schedule':
+            route = 'schedule'
+            with HttpHandler.lock:
+                body = HttpHandler.schedules.json()
+            self.send_body(body)
+        elif path == '/health':
+            route = 'health'
+            with HttpHandler.lock:
+                reply = HttpHandler.health.as_dict(time())
+            self.send_body(dumps(reply, separators=(',', ':')).encode('utf-8'))
+        elif path == '/metrics':
+            route = 'metrics'
+            self.send_metrics()
+        else:
+            route = 'static'
+            static = HttpHandler.get_static(path) or HttpHandler.get_static('/index.html')
+            self.send_static(static)
+        HttpHandler.request_latency.observe((monotonic_ns() - started) / 1e9, route)
+
+    @staticmethod
+    def load_static():
+        """Load all files from configRoot into memory."""
+        HttpHandler.static_files = {}
+        for name in os.listdir(HttpHandler.configRoot):
+            path = os.path.join(HttpHandler.configRoot, name)
+            if os.path.isfile(path):
+                HttpHandler.static_files['/' + name] = StaticFile(path)
+        if '/index.html' in HttpHandler.static_files:
+            HttpHandler.static_files['/'] = HttpHandler.static_files['/index.html']
+        HttpHandler.last_reload = time()
+
+    @staticmethod
+    def get_static(path):
+        """Return StaticFile for the URL path or None, reloading modified files if enabled."""
+        if HttpHandler.reload_interval is not None and time() - HttpHandler.last_reload > HttpHandler.reload_interval:
+            HttpHandler.last_reload = time()
+            for static in set(HttpHandler.static_files.values()):
+                static.check()
+        return HttpHandler.static_files.get(path)
+
+    def send_static(self, static):
+        """Send the static file from memory, compressed if the client accepts it."""
+        if static is None:
+            self.send_error(404)
+            return
+        body, etag, compressed = static.content
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
         self.send_response(200)
-        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Type', static.content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if compressed is not None and self.accepts_gzip():
+            body = compressed
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def accepts_gzip(self):
+        """Return True if the client accepts gzip content encoding."""
+        return 'gzip' in self.headers.get('Accept-Encoding', '')
+
+    def send_json(self):
+        """
+        Send the JSON with all data, unless the client already has the current version.
+
+        The client gets ETag of the state version it received, and the browser revalidates it
+        with If-None-Match on the next request; if the state did not change since, the reply is
+        304 without body.
+        """
+        etag, body, compressed = HttpHandler.get_snapshot(self.accepts_gzip())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if compressed is not None:
+            body = compressed
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self):
+        """
+        Stream the changes of the state to the client as Server-Sent Events.
+
+        The stream starts with the 'state' event with the whole state, followed by the 'update'
+        events, each with the list of changes applied to the state by one batch of messages from
+        dispatcher (see HttpServer.publish). The snapshot is taken and the subscriber registered
+        under the lock, so no change is either missed or applied twice by the client.
+        """
+        subscriber = Subscriber()
+        with HttpHandler.lock:
+            _, body, _ = HttpHandler.get_snapshot()
+            HttpHandler.subscribers.append(subscriber)
+        logger.info("Events subscriber connected, %d subscribers", len(HttpHandler.subscribers))
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(b'event: state\ndata: ' + body + b'\n\n')
+            while True:
+                with HttpHandler.events:
+                    if not subscriber.pending and not subscriber.overflow:
+                        HttpHandler.events.wait(HttpHandler.ping_interval)
+                    if subscriber.overflow:
+                        break
+                    events = list(subscriber.pending)
+                    subscriber.pending.clear()
+                self.wfile.write(b''.join(events) if events else b': ping\n\n')
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            pass
+        finally:
+            with HttpHandler.lock:
+                HttpHandler.subscribers.remove(subscriber)
+            logger.info("Events subscriber disconnected, %d subscribers", len(HttpHandler.subscribers))
+
+    def send_changes(self, since, run):
+        """
+        Send the entries newer than the client's cursor.
+
+        Reply to /fht_data.json?since=<seq>&run=<run>, where seq and run are the values from the
+        previous reply (run identifies the run of the server, sequence numbers restart with it):
+        {
+            'run': <run>,
+            'seq': <sequence number of the newest entry>,
+            'reset': true if the client has to drop its state first,
+            'changes': [{'room': ..., 'type': ..., 'entry': {...}}, ...],
+            'errors': {'counts': [...], 'recent': [...], 'alerts': [...]}
+        }
+        A client without state asks with since=0 and gets all entries. The changes are the same
+        as in the 'update' events of /events.
+        """
+        try:
+            since = int(since)
+        except ValueError:
+            self.send_error(400, "Invalid since")
+            return
+        with HttpHandler.lock:
+            reset = (run is not None and run != HttpHandler.etag_prefix) or since > HttpHandler.version
+            if reset:
+                since = 0
+            changes = HttpHandler.get_changes(since)
+            body = dumps({
+                'run': HttpHandler.etag_prefix,
+                'seq': HttpHandler.version,
+                'reset': reset,
+                'changes': changes,
+                'errors': HttpHandler.errors()
+            }, default=list).encode('utf-8')
+        self.send_body(body)
+
+    def send_history(self, query):
+        """
+        Send the history of a type of values of a room.
+
+        Reply to /history?room=<room>&type=<type>&from=<time>&to=<time>&res=<resolution>, times
+        in seconds since epoch; to is now and from history_range before to by default, the
+        resolution (raw, 5m or 1h) is chosen by History by default. See History.query for the
+        reply. Without room and type the list of the series is sent:
+        {'series': [{'room': ..., 'type': ..., 'raw': <points>, '5m': ..., '1h': ...}, ...], 'bytes': ...}
+        """
+        room = query.get('room', [None])[0]
+        msg_type = query.get('type', [None])[0]
+        resolution = query.get('res', [None])[0]
+        try:
+            end = float(query['to'][0]) if 'to' in query else time()
+            start = float(query['from'][0]) if 'from' in query else end - HttpHandler.history_range
+        except ValueError:
+            self.send_error(400, "Invalid time")
+            return
+        if resolution is not None and resolution not in History.RESOLUTIONS:
+            self.send_error(400, "Invalid resolution")
+            return
+        with HttpHandler.lock:
+            if room is None and msg_type is None:
+                reply = {'series': HttpHandler.history.list(), 'bytes': HttpHandler.history.nbytes()}
+            else:
+                reply = HttpHandler.history.query(room, msg_type, start, end, resolution)
+            body = None if reply is None else dumps(reply, separators=(',', ':')).encode('utf-8')
+        if body is None:
+            self.send_error(404, "No history of %s %s" % (room, msg_type))
+            return
+        self.send_body(body)
+
+    def send_metrics(self):
+        """Send the metrics of the pipeline in the Prometheus text format, see metrics."""
+        body = Metrics.render().encode('utf-8')
+        self.send_body(body, 'text/plain; version=0.0.4; charset=utf-8')
+
+    def send_body(self, body, content_type='application/json'):
+        """Send the body (JSON by default), not to be cached, compressed if the client accepts it."""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
         self.send_header('Cache-Control', 'no-store')
+        if len(body) >= StaticFile.min_compress and self.accepts_gzip():
+            body = gzip.compress(body, mtime=0)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        if self.path == '/fht_data.json':
-            self.wfile.write(bytes(self.get_json(), 'utf-8'))
-        else:
-            with open(os.path.join(HttpHandler.configRoot, 'index.html')) as f:
-                html = f.read()
-            self.wfile.write(bytes(html, 'utf-8'))
+        self.wfile.write(body)
 
-    def get_json(self):
+    @staticmethod
+    def get_changes(since):
+        """Return the list of changes with entries newer than since, ordered by seq; needs the lock."""
+        changes = []
+        for room, types in HttpHandler.state.items():
+            for msg_type, entries in types.items():
+                for entry in entries:
+                    if entry['seq'] > since:
+                        changes.append({'room': room, 'type': msg_type, 'entry': entry})
+        changes.sort(key=lambda c: c['entry']['seq'])
+        return changes
+
+    @staticmethod
+    def get_snapshot(compress=False):
+        """
+        Return (etag, JSON as bytes, gzipped JSON or None) for the current version of the state.
+
+        The state is serialized once per version, the compressed variant is created on the first
+        request that asks for it.
         """
-        Send the client JSON with all data.
+        with HttpHandler.lock:
+            snapshot = HttpHandler.snapshot
+            if snapshot is None or snapshot[0] != HttpHandler.version:
+                etag = '"%s-%d"' % (HttpHandler.etag_prefix, HttpHandler.version)
+                snapshot = [HttpHandler.version, etag, HttpHandler.get_json().encode('utf-8'), None]
+                HttpHandler.snapshot = snapshot
+            if compress and snapshot[3] is None:
+                snapshot[3] = gzip.compress(snapshot[2], mtime=0)
+            return snapshot[1], snapshot[2], snapshot[3] if compress else None
+
+    @staticmethod
+    def get_json():
+        """
+        Serialize the state to JSON, must be called with the lock held.
 
         JSON file structure:
         {
             <room_name>: {
                 <msg_type>: [
-                    {<cmnd>: value, 'flags': [...]}, ... # last five messages of this type
+                    {<cmnd>: value, 'flags': [...], 'time': t, 'seq': n}, ... # last five messages of this type
                 ],
                 ...
             },
             ...
-            'errors': [list of errors]
+            'errors': {
+                'counts': [[error flags, room, type, count, first seen, last seen], ...],
+                'recent': [[error flags, room, type, time], ...],  # last ERRORS_TO_KEEP errors
+                'alerts': [[room, kind, since, detail], ...]  # active alerts, see HealthMonitor
+            }
         }
+        The lists of messages are deques in the state, they are serialized as lists.
         """
-        return dumps(HttpHandler.state)
+        return dumps(dict(HttpHandler.state, errors=HttpHandler.errors()), default=list)
+
+    @staticmethod
+    def errors():
+        """Return the errors served with the state: the counts, the recent errors and the alerts; needs the lock."""
+        return {
+            'counts': list(HttpHandler.error_counts.values()),
+            'recent': list(HttpHandler.recent_errors),
+            'alerts': list(HttpHandler.health.alerts.values())
+        }
+
+    def log_message(self, format, *args):
+        """Log the requests to our logger instead of stderr."""
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ThreadedServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer with longer backlog for many clients connecting at once."""
+
+    daemon_threads = True
+    request_queue_size = 64
 
 
 class HttpServer(Process):
     """HTTP Server process, receives messages from dispatcher."""
 
     serverPort = 80
-    timeout = 0.1
+    batch_size = 100
+    # the state is saved at most this often (in seconds) when it changes, see save_state
+    snapshot_interval = 60.0
+    SNAPSHOT_FORMAT = 1
 
-    def __init__(self, queue: Queue):
+    def __init__(self, queue: Queue, port=None, state_path=None):
         """
         Create HTTP server to display the web page with current status of FHT devices.
 
-        :param queue: queue for receiving data from the process that reads serial port
+        :param queue: queue for receiving data from the process that reads serial port, None if
+                      the messages are passed to apply_batch directly (the single-process mode)
+        :param port: port to listen on, HttpServer.serverPort by default
+        :param state_path: file the state is restored from at start and periodically saved to,
+                           None to start with empty state and not save it
         """
         Process.__init__(self)
-        self.msg_queue = queue
+        self.msg_queue = None
+        if queue is not None:
+            self.msg_queue = BatchReader(queue, HttpMessage.from_tuple, 'dispatcher->http')
+        self.port = HttpServer.serverPort if port is None else port
+        self.state_path = state_path
         self.server = None
 
     def run(self):
         """
         Start the server main loop.
 
-        We check for a new request with HttpServer.timeout, than we check for
-        a new message from dispatcher and add it to our state.
+        Requests are served by ThreadedServer, each in its own thread, so a slow client does
+        not block the others. Messages from dispatcher are applied to the state in a separate
+        thread, see drain_queue.
         """
-        self.server = HTTPServer(('', HttpServer.serverPort), HttpHandler)
-        self.server.timeout = HttpServer.timeout
-        self.server.msg_queue = self.msg_queue
+        self.open()
+        if self.msg_queue is not None:
+            drain = threading.Thread(target=self.drain_queue, name='drain_queue', daemon=True)
+            drain.start()
+        self.serve()
+
+    def open(self):
+        """
+        Load the static files and the saved state, bind the server to the port.
+
+        SIGTERM (e.g. from Process.terminate) unwinds the thread that opened the server, so that
+        the state is saved before the process exits, see terminated.
+        """
+        register_process('http')
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, HttpServer.terminated)
+        HttpHandler.load_static()
+        if self.state_path is not None:
+            self.load_state(self.state_path)
+            saver = threading.Thread(target=self.save_periodically, name='save_state', daemon=True)
+            saver.start()
+        watch = threading.Thread(target=self.watch_health, name='watch_health', daemon=True)
+        watch.start()
+        self.server = ThreadedServer(('', self.port), HttpHandler)
+
+    def serve(self):
+        """Serve the requests until the server is shut down or terminated, then save the state."""
         logger.warning("HTTP server running")
         try:
-            while True:
-                self.server.handle_request()
-                try:
-                    msg: HttpMessage = self.msg_queue.get(False)
-                    self.update_state(msg)
-                    logger.debug("HTTP message received")
-                except Empty:
-                    pass
+            self.server.serve_forever()
         except Exception:
             print(sys.exc_info())
+        finally:
+            if self.state_path is not None:
+                self.save_state(self.state_path)
+            logger.warning("HTTP server terminating")
+
+    def shutdown(self):
+        """Stop serving from another thread than the one in serve, which saves the state and returns."""
+        self.server.shutdown()
+
+    @staticmethod
+    def terminated(signum, frame):
+        """Handle SIGTERM by exiting the main thread, the state is saved on the way out (see serve)."""
+        logger.warning("HTTP server terminated by signal %d", signum)
+        raise SystemExit(0)
+
+    def save_periodically(self):
+        """Save the state every snapshot_interval seconds if it changed."""
+        saved = HttpHandler.version
+        while True:
+            sleep(HttpServer.snapshot_interval)
+            if HttpHandler.version != saved:
+                saved = self.save_state(self.state_path)
+
+    def watch_health(self):
+        """Raise the alerts that need no message (see HealthMonitor.check) every check_interval, publish them."""
+        health = HttpHandler.health
+        while True:
+            sleep(HealthMonitor.check_interval)
+            with HttpHandler.lock:
+                health.check(time())
+                if health.changed:
+                    health.changed = False
+                    # a new version, so that the clients polling the whole state get the alerts too
+                    HttpHandler.version += 1
+                    self.publish([{'errors': HttpHandler.errors()}])
+
+    @staticmethod
+    def save_state(path):
+        """
+        Save the state to the gzipped JSON file at path, return the version that was saved.
+
+        The file contains the entries of all rooms and types, the errors, the weekly programs, the
+        health of the rooms and their history:
+        {'format': 1, 'saved': <time>, 'rooms': {room: {type: [entry, ...]}}, 'errors': {...},
+         'schedules': {...}, 'health': {...}, 'history': {...}} (see Schedules.as_saved,
+        HealthMonitor.as_saved and History.as_saved)
+        It is written to a temporary file first, which then replaces the target, so a crash
+        never leaves a partial snapshot behind.
+        """
+        with HttpHandler.lock:
+            version = HttpHandler.version
+            data = dumps({
+                'format': HttpServer.SNAPSHOT_FORMAT,
+                'saved': time(),
+                'rooms': HttpHandler.state,
+                'errors': HttpHandler.errors(),
+                'schedules': HttpHandler.schedules.as_saved(),
+                'health': HttpHandler.health.as_saved(),
+                'history': HttpHandler.history.as_saved()
+            }, default=list, separators=(',', ':'))
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(gzip.compress(data.encode('utf-8'), mtime=0))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error("Cannot save the state to %s: %s", path, e)
+            return version
+        logger.debug("State version %d saved to %s", version, path)
+        return version
+
+    @staticmethod
+    def read_state(path):
+        """Return the data saved by save_state at path, None if there is none or it cannot be read."""
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(gzip.decompress(f.read()))
+            if data.get('format') != HttpServer.SNAPSHOT_FORMAT:
+                raise ValueError("unknown format %r" % data.get('format'))
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError) as e:
+            logger.error("Cannot restore the state from %s: %s", path, e)
+            return None
+        return data
 
-        logger.warning("HTTP server terminating")
+    @staticmethod
+    def load_state(path):
+        """
+        Restore the state saved by save_state, return the time it was saved or None.
+
+        The entries are renumbered in their original order, the new run of the server starts
+        with them as if it received them.
+        """
+        data = HttpServer.read_state(path)
+        if data is None:
+            return None
+        with HttpHandler.lock:
+            entries = []
+            for room, types in data['rooms'].items():
+                HttpHandler.state[room] = {}
+                for msg_type, saved in types.items():
+                    HttpHandler.state[room][msg_type] = deque(saved, maxlen=HttpHandler.MSG_TO_KEEP)
+                    entries += saved
+            entries.sort(key=lambda e: e['seq'])
+            for seq, entry in enumerate(entries, HttpHandler.version + 1):
+                entry['seq'] = seq
+            HttpHandler.version += len(entries)
+            HttpHandler.error_counts.clear()
+            for count in data['errors']['counts']:
+                HttpHandler.error_counts[tuple(count[0:3])] = count
+            HttpHandler.recent_errors.extend(data['errors']['recent'])
+            HttpHandler.schedules.load(data.get('schedules', {}))
+            if 'health' in data:
+                HttpHandler.health.load(data['health'])
+            else:
+                # saved before the health was, the rooms are at least alerted when they stay silent
+                for room, types in data['rooms'].items():
+                    last_seen = max((e['time'] for saved in types.values() for e in saved), default=None)
+                    if last_seen is not None:
+                        HttpHandler.health.rooms.setdefault(room, RoomHealth(last_seen))
+            if 'history' in data:
+                HttpHandler.history.load(data['history'])
+            HttpHandler.snapshot = None
+        logger.warning("State with %d entries restored from %s", len(entries), path)
+        return data['saved']
+
+    def drain_queue(self):
+        """
+        Apply the messages from dispatcher to the state.
+
+        Wait for a batch of messages, then take the other batches that are waiting in the queue
+        (up to batch_size messages) and apply them all at once, see apply_batch.
+        """
+        while True:
+            batch = self.msg_queue.get()
+            oldest = self.msg_queue.oldest
+            try:
+                while len(batch) < HttpServer.batch_size:
+                    batch += self.msg_queue.get(False)
+            except Empty:
+                pass
+            self.apply_batch(batch, oldest)
+
+    def apply_batch(self, batch, analyzed=None):
+        """
+        Apply the list of messages to the state under one acquisition of the lock, publish the changes.
+
+        :param analyzed: time.monotonic_ns when the oldest message of the batch was analyzed, if it
+                         is known, for the latency metrics
+        """
+        with HttpHandler.lock:
+            changes = [self.update_state(msg) for msg in batch]
+            if HttpHandler.health.changed or any(msg.error != 0 for msg in batch):
+                HttpHandler.health.changed = False
+                changes.append({'errors': HttpHandler.errors()})
+            self.publish(changes)
+        if analyzed is not None:
+            stage_latency.observe((monotonic_ns() - analyzed) / 1e9, 'applied')
+        logger.debug("%d HTTP messages received", len(batch))
+
+    @staticmethod
+    def publish(changes):
+        """
+        Send the changes of the state to all subscribers of /events as one 'update' event.
+
+        The changes are those returned by update_state, if the errors changed, the last item is
+        {'errors': <HttpHandler.errors()>}. Must be called with the lock held. The event is
+        encoded only once for all subscribers, and publishing never blocks, slow subscribers are
+        dropped instead (see Subscriber).
+        """
+        if not HttpHandler.subscribers:
+            return
+        event = b'event: update\ndata: ' + dumps(changes, default=list).encode('utf-8') + b'\n\n'
+        for subscriber in HttpHandler.subscribers:
+            subscriber.publish(event)
+        HttpHandler.events.notify_all()
 
     def update_state(self, msg: HttpMessage):
-        """Update HttpHandler state with values from the message we received."""
+        """
+        Update HttpHandler state with values from the message we received.
+
+        Returns the change, dictionary with room, type and the entry that was added to the state.
+        """
+        HttpHandler.version += 1
+        msg_type, value, warning, command, flags = msg.payload
         if msg.room not in HttpHandler.state:
             HttpHandler.state[msg.room] = {}
-        if msg.payload['type'] not in HttpHandler.state[msg.room]:
-            HttpHandler.state[msg.room][msg.payload['type']] = []
-        if len(HttpHandler.state[msg.room][msg.payload['type']]) >= HttpHandler.MSG_TO_KEEP:
-            del HttpHandler.state[msg.room][msg.payload['type']][0]
-        value = msg.payload['value']
-        if msg.payload['type'] == 'warnings':
-            value = msg.payload['warning']
-        HttpHandler.state[msg.room][msg.payload['type']].append({
-            msg.payload['command']: value,
-            'flags': msg.payload['flags'],
-            'time': time()
-        })
+        if msg_type not in HttpHandler.state[msg.room]:
+            HttpHandler.state[msg.room][msg_type] = deque(maxlen=HttpHandler.MSG_TO_KEEP)
+        if msg_type == 'warnings':
+            value = warning
+        entry = {
+            command: value,
+            'flags': flags,
+            'time': time() if msg.time is None else msg.time,
+            'seq': HttpHandler.version
+        }
+        HttpHandler.state[msg.room][msg_type].append(entry)
+        # unknown addresses (e.g. devices of the neighbours) would take the series of the rooms
+        known = not msg.error & PayloadErrors.NEW_ROOM
+        if known and msg_type in History.types and isinstance(value, (int, float)):
+            HttpHandler.history.add(msg.room, msg_type, value, entry['time'])
+        elif known and msg_type in Schedules.index:
+            HttpHandler.schedules.add(msg.room, msg_type, value, entry['time'])
+        if known:
+            HttpHandler.health.add(msg.room, msg_type, value, warning, entry['time'])
         if msg.error != 0:
-            HttpHandler.state['errors'].append(msg.error)
+            self.record_error(msg, entry['time'])
+        return {'room': msg.room, 'type': msg_type, 'entry': entry}
+
+    @staticmethod
+    def record_error(msg: HttpMessage, t):
+        """Count the error of the message and add it to the recent errors."""
+        t = int(t)
+        key = (msg.error, msg.room, msg.payload['type'])
+        counts = HttpHandler.error_counts
+        if key not in counts:
+            if len(counts) >= HttpHandler.MAX_ERROR_KEYS:
+                key = (msg.error, '*', msg.payload['type'])
+            if key not in counts:
+                counts[key] = [key[0], key[1], key[2], 0, t, t]
+        counts[key][3] += 1
+        counts[key][5] = t
+        HttpHandler.recent_errors.append([msg.error, msg.room, msg.payload['type'], t])
 
 
 if __name__ == "__main__":
@@ -128,16 +777,8 @@ if __name__ == "__main__":
     msg_queue = Queue()  # type: Queue
     server = HttpServer(msg_queue)
     server.start()
+    writer = BatchWriter(msg_queue, HttpMessage.to_tuple)
     while True:
         sleep(5)
-        msg_queue.put(HttpMessage(
-            'main room',
-            0,
-            {
-                'type': 'all-valves',
-                'value': 0.0,
-                'warning': '',
-                'command': 'set-valve',
-                'flags': ['extended', 'repetitions']
-            }
-        ))
+        writer.put(HttpMessage('main room', 0, Payload('all-valves', 0.0, '', 'set-valve', ('extended', 'repetitions'))))
+        writer.flush()
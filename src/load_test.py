@@ -0,0 +1,159 @@
+#! /usr/bin/python
+"""
+Load test of the HTTP server.
+
+Starts the HttpServer process on a local port, then for a given time
+- several client threads request the JSON with data as fast as they can,
+- a feeder puts bursts of messages into the server queue and measures how long it takes
+  before the last message of the burst is visible in the JSON (message drain latency).
+With --legacy the test runs against the original server loop, which alternates a request
+with a single message from the queue, for comparison.
+"""
+
+import os.path
+import json
+import time
+import argparse
+import logging
+import threading
+import http.client
+from multiprocessing import Queue
+from queue import Empty
+from http.server import HTTPServer
+from http_server import HttpServer, HttpHandler
+from message import HttpMessage, Payload
+from batch_queue import BatchWriter
+
+
+class LegacyHttpHandler(HttpHandler):
+    """The original handler: no keep-alive, page read from disk and state serialized per request."""
+
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        if self.path == '/fht_data.json':
+            self.wfile.write(bytes(HttpHandler.get_json(), 'utf-8'))
+        else:
+            with open(os.path.join(HttpHandler.configRoot, 'index.html')) as f:
+                html = f.read()
+            self.wfile.write(bytes(html, 'utf-8'))
+
+
+class LegacyHttpServer(HttpServer):
+    """The original server loop: one request or timeout, then at most one message (a batch of one)."""
+
+    timeout = 0.1
+
+    def run(self):
+        self.server = HTTPServer(('', self.port), LegacyHttpHandler)
+        self.server.timeout = LegacyHttpServer.timeout
+        while True:
+            self.server.handle_request()
+            try:
+                for msg in self.msg_queue.get(False):
+                    self.update_state(msg)
+            except Empty:
+                pass
+
+
+def message(room, value):
+    return HttpMessage(room, 0, Payload('all-valves', value, '', 'set-valve', ('extended',)))
+
+
+def get(port, path='/fht_data.json', conn=None):
+    """GET the path, reusing the connection conn if given."""
+    close = conn is None
+    if conn is None:
+        conn = http.client.HTTPConnection('localhost', port, timeout=30)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    data = response.read()
+    if close or response.will_close:
+        conn.close()
+    return data
+
+
+def get_json(port):
+    return get(port)
+
+
+def client(port, stop, counts, path, keep_alive):
+    n = 0
+    conn = http.client.HTTPConnection('localhost', port, timeout=30) if keep_alive else None
+    while not stop.is_set():
+        get(port, path, conn)
+        n += 1
+    counts.append(n)
+
+
+def feeder(port, queue, stop, burst, latencies, max_batch):
+    seq = 0
+    writer = BatchWriter(queue, HttpMessage.to_tuple, max_batch=max_batch)
+    while not stop.is_set():
+        start = time.perf_counter()
+        for _ in range(burst):
+            seq += 1
+            writer.put(message('load test', seq))
+        writer.flush()
+        while not stop.is_set():
+            state = json.loads(get_json(port))
+            if state.get('load test', {}).get('all-valves', [{}])[-1].get('set-valve') == seq:
+                latencies.append(time.perf_counter() - start)
+                break
+            time.sleep(0.001)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the HTTP server.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--clients', type=int, default=8, help="number of concurrent clients")
+    parser.add_argument('--burst', type=int, default=50, help="number of messages in one burst")
+    parser.add_argument('--duration', type=float, default=5.0, help="length of the test in seconds")
+    parser.add_argument('--path', default='/fht_data.json', help="path the clients request")
+    parser.add_argument('--keep-alive', action='store_true', help="clients reuse their connections")
+    parser.add_argument('--legacy', action='store_true', help="test the original server loop")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    queue = Queue()  # type: Queue
+    server = (LegacyHttpServer if args.legacy else HttpServer)(queue, args.port)
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+
+    stop = threading.Event()
+    counts = []
+    latencies = []
+    threads = [threading.Thread(target=client, args=(args.port, stop, counts, args.path, args.keep_alive))
+               for _ in range(args.clients)]
+    # the legacy server takes one message at a time
+    max_batch = 1 if args.legacy else None
+    threads.append(threading.Thread(target=feeder, args=(args.port, queue, stop, args.burst, latencies, max_batch)))
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    server.terminate()
+
+    latencies.sort()
+    print(json.dumps({
+        'server': 'legacy' if args.legacy else 'threaded',
+        'clients': args.clients,
+        'path': args.path,
+        'keep_alive': args.keep_alive,
+        'requests_per_s': sum(counts) / args.duration,
+        'bursts': len(latencies),
+        'burst_size': args.burst,
+        'drain_latency_median_ms': 1000 * latencies[len(latencies) // 2] if latencies else None,
+        'drain_latency_max_ms': 1000 * latencies[-1] if latencies else None
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#! /usr/bin/python
+"""
+Compact columnar archive of the rotated FHT message logs.
+
+The listener writes one text log every four hours. Once the rotation is closed, the text log
+can be compacted into a binary file with the same name and the suffix LogArchive.SUFFIX.
+The archive stores the messages in blocks, each block has its own entry in the index at the
+start of the file, so that a query for some addresses and time range reads only the header
+and the blocks that can contain matching messages.
+"""
+
+import os
+import os.path
+import sys
+import struct
+import logging
+import datetime
+from array import array
+from message import FhtMessage
+
+logger = logging.getLogger(__name__)
+
+
+class LogArchive:
+    """
+    Static class for writing and querying the compacted message logs.
+
+    File layout (all numbers little endian):
+    header:  magic, version, number of blocks, number of records, min time, max time
+    index:   for each block: offset, number of records, min time, max time, number of addresses,
+             followed by the list of addresses present in the block
+    blocks:  for each block the columns of its records:
+             time     int64, microseconds since 1970-01-01 of the (naive) time in the text log
+             address  uint16
+             msg_type uint8
+             command  uint8
+             value    VALUE_WIDTH ascii characters padded by zero bytes
+    """
+
+    SUFFIX = '.fhtc'
+    MAGIC = b'FHTC'
+    VERSION = 1
+    BLOCK_SIZE = 4096
+    VALUE_WIDTH = 8
+
+    header = struct.Struct('<4sHIIqq')
+    block_entry = struct.Struct('<QIqqH')
+
+    epoch = datetime.datetime(1970, 1, 1)
+    microsecond = datetime.timedelta(microseconds=1)
+
+    @staticmethod
+    def to_int(t: datetime.datetime):
+        """Convert datetime from the message log to microseconds since epoch."""
+        return (t - LogArchive.epoch) // LogArchive.microsecond
+
+    @staticmethod
+    def to_datetime(us):
+        """Convert microseconds since epoch back to datetime."""
+        return LogArchive.epoch + datetime.timedelta(microseconds=us)
+
+    @staticmethod
+    def archive_name(path):
+        """Return the name of the archive for the text log at path."""
+        return os.path.splitext(path)[0] + LogArchive.SUFFIX
+
+    @staticmethod
+    def _column(typecode, data):
+        col = array(typecode)
+        col.frombytes(data)
+        if sys.byteorder == 'big':
+            col.byteswap()
+        return col
+
+    @staticmethod
+    def _bytes(col):
+        if sys.byteorder == 'big':
+            col = array(col.typecode, col)
+            col.byteswap()
+        return col.tobytes()
+
+    @staticmethod
+    def write(path, messages):
+        """
+        Write the messages to the archive at path.
+
+        The archive is first written to a temporary file which then replaces the target, so the
+        readers never see a partially written archive. Messages that cannot be stored in fixed
+        width columns (non-hex address, type or command, or too long value) are skipped.
+        Returns tuple (number of records written, number of records skipped).
+        """
+        times = array('q')
+        addresses = array('H')
+        types = array('B')
+        commands = array('B')
+        values = bytearray()
+        skipped = 0
+        for msg in messages:
+            try:
+                if len(msg.address) != 4 or len(msg.msg_type) != 2 or len(msg.command) != 2:
+                    raise ValueError
+                address = int(msg.address, 16)
+                msg_type = int(msg.msg_type, 16)
+                command = int(msg.command, 16)
+                value = msg.value.encode('ascii')
+                if len(value) > LogArchive.VALUE_WIDTH:
+                    raise ValueError
+            except (ValueError, UnicodeEncodeError):
+                logger.warning("Message cannot be archived: %s", msg)
+                skipped += 1
+                continue
+            times.append(LogArchive.to_int(msg.time))
+            addresses.append(address)
+            types.append(msg_type)
+            commands.append(command)
+            values += value.ljust(LogArchive.VALUE_WIDTH, b'\0')
+
+        count = len(times)
+        starts = range(0, count, LogArchive.BLOCK_SIZE)
+        entries = []
+        index_size = LogArchive.header.size
+        for start in starts:
+            block_addresses = sorted(set(addresses[start:start + LogArchive.BLOCK_SIZE]))
+            entries.append(block_addresses)
+            index_size += LogArchive.block_entry.size + 2 * len(block_addresses)
+
+        record_size = 8 + 2 + 1 + 1 + LogArchive.VALUE_WIDTH
+        index = bytearray(LogArchive.header.pack(
+            LogArchive.MAGIC, LogArchive.VERSION, len(entries), count,
+            min(times) if count else 0, max(times) if count else 0))
+        body = bytearray()
+        for start, block_addresses in zip(starts, entries):
+            end = min(start + LogArchive.BLOCK_SIZE, count)
+            block_times = times[start:end]
+            index += LogArchive.block_entry.pack(
+                index_size + len(body), end - start, min(block_times), max(block_times), len(block_addresses))
+            index += struct.pack('<%dH' % len(block_addresses), *block_addresses)
+            body += LogArchive._bytes(block_times)
+            body += LogArchive._bytes(addresses[start:end])
+            body += types[start:end].tobytes()
+            body += commands[start:end].tobytes()
+            body += values[start * LogArchive.VALUE_WIDTH:end * LogArchive.VALUE_WIDTH]
+            assert len(body) % record_size == 0
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(index)
+            f.write(body)
+        os.replace(tmp_path, path)
+        return count, skipped
+
+    @staticmethod
+    def read_index(f):
+        """
+        Read the header and the block index from the open archive f.
+
+        Returns tuple (header, blocks) where header is (record count, min time, max time) and
+        blocks is a list of (offset, record count, min time, max time, set of addresses).
+        """
+        magic, version, block_count, count, tmin, tmax = LogArchive.header.unpack(f.read(LogArchive.header.size))
+        if magic != LogArchive.MAGIC or version != LogArchive.VERSION:
+            raise ValueError("Not a message log archive: %s" % f.name)
+        blocks = []
+        for _ in range(block_count):
+            offset, n, btmin, btmax, address_count = LogArchive.block_entry.unpack(
+                f.read(LogArchive.block_entry.size))
+            block_addresses = set(struct.unpack('<%dH' % address_count, f.read(2 * address_count)))
+            blocks.append((offset, n, btmin, btmax, block_addresses))
+        return (count, tmin, tmax), blocks
+
+    @staticmethod
+    def read_block(f, offset, n):
+        """Read columns (times, addresses, types, commands, values) of one block."""
+        f.seek(offset)
+        data = f.read(n * (12 + LogArchive.VALUE_WIDTH))
+        times = LogArchive._column('q', data[0:8 * n])
+        addresses = LogArchive._column('H', data[8 * n:10 * n])
+        types = data[10 * n:11 * n]
+        commands = data[11 * n:12 * n]
+        values = data[12 * n:]
+        return times, addresses, types, commands, values
+
+    @staticmethod
+    def query(path, addresses=None, start=None, end=None):
+        """
+        Iterate over messages in the archive at path, optionally filtered.
+
+        :param addresses: collection of addresses as hex strings (e.g. '6004'), None for all
+        :param start: datetime, only messages at this time or later are returned
+        :param end: datetime, only messages before this time are returned
+        """
+        wanted = None if addresses is None else set(int(a, 16) for a in addresses)
+        tstart = None if start is None else LogArchive.to_int(start)
+        tend = None if end is None else LogArchive.to_int(end)
+        width = LogArchive.VALUE_WIDTH
+        with open(path, 'rb') as f:
+            (count, tmin, tmax), blocks = LogArchive.read_index(f)
+            if count == 0 or (tstart is not None and tmax < tstart) or (tend is not None and tmin >= tend):
+                return
+            for offset, n, btmin, btmax, block_addresses in blocks:
+                if (tstart is not None and btmax < tstart) or (tend is not None and btmin >= tend):
+                    continue
+                if wanted is not None and wanted.isdisjoint(block_addresses):
+                    continue
+                times, addrs, types, commands, values = LogArchive.read_block(f, offset, n)
+                for i in range(n):
+                    t = times[i]
+                    if (tstart is not None and t < tstart) or (tend is not None and t >= tend):
+                        continue
+                    if wanted is not None and addrs[i] not in wanted:
+                        continue
+                    yield FhtMessage(
+                        '{:04X}'.format(addrs[i]),
+                        '{:02X}'.format(types[i]),
+                        '{:02X}'.format(commands[i]),
+                        values[i * width:(i + 1) * width].rstrip(b'\0').decode('ascii'),
+                        LogArchive.to_datetime(t))
+
+    @staticmethod
+    def read_columns(path, addresses=None, start=None, end=None):
+        """
+        Read the archive at path as columns, optionally filtered like in query.
+
+        Returns dictionary with columns 'time' (microseconds), 'address', 'msg_type' and 'command'
+        as arrays of integers and 'value' as list of hex strings, suitable for
+        FhtAnalyzer.AnalyzeMessages, and 'scanned', the number of messages in the blocks that
+        were read (the blocks outside of the filter are skipped by the index).
+        """
+        columns = {
+            'time': array('q'),
+            'address': array('H'),
+            'msg_type': array('B'),
+            'command': array('B'),
+            'value': [],
+            'scanned': 0
+        }
+        wanted = None if addresses is None else set(int(a, 16) for a in addresses)
+        tstart = None if start is None else LogArchive.to_int(start)
+        tend = None if end is None else LogArchive.to_int(end)
+        width = LogArchive.VALUE_WIDTH
+        with open(path, 'rb') as f:
+            _, blocks = LogArchive.read_index(f)
+            for offset, n, btmin, btmax, block_addresses in blocks:
+                if (tstart is not None and btmax < tstart) or (tend is not None and btmin >= tend):
+                    continue
+                if wanted is not None and wanted.isdisjoint(block_addresses):
+                    continue
+                times, addrs, types, commands, values = LogArchive.read_block(f, offset, n)
+                columns['scanned'] += n
+                values = values.decode('ascii')
+                values = [values[i:i + width].rstrip('\0') for i in range(0, n * width, width)]
+                if wanted is None and (tstart is None or btmin >= tstart) and (tend is None or btmax < tend):
+                    columns['time'] += times
+                    columns['address'] += addrs
+                    columns['msg_type'].frombytes(types)
+                    columns['command'].frombytes(commands)
+                    columns['value'] += values
+                    continue
+                for i in range(n):
+                    t = times[i]
+                    if (tstart is not None and t < tstart) or (tend is not None and t >= tend):
+                        continue
+                    if wanted is not None and addrs[i] not in wanted:
+                        continue
+                    columns['time'].append(t)
+                    columns['address'].append(addrs[i])
+                    columns['msg_type'].append(types[i])
+                    columns['command'].append(commands[i])
+                    columns['value'].append(values[i])
+        return columns
+
+    @staticmethod
+    def read(path):
+        """Iterate over all messages in the archive at path."""
+        return LogArchive.query(path)
+
+    @staticmethod
+    def compact(data_dir='../data', remove=False):
+        """
+        Compact all closed rotations of the message log in data_dir.
+
+        The log of the current rotation is still being written by the listener, so it is left
+        alone. Logs that already have an archive newer than themselves are skipped. If remove is
+        True, the text log is deleted after all its messages were archived.
+        Returns the list of archives that were written.
+        """
+        current = 'fht_message_log%s.txt' % FhtMessage.rotation_name(datetime.datetime.now())
+        written = []
+        for name in sorted(os.listdir(data_dir)):
+            if len(name) != 29 or name[0:15] != 'fht_message_log' or name == current:
+                continue
+            path = os.path.join(data_dir, name)
+            archive = LogArchive.archive_name(path)
+            if os.path.exists(archive) and os.path.getmtime(archive) >= os.path.getmtime(path):
+                continue
+            count, skipped = LogArchive.write(archive, FhtMessage.read_log(path))
+            logger.info("Archived %s: %d messages, %d skipped", name, count, skipped)
+            written.append(archive)
+            if remove and skipped == 0:
+                os.remove(path)
+        return written
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for a in LogArchive.compact(remove='--remove' in sys.argv):
+        print(a)
@@ -0,0 +1,218 @@
+#! /usr/bin/python
+"""
+Streaming reader of the text message logs.
+
+The reader never loads a whole log into memory: it goes through the log line by line and yields
+LogRecord objects, which only keep the line and slice the fields out of it when asked. The time
+is kept as the ISO string from the log and is converted to datetime only on demand; ISO strings
+of the same format compare in the same order as the times, so filtering by time does not need
+the conversion at all.
+"""
+
+import os
+import os.path
+import time
+import logging
+import datetime
+from message import FhtMessage
+from log_archive import LogArchive
+
+logger = logging.getLogger(__name__)
+
+
+class LogRecord:
+    """One line of the message log, parsed lazily."""
+
+    __slots__ = ('line',)
+
+    def __init__(self, line):
+        """Wrap the stripped line of the message log, use LogRecord.parse to validate it first."""
+        self.line = line
+
+    @classmethod
+    def parse(cls, line):
+        """Return LogRecord for the line, or None if the line is not a message (as in FhtMessage.read)."""
+        line = line.strip()
+        if len(line) > 40:
+            return cls(line)
+        return None
+
+    @property
+    def time_str(self):
+        return self.line[1:27]
+
+    @property
+    def time(self):
+        return datetime.datetime.fromisoformat(self.line[1:27])
+
+    @property
+    def address(self):
+        return self.line[29:33]
+
+    @property
+    def msg_type(self):
+        return self.line[34:36]
+
+    @property
+    def command(self):
+        return self.line[37:39]
+
+    @property
+    def value(self):
+        return self.line[40:]
+
+    def to_message(self):
+        """Return the full FhtMessage for this record."""
+        return FhtMessage(self.address, self.msg_type, self.command, self.value, self.time)
+
+    def __str__(self):
+        return self.line
+
+
+class LogReader:
+    """Static class with generators over the message logs."""
+
+    poll_interval = 1.0
+
+    @staticmethod
+    def _time_key(t):
+        """Convert datetime or ISO string to the key the records are compared with."""
+        if isinstance(t, datetime.datetime):
+            return t.isoformat()
+        return t
+
+    @staticmethod
+    def seek_time(f, since):
+        """
+        Move the binary file f to the first line with time not earlier than since.
+
+        Messages are appended to the log as they come, so the lines are ordered by time and we
+        can bisect the file by byte offsets, reading only a few lines around each probe.
+        """
+        since = LogReader._time_key(since)
+        f.seek(0, os.SEEK_END)
+        lo, hi = 0, f.tell()
+        # invariant: the first line starting at or after lo that is not earlier than since
+        # starts before or at hi
+        while hi - lo > 256:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()
+            record = None
+            while record is None and f.tell() < hi:
+                record = LogRecord.parse(f.readline().decode('ascii', 'replace'))
+            if record is None or record.time_str >= since:
+                hi = mid
+            else:
+                lo = mid
+        f.seek(lo)
+        if lo > 0:
+            f.readline()
+        while True:
+            pos = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            record = LogRecord.parse(line.decode('ascii', 'replace'))
+            if record is not None and record.time_str >= since:
+                f.seek(pos)
+                break
+
+    @staticmethod
+    def records(path, since=None, until=None):
+        """
+        Iterate over the records of the text log at path.
+
+        :param since: datetime or ISO string, skip records earlier than this (by seeking)
+        :param until: datetime or ISO string, stop at the first record not earlier than this
+        """
+        until = None if until is None else LogReader._time_key(until)
+        with open(path, 'rb') as f:
+            if since is not None:
+                LogReader.seek_time(f, since)
+            for line in f:
+                record = LogRecord.parse(line.decode('ascii', 'replace'))
+                if record is None:
+                    continue
+                if until is not None and record.time_str >= until:
+                    return
+                yield record
+
+    @staticmethod
+    def current_log(data_dir='../data'):
+        """Return path of the log the listener is writing to now."""
+        name = 'fht_message_log%s.txt' % FhtMessage.rotation_name(datetime.datetime.now())
+        return os.path.join(data_dir, name)
+
+    @staticmethod
+    def tail(data_dir='../data', since=None):
+        """
+        Iterate over the messages (FhtMessage) of all logs from since until now.
+
+        Goes through the logs of the rotations from the one containing since to the current one,
+        skipping the missing ones; without since only the current log is read. The compacted
+        archive is read if the text log was removed.
+        """
+        now = datetime.datetime.now()
+        if since is None or isinstance(since, str):
+            since = now if since is None else datetime.datetime.fromisoformat(since)
+        rotation = since.replace(hour=since.hour // 4 * 4, minute=0, second=0, microsecond=0)
+        while rotation <= now:
+            path = os.path.join(data_dir, 'fht_message_log%s.txt' % FhtMessage.rotation_name(rotation))
+            if os.path.exists(path):
+                for record in LogReader.records(path, since if rotation < since else None):
+                    yield record.to_message()
+            elif os.path.exists(LogArchive.archive_name(path)):
+                yield from LogArchive.query(LogArchive.archive_name(path), None, since)
+            rotation += datetime.timedelta(hours=4)
+
+    @staticmethod
+    def follow(data_dir='../data', since=None):
+        """
+        Iterate over records of the current log, waiting for new ones as they are written.
+
+        Starts at the end of the current log, or at the first record not earlier than since.
+        When the listener rotates the log, the reader finishes the old log and continues with the
+        new one. Incomplete last line is kept until the rest of it is written. Never returns.
+        """
+        path = LogReader.current_log(data_dir)
+        f = None
+        pending = b''
+        while True:
+            if f is None:
+                if not os.path.exists(path):
+                    time.sleep(LogReader.poll_interval)
+                    path = LogReader.current_log(data_dir)
+                    continue
+                f = open(path, 'rb')
+                if since is not None:
+                    LogReader.seek_time(f, since)
+                else:
+                    f.seek(0, os.SEEK_END)
+                logger.info("Following %s", path)
+            line = f.readline()
+            if line:
+                pending += line
+                if not pending.endswith(b'\n'):
+                    continue
+                record = LogRecord.parse(pending.decode('ascii', 'replace'))
+                pending = b''
+                if record is not None:
+                    yield record
+                continue
+            new_path = LogReader.current_log(data_dir)
+            if new_path != path and os.path.exists(new_path):
+                # the old log is complete, everything in the new one is newer
+                f.close()
+                f = None
+                path = new_path
+                since = ''
+                pending = b''
+                continue
+            time.sleep(LogReader.poll_interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for r in LogReader.follow():
+        print(r)
@@ -0,0 +1,150 @@
+#! /usr/bin/python
+"""
+Buffered writer of the message log.
+
+The listener used to write and flush every message on its own, which on an SD card means a
+write to the card for every radio frame. LogWriter keeps the lines in memory and writes them
+as one group when
+
+- flush_size bytes are buffered,
+- flush_interval seconds pass (a background thread writes the buffer, so a line is written
+  even if no other message follows), or
+- the log is rotated or closed.
+
+A crash of the process therefore loses at most the last flush_interval seconds of messages;
+with fsync the written groups are also forced to the card, so they survive a power cut. A group
+that cannot be written (e.g. the card is full) is dropped and counted, so that the buffer does
+not grow without bounds, and the writer goes on with the next one.
+
+The log is rotated every four hours (see FhtMessage.rotation_name); the time of the next
+rotation is computed when the log is opened, so the writer only compares timestamps per
+message. With compress the closed rotations are compacted by LogArchive in the background and
+the text logs removed.
+"""
+
+import os
+import os.path
+import time
+import logging
+import datetime
+import threading
+from message import FhtMessage
+from log_archive import LogArchive
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    """Writes messages to the rotated message logs in groups."""
+
+    flush_interval = 1.0
+    flush_size = 16384
+
+    def __init__(self, log_dir, fsync=False, compress=False):
+        """
+        Open the log of the current rotation in log_dir and start the flushing thread.
+
+        :param fsync: force every written group to the disk
+        :param compress: compact the closed rotations, see LogArchive.compact
+        """
+        self.log_dir = log_dir
+        self.fsync = fsync
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.file = None
+        self.name = None
+        self.next_rotation = 0.0
+        self.groups = 0
+        self.lines = 0
+        # lines of the groups that could not be written, and the error of the last such group
+        self.dropped = 0
+        self.error = None
+        self.rotate(time.time())
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically, name='log_writer', daemon=True)
+        self.flusher.start()
+
+    def rotate(self, now):
+        """Close the current log and open the one of the rotation containing now (seconds since epoch)."""
+        d = datetime.datetime.fromtimestamp(now)
+        start = d.replace(hour=d.hour // 4 * 4, minute=0, second=0, microsecond=0)
+        self.next_rotation = (start + datetime.timedelta(hours=4)).timestamp()
+        name = 'fht_message_log%s.txt' % FhtMessage.rotation_name(d)
+        if name == self.name:
+            return
+        closed = self.file
+        if closed is not None:
+            self.write_buffer()
+            closed.close()
+        self.name = name
+        self.file = open(os.path.join(self.log_dir, name), 'a')
+        if closed is not None and self.compress:
+            threading.Thread(target=self.compact, name='compact_logs', daemon=True).start()
+
+    def compact(self):
+        try:
+            for archive in LogArchive.compact(self.log_dir, remove=True):
+                logger.info("Log compacted to %s", archive)
+        except Exception:
+            logger.exception("Compacting of the logs failed")
+
+    def write(self, msg: FhtMessage):
+        """Add the message to the buffer, write the buffer if it is full."""
+        now = time.time()
+        line = msg.line()
+        with self.lock:
+            if now >= self.next_rotation:
+                self.rotate(now)
+            self.buffer.append(line)
+            self.buffered += len(line)
+            if self.buffered >= LogWriter.flush_size:
+                self.write_buffer()
+
+    def write_buffer(self):
+        """Write the buffered lines as one group, or drop them if that fails; needs the lock."""
+        if not self.buffer:
+            return
+        try:
+            self.file.write(''.join(self.buffer))
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+        except OSError as e:
+            # logged once until a group is written again, the disk may stay full for a while
+            if self.error is None:
+                logger.error("Message log %s cannot be written, dropping the lines: %s", self.name, e)
+            self.error = e
+            self.dropped += len(self.buffer)
+        else:
+            if self.error is not None:
+                logger.warning("Message log %s written again, %d lines dropped so far", self.name, self.dropped)
+                self.error = None
+            self.groups += 1
+            self.lines += len(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+    def flush(self):
+        """Write everything that is buffered."""
+        with self.lock:
+            self.write_buffer()
+
+    def flush_periodically(self):
+        """Write the buffer every flush_interval, until closed."""
+        while not self.closed.wait(LogWriter.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # the thread must go on, or the buffer would only be written when full
+                logger.exception("Flushing of the message log failed")
+
+    def close(self):
+        """Write the rest of the buffer and close the log."""
+        self.closed.set()
+        with self.lock:
+            self.write_buffer()
+            self.file.close()
+        logger.info("Message log closed, %d lines written in %d groups, %d dropped", self.lines, self.groups,
+                    self.dropped)
@@ -9,78 +9,239 @@ The overall architecture:
                 interprets and send the data to the HttpServer that will allow it to constructs JSON to be
                 sent to the web page
 - HttpServer: runs webserver on port 80, gets information from Dispatcher
+By default each of them runs in its own process. In the single-process mode (--single-process)
+the listener runs in the main thread and passes the messages to the Dispatcher, which applies
+them to the state of the HttpServer directly; the server serves requests from its threads. That
+saves the memory of two interpreters and the two hops between processes on a small machine.
 """
 
 import os
 import sys
 import logging
 import time
+import argparse
+import threading
+import datetime
 from multiprocessing import Process, Queue
 from fht_listener import FhtListener
+from frame_source import SerialSource, PtySource, ReplaySource, MultiSource
 from fht_analyzer import FhtAnalyzer
+from dedup import RepeatFilter
 from http_server import HttpServer
+from batch_queue import BatchReader, BatchWriter
+from log_reader import LogReader
 from message import FhtMessage, HttpMessage, PayloadErrors, RoomIds
+from metrics import Counter, register_process, stage_latency
 
 
 class Dispatcher(Process):
     """The main hub that translates messages from listner to server."""
 
-    def __init__(self):
-        """Init the instance variables, read the room ids."""
+    # the state of the HTTP server is saved here in log_dir, see HttpServer.save_state
+    STATE_FILE = 'fht_state.json.gz'
+    # at start, messages logged since the state was saved are replayed, but at most this far back
+    warm_window = datetime.timedelta(hours=4)
+    messages = Counter('fht_messages_total', "Messages analyzed by type", 'type',
+                       sorted(set(FhtAnalyzer.message_types.values())) + ['unknown'])
+
+    def __init__(self, source=None, http_port=None, log_dir="../data", room_ids=None, single_process=False,
+                 repeat_window=None, log_fsync=False, compress_logs=False):
+        """
+        Init the instance variables, read the room ids.
+
+        :param source: source of frames for FhtListener, SerialSource by default
+        :param http_port: port of the HttpServer, HttpServer.serverPort by default
+        :param log_dir: directory for the message logs and the saved state, None to not write
+                        them (and to start with empty state)
+        :param room_ids: RoomIds to use, read from ../data by default; they are reloaded when
+                         the file is modified, see RoomIds.check
+        :param single_process: run the listener and the HTTP server in this process
+        :param repeat_window: window of the listener for suppressing repeated messages, see RepeatFilter
+        :param log_fsync: force the message log to the disk, see LogWriter
+        :param compress_logs: compact the closed rotations of the message log, see LogWriter
+        """
         Process.__init__(self)
         self.listener_queue = None
         self.http_queue = None
-        self.roomIds = RoomIds()
+        self.source = source
+        self.http_port = http_port
+        self.log_dir = log_dir
+        self.state_path = None if log_dir is None else os.path.join(log_dir, Dispatcher.STATE_FILE)
+        self.roomIds = RoomIds() if room_ids is None else room_ids
+        self.single_process = single_process
+        self.repeat_window = repeat_window
+        self.log_fsync = log_fsync
+        self.compress_logs = compress_logs
+        self.http_server = None
+        self.pending = []
+        # time.monotonic_ns when the oldest pending message was received
+        self.oldest = 0
 
     def start(self):
         """
         Start the main loop of the application.
 
-        Create instance of FhtListener and HttpServer and start them. Listen on the queue
-        from the Listener and when receive the message, parse it and send the result to server.
+        In the single-process mode see start_single. Otherwise create instance of FhtListener
+        and HttpServer and start them. Listen on the queue
+        from the Listener and when receive a batch of messages, parse them and send the results
+        to server, again as one batch (see batch_queue).
         """
-        self.listener_queue = Queue()
-        listener = FhtListener(self.listener_queue)
-        self.http_queue = Queue()
-        http_server = HttpServer(self.http_queue)
-        listener.start()
+        register_process('dispatcher')
+        if self.single_process:
+            self.start_single()
+            return
+        queue = Queue()
+        listener = FhtListener(BatchWriter(queue, FhtMessage.to_tuple, 'listener->dispatcher'), self.source,
+                               self.log_dir, self.repeat_window, self.log_fsync, self.compress_logs)
+        self.listener_queue = BatchReader(queue, FhtMessage.from_tuple, 'listener->dispatcher')
+        queue = Queue()
+        http_server = HttpServer(queue, self.http_port, self.state_path)
+        self.http_queue = BatchWriter(queue, HttpMessage.to_tuple, 'dispatcher->http')
         http_server.start()
+        # the server restores the saved state before it takes the replayed messages
+        for msg in self.replay_tail():
+            self.http_queue.put(msg)
+        self.http_queue.flush()
+        listener.start()
 
         while True:
-            msg: FhtMessage = self.listener_queue.get()
-            logger.debug("FHT message received")
-            # process the message and create a message for http server
+            batch = self.listener_queue.get()
+            logger.debug("%d FHT messages received", len(batch))
+            self.roomIds.check()
+            # process the messages and create messages for http server
+            for msg in batch:
+                self.http_queue.put(self.analyze_msg(msg))
+            stage_latency.observe((time.monotonic_ns() - self.listener_queue.oldest) / 1e9, 'analyzed')
+            self.http_queue.flush()
+
+    def start_single(self):
+        """
+        Run the listener, the dispatcher and the HTTP server in this process.
+
+        The HTTP server serves the requests from its threads, the listener runs in this thread
+        and puts the messages to the dispatcher (see put and flush). When the source of frames
+        is exhausted (a replay), the server keeps serving.
+        """
+        self.http_server = HttpServer(None, self.http_port, self.state_path)
+        self.http_server.open()
+        self.http_server.apply_batch(list(self.replay_tail()))
+        http_thread = threading.Thread(target=self.http_server.serve, name='http_server', daemon=True)
+        http_thread.start()
+        listener = FhtListener(self, self.source, self.log_dir, self.repeat_window, self.log_fsync,
+                               self.compress_logs)
+        try:
+            listener.run()
+            http_thread.join()
+        finally:
+            # also when terminated (see HttpServer.terminated), the server saves the state
+            self.http_server.shutdown()
+            http_thread.join()
+
+    def replay_tail(self):
+        """
+        Iterate over messages for the HTTP server from the logs written since the state was saved.
+
+        The state is saved periodically, so the messages received between the last save and the
+        restart are replayed from the logs, with their original times. The time of the save is
+        taken from the saved state, not from the file, which may have been copied or touched.
+        Without the saved state the last warm_window of the logs is replayed.
+        """
+        if self.log_dir is None:
+            return
+        since = datetime.datetime.now() - Dispatcher.warm_window
+        saved = HttpServer.read_state(self.state_path)
+        if saved is not None:
+            since = max(since, datetime.datetime.fromtimestamp(saved['saved']))
+        started = time.perf_counter()
+        count = 0
+        for msg in LogReader.tail(self.log_dir, since):
             http_msg = self.analyze_msg(msg)
-            self.http_queue.put(http_msg)
+            http_msg.time = msg.time.timestamp()
+            count += 1
+            yield http_msg
+        logger.warning("%d messages since %s replayed in %.3f s", count, since.isoformat(),
+                       time.perf_counter() - started)
+
+    def put(self, msg: FhtMessage):
+        """Analyze the message from the listener running in this process, see flush."""
+        if not self.pending:
+            self.oldest = time.monotonic_ns()
+            self.roomIds.check()
+        self.pending.append(self.analyze_msg(msg))
+
+    def flush(self):
+        """Apply the messages analyzed since the last flush to the state of the HTTP server."""
+        if self.pending:
+            analyzed = time.monotonic_ns()
+            stage_latency.observe((analyzed - self.oldest) / 1e9, 'analyzed')
+            self.http_server.apply_batch(self.pending, analyzed)
+            self.pending = []
 
     def analyze_msg(self, msg):
         """
         Analyze the FHT message, produce message for HTTP server.
 
-        FhtAnalyzer returns a dictionary that we want to send to the HTTP server.
+        FhtAnalyzer returns a Payload that we want to send to the HTTP server.
         We only check it for errors and set the error flags
         """
         error = PayloadErrors.OK
         payload = FhtAnalyzer.AnalyzeMessage(msg)
-        address = msg.address.upper()
-        room = address
-        if address not in self.roomIds:
-            logger.error("Unknown room %s", address)
+        room = self.roomIds.get(msg.address)
+        if room is None:
+            room = msg.address.upper()
+            FhtAnalyzer.LogUnknown("room", room)
             error |= PayloadErrors.NEW_ROOM
-        else:
-            room = self.roomIds[address]
-        if payload["type"] == 'unknown':
+        if payload.type == 'unknown':
             error |= PayloadErrors.NEW_TYPE
-        if payload["command"] == 'unknown':
+        if payload.command == 'unknown':
             error |= PayloadErrors.NEW_COMMAND
-        if payload["warning"] == 'unknown':
+        if payload.warning == 'unknown':
             error |= PayloadErrors.NEW_WARNING
+        Dispatcher.messages.inc(1, payload.type)
         return HttpMessage(room, error, payload)
 
 
+def parse_args(argv=None):
+    """Parse the command line, return the arguments and the frame source they select."""
+    parser = argparse.ArgumentParser(description="FHT state reporter.")
+    parser.add_argument('--device', action='append',
+                        help="read frames from this device (e.g. a pty) instead of the CUL (can be repeated)")
+    parser.add_argument('--receiver', action='append', metavar='PORT',
+                        help="read frames from the CUL on this serial port (can be repeated), see MultiSource")
+    parser.add_argument('--rssi', action='store_true',
+                        help="the receivers report the signal strength of the frames (CUL X21)")
+    parser.add_argument('--replay', nargs='+', metavar='LOG', help="replay frames from these message logs")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay speed, 1 for original timing, 0 for as fast as possible")
+    parser.add_argument('--http-port', type=int, help="port of the HTTP server")
+    parser.add_argument('--single-process', action='store_true',
+                        help="run the listener and the HTTP server in one process")
+    parser.add_argument('--log-fsync', action='store_true',
+                        help="force every group of lines written to the message log to the disk")
+    parser.add_argument('--compress-logs', action='store_true',
+                        help="compact the closed rotations of the message log (see log_archive)")
+    parser.add_argument('--repeat-window', type=float, default=RepeatFilter.window,
+                        help="suppress repetitions of a message within this many seconds, 0 to keep them")
+    args = parser.parse_args(argv)
+    if args.replay:
+        source = ReplaySource([os.path.abspath(log) for log in args.replay], args.speed)
+        # the window is in the time of the replay
+        args.repeat_window = args.repeat_window / args.speed if args.speed else 0
+    elif args.device or args.receiver:
+        # the enable pin is only on the board on the port of the Raspberry Pi
+        sources = [SerialSource(port, 17 if port == '/dev/ttyAMA0' else None, rssi=args.rssi)
+                   for port in args.receiver or []]
+        sources += [PtySource(os.path.abspath(device), rssi=args.rssi) for device in args.device or []]
+        source = sources[0] if len(sources) == 1 else MultiSource(sources)
+    else:
+        source = SerialSource(rssi=args.rssi)
+    return args, source
+
+
 logger = logging.getLogger(__name__)
 if __name__ == "__main__":
-    os.chdir(os.path.dirname(__file__))
+    args, source = parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s: %(message)s',
                     filename='../data/main.log', level=logging.INFO)
     logger.error("====================== START ===========================")
@@ -91,6 +252,9 @@ if __name__ == "__main__":
     sys.stdout = fout
     sys.stderr = ferr
     print('Starting')
-    dispatcher = Dispatcher()
+    # replayed messages are already in the message logs
+    dispatcher = Dispatcher(source, args.http_port, None if args.replay else "../data",
+                            single_process=args.single_process, repeat_window=args.repeat_window,
+                            log_fsync=args.log_fsync, compress_logs=args.compress_logs)
     dispatcher.start()
     # os.system("sudo shutdown -h now")
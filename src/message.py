@@ -1,11 +1,19 @@
 #! /usr/bin/python
 """Module for messages that are exchanged between processes."""
+import os
+import time
+import logging
 import datetime
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
 
 
 class FhtMessage:
     """Class for sending data from FHT listener to Dispatcher."""
 
+    __slots__ = ('address', 'msg_type', 'command', 'value', 'time')
+
     def __init__(self, address, msg_type, command, value, time=None):
         """Constructor, initialize instance variables."""
         self.address = address
@@ -17,11 +25,29 @@ class FhtMessage:
         else:
             self.time = time
 
+    def line(self):
+        """Return the line of the message log for the message."""
+        return "[%s] %s %s %s %s\n" % (self.time, self.address, self.msg_type, self.command, self.value)
+
     def write(self, fout):
         """Write the message into file-like output."""
-        fout.write("[%s] %s %s %s %s\n" % (self.time, self.address, self.msg_type, self.command, self.value))
+        fout.write(self.line())
         fout.flush()
 
+    def to_tuple(self):
+        """Return the compact form of the message sent between processes, see from_tuple."""
+        return self.address, self.msg_type, self.command, self.value, self.time
+
+    @classmethod
+    def from_tuple(cls, t):
+        """Reconstruct the message from its compact form returned by to_tuple."""
+        return cls(*t)
+
+    @staticmethod
+    def rotation_name(d):
+        """Return the suffix of the message log rotated every four hours that contains time d."""
+        return "{:04}{:02}{:02}-{:01}".format(d.year, d.month, d.day, d.hour // 4)
+
     def __str__(self):
         return "Msg address: %s, type: %s, command: %s, value: %s" % (self.address, self.msg_type, self.command, self.value)
 
@@ -38,16 +64,79 @@ class FhtMessage:
         else:
             return None
 
+    @classmethod
+    def read_log(cls, path):
+        """
+        Iterate over all messages stored in the message log at path.
+
+        The log can either be the text log written by the listener or its compacted
+        version created by LogArchive, the format is chosen by the file suffix.
+        """
+        from log_archive import LogArchive
+        if path.endswith(LogArchive.SUFFIX):
+            yield from LogArchive.read(path)
+            return
+        with open(path, 'r') as logf:
+            for l in logf:
+                msg = cls.read(l)
+                if msg is not None:
+                    yield msg
+
+
+class Payload(namedtuple('Payload', ('type', 'value', 'warning', 'command', 'flags'))):
+    """
+    Immutable result of FhtAnalyzer.AnalyzeMessage: (type, value, warning, command, flags).
+
+    The fields can be read as attributes, or by their names as from the dictionary that was
+    the result before: payload['type'] is payload.type. Attributes and unpacking are faster.
+    The flags are a tuple shared by all payloads with the same flags.
+    """
+
+    __slots__ = ()
+    index = {name: i for i, name in enumerate(('type', 'value', 'warning', 'command', 'flags'))}
+
+    def __getitem__(self, key):
+        if key.__class__ is str:
+            key = Payload.index[key]
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self)
 
 
 class HttpMessage:
     """Class for sending info to HTTP server."""
 
-    def __init__(self, room, error, payload):
-        """Constructor, initialize instance variables."""
+    __slots__ = ('room', 'error', 'payload', 'time')
+
+    def __init__(self, room, error, payload, time=None):
+        """
+        Constructor, initialize instance variables.
+
+        The payload is the Payload from FhtAnalyzer. The time (seconds since epoch) is only set
+        for messages replayed from the logs, the server uses the time of receiving the message
+        otherwise.
+        """
         self.room = room
         self.error = error
         self.payload = payload
+        self.time = time
+
+    def to_tuple(self):
+        """
+        Return the compact form of the message sent between processes, see from_tuple.
+
+        The Payload is flattened into the tuple.
+        """
+        return (self.room, self.error) + tuple(self.payload) + (self.time,)
+
+    @classmethod
+    def from_tuple(cls, t):
+        """Reconstruct the message from its compact form returned by to_tuple."""
+        return cls(t[0], t[1], Payload._make(t[2:7]), t[7])
 
 
 class PayloadErrors:
@@ -61,17 +150,77 @@ class PayloadErrors:
 
 
 class RoomIds:
+    """
+    Names of the rooms by the addresses of their FHT devices, read from known_ids.txt.
+
+    The file has a [room name] line followed by the addresses of the devices in the room, each
+    as two decimal numbers of two digits. The addresses are kept in hex as the listener reports
+    them: ids maps the address in upper case to the room, rooms maps the room to the list of its
+    addresses, and get looks up an address in any case.
+
+    check() reloads the file when it was modified (at most once per check_interval seconds), so
+    that a new device is known without a restart. The new tables replace the old ones at once
+    when the whole file is read; if it cannot be read, the old ones are kept.
+    """
+
+    check_interval = 2.0
 
-    def __init__(self):
+    def __init__(self, path='../data/known_ids.txt'):
+        self.path = path
         self.ids = {}
-        idsf = open('../data/known_ids.txt', 'r')
-        for l in idsf.readlines():
+        self.rooms = {}
+        self.mtime = None
+        self.last_check = time.monotonic()
+        with open(path, 'r') as idsf:
+            self.mtime = os.fstat(idsf.fileno()).st_mtime
+            self.read(idsf)
+
+    def read(self, idsf):
+        """Read the room ids from the open file, line by line, and replace the tables with them."""
+        ids = {}
+        rooms = {}
+        cur_room = None
+        for l in idsf:
             l = l.strip()
+            if not l:
+                continue
             if l[0] == '[':
                 cur_room = l[1:-1]
+                rooms.setdefault(cur_room, [])
             else:
-                h = '{:02x}'.format(int(l[0:2])) + '{:02x}'.format(int(l[2:4]))
-                self.ids[h.upper()] = cur_room
+                h = '{:02X}{:02X}'.format(int(l[0:2]), int(l[2:4]))
+                ids[h] = cur_room
+                rooms[cur_room].append(h)
+        self.ids, self.rooms = ids, rooms
+
+    def check(self):
+        """Reload the file if it was modified since it was read, return True if it was reloaded."""
+        now = time.monotonic()
+        if now - self.last_check < RoomIds.check_interval:
+            return False
+        self.last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return False
+            # if the file is broken, it is not tried again until it is modified again
+            self.mtime = mtime
+            with open(self.path, 'r') as idsf:
+                self.read(idsf)
+        except FileNotFoundError:
+            if self.mtime is not None:
+                logger.error("Room ids in %s were removed, keeping the old ones", self.path)
+                self.mtime = None
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Room ids in %s cannot be reloaded, keeping the old ones: %s", self.path, e)
+            return False
+        logger.warning("Room ids reloaded from %s: %d addresses in %d rooms", self.path, len(self.ids), len(self.rooms))
+        return True
+
+    def get(self, address, default=None):
+        """Return the room of the address (in any case), default if it is not known."""
+        return self.ids.get(address.upper(), default)
 
     def __getitem__(self, key):
         return self.ids[key]
@@ -0,0 +1,205 @@
+#! /usr/bin/python
+"""
+Metrics of the pipeline, served by the HTTP server on /metrics in the Prometheus text format.
+
+The listener, the dispatcher and the HTTP server run in their own processes (unless in the
+single-process mode), but only the HTTP server serves the metrics. The values of all metrics
+are therefore kept in one array of doubles in shared memory, allocated when this module is
+imported, before the processes are forked. Every metric gets its fixed slots in the array when
+it is defined, which must also happen before the fork (the metrics are class attributes of the
+classes that update them), and each slot is updated by one process only. Updating a counter or
+a gauge is thus an addition to an item of the array, without locks or messages between the
+processes, and Metrics.render formats the current values on request. Such an update is not
+atomic, so a counter must be updated by one thread of its process; a histogram takes a lock of
+its own in observe, as the request latencies are observed by all threads of the HTTP server.
+
+Values that are not updated by the pipeline, such as the depth of the queues or the memory of
+the processes, are computed by the collectors (see Metrics.collectors) just before rendering.
+"""
+
+import os
+import logging
+import threading
+from bisect import bisect_left
+from multiprocessing.sharedctypes import RawArray
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Registry of the metrics and their values in shared memory."""
+
+    capacity = 1024
+    values = memoryview(RawArray('d', capacity)).cast('B').cast('d')
+    used = 0
+    registry = []
+    # functions called before the metrics are rendered, they update the computed metrics
+    collectors = []
+    # latency buckets in seconds, upper bounds
+    latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    @staticmethod
+    def allocate(metric, count):
+        """Register the metric and return the index of its first of count slots."""
+        if Metrics.used + count > Metrics.capacity:
+            raise ValueError("no room for metric %s" % metric.name)
+        start = Metrics.used
+        Metrics.used += count
+        Metrics.registry.append(metric)
+        return start
+
+    @staticmethod
+    def render():
+        """Return the text of all metrics in the Prometheus exposition format."""
+        for collect in Metrics.collectors:
+            try:
+                collect()
+            except Exception:
+                logger.exception("Metrics collector %s failed", collect)
+        lines = []
+        for metric in Metrics.registry:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            metric.render(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def number(value):
+        return '%d' % value if value == int(value) else repr(value)
+
+
+class Counter:
+    """
+    Number that only grows, optionally split by the value of one label.
+
+    The label values are fixed when the counter is defined, other values are counted under
+    'other', which is rendered only when something was counted there.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None, label_values=()):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.label_values = list(label_values) + ['other'] if label is not None else [None]
+        self.start = Metrics.allocate(self, len(self.label_values) * self.width())
+        self.index = {v: self.start + i * self.width() for i, v in enumerate(self.label_values)}
+        self.other = self.index[self.label_values[-1]]
+
+    def width(self):
+        """Return the number of slots per label value."""
+        return 1
+
+    def slot(self, label_value):
+        return self.start if label_value is None else self.index.get(label_value, self.other)
+
+    def inc(self, n=1, label_value=None):
+        Metrics.values[self.slot(label_value)] += n
+
+    def get(self, label_value=None):
+        return Metrics.values[self.slot(label_value)]
+
+    def labels(self, label_value, extra=''):
+        """Return the label part of a sample, {label="value"} or empty without a label."""
+        labels = [] if label_value is None else ['%s="%s"' % (self.label, label_value)]
+        if extra:
+            labels.append(extra)
+        return '{%s}' % ','.join(labels) if labels else ''
+
+    def rendered_values(self):
+        """Return the label values to render."""
+        if self.label is None or Metrics.values[self.other:self.other + self.width()].tobytes().strip(b'\0'):
+            return self.label_values
+        return self.label_values[:-1]
+
+    def render(self, lines):
+        for label_value in self.rendered_values():
+            lines.append('%s%s %s' % (self.name, self.labels(label_value), Metrics.number(self.get(label_value))))
+
+
+class Gauge(Counter):
+    """Number that goes up and down, see Counter."""
+
+    kind = 'gauge'
+
+    def set(self, value, label_value=None):
+        Metrics.values[self.slot(label_value)] = value
+
+
+class Histogram(Counter):
+    """
+    Distribution of observed values in buckets, see Counter for the label.
+
+    The slots of every label value hold the counts of the buckets (not cumulative, the last
+    one for values over all bounds), the sum and the count of the values. Values can be observed
+    from several threads of a process, see the lock.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None, label_values=(), buckets=Metrics.latency_buckets):
+        self.buckets = buckets
+        # guards the slots against the threads of this process, each process has its own copy
+        self.lock = threading.Lock()
+        Counter.__init__(self, name, help, label, label_values)
+
+    def width(self):
+        return len(self.buckets) + 3
+
+    def observe(self, value, label_value=None):
+        i = self.slot(label_value)
+        bucket = i + bisect_left(self.buckets, value)
+        n = len(self.buckets)
+        values = Metrics.values
+        with self.lock:
+            values[bucket] += 1
+            values[i + n + 1] += value
+            values[i + n + 2] += 1
+
+    def render(self, lines):
+        values = Metrics.values
+        n = len(self.buckets)
+        for label_value in self.rendered_values():
+            i = self.slot(label_value)
+            total = 0
+            for b, bound in enumerate(self.buckets + ('+Inf',)):
+                total += values[i + b]
+                lines.append('%s_bucket%s %d' % (self.name, self.labels(label_value, 'le="%s"' % bound), total))
+            lines.append('%s_sum%s %s' % (self.name, self.labels(label_value), repr(values[i + n + 1])))
+            lines.append('%s_count%s %d' % (self.name, self.labels(label_value), values[i + n + 2]))
+
+
+# a frame is analyzed when the dispatcher analyzed its message, applied when the HTTP server
+# applied the message to the state; see Dispatcher and HttpServer.apply_batch
+stage_latency = Histogram('fht_stage_latency_seconds', "Time from receiving a frame to its analysis, and from "
+                          "the analysis to applying it to the state", 'stage', ('analyzed', 'applied'))
+# the processes of the pipeline, see process_memory
+PROCESSES = ('listener', 'dispatcher', 'http')
+process_ids = Gauge('fht_process_id', "Process id of each part of the pipeline (the same process in the "
+                    "single-process mode)", 'process', PROCESSES)
+process_memory = Gauge('fht_process_resident_memory_bytes', "Resident memory of each part of the pipeline",
+                       'process', PROCESSES)
+
+
+def register_process(role):
+    """Note that the part of the pipeline (one of PROCESSES) runs in this process."""
+    process_ids.set(os.getpid(), role)
+
+
+def collect_memory():
+    page = os.sysconf('SC_PAGE_SIZE')
+    for role in PROCESSES:
+        pid = int(process_ids.get(role))
+        rss = 0
+        if pid:
+            try:
+                with open('/proc/%d/statm' % pid) as f:
+                    rss = int(f.read().split()[1]) * page
+            except (OSError, ValueError, IndexError):
+                pass
+        process_memory.set(rss, role)
+
+
+Metrics.collectors.append(collect_memory)
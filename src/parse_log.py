@@ -1,53 +1,210 @@
 #! /usr/bin/python
+"""
+Command for collecting statistics from the message logs.
+
+Every message log (text log or its compacted archive) is analyzed separately and produces
+partial statistics, which are then merged in the order of the logs. With --jobs the logs are
+distributed among a pool of processes; the result does not depend on the number of jobs.
+Only the logs whose rotation overlaps the requested time range are opened.
+"""
 
 import sys
 import os, os.path
+import time
+import argparse
+import datetime
+from multiprocessing import Pool
 from message import RoomIds, FhtMessage
 from fht_analyzer import FhtAnalyzer
-
-ids = RoomIds()
-
-stats = {
-    'count': 0,
-    'room': {},
-    'type': {},
-    'command': {}
-}
-for i in ids.ids:
-    if ids[i] not in stats['room']:
-        stats['room'][ids[i]] = 0
+from log_archive import LogArchive
+from log_reader import LogReader
 
 interest = {
     'type': ['unknown', 'report1', 'report2'],
     'command': ['unknown']
 }
+names = {
+    'type': FhtAnalyzer.type_names,
+    'command': FhtAnalyzer.command_names
+}
+
+
+def rotation_range(log):
+    """Return the time range (start, end) covered by the rotation of the message log named log."""
+    day = datetime.datetime.strptime(log[15:23], '%Y%m%d')
+    start = day + datetime.timedelta(hours=4 * int(log[24]))
+    return start, start + datetime.timedelta(hours=4)
+
 
-ll = os.listdir('../data')
-logs = [x for x in ll if len(x) == 29 and x[0:15] == 'fht_message_log']
-for log in logs:
-    logf = open(os.path.join('../data', log), 'r')
-    for l in logf.readlines():
-        msg = FhtMessage.read(l)
-        if msg == None:
-            # print("Invalid record: %s in %s", l, log)
+def find_logs(data_dir, start=None, end=None):
+    """
+    List message logs in data_dir that can contain messages from [start, end).
+
+    The compacted archive is preferred to the text log of the same rotation.
+    """
+    ll = os.listdir(data_dir)
+    logs = [x for x in ll if len(x) == 29 and x[0:15] == 'fht_message_log']
+    archives = [x for x in ll if len(x) == 30 and x[0:15] == 'fht_message_log' and x.endswith(LogArchive.SUFFIX)]
+    logs = sorted(archives + [x for x in logs if LogArchive.archive_name(x) not in archives])
+    selected = []
+    for log in logs:
+        log_start, log_end = rotation_range(log)
+        if (start is not None and log_end <= start) or (end is not None and log_start >= end):
             continue
-        if len(msg.value) > 2:
-            print(msg)
-        pmsg = FhtAnalyzer.AnalyzeMessage(msg)
-        stats['count'] += 1
-        if msg.address in ids:
-            room = ids[msg.address]
-            stats['room'][room] += 1
+        selected.append(log)
+    return selected
+
+
+def read_columns(path, addresses=None, start=None, end=None):
+    """
+    Read the message log (text or archive) at path as columns for FhtAnalyzer.AnalyzeMessages.
+
+    Times are left in the form they are stored in (ISO strings or microseconds), message_at
+    converts them when a message is reported. 'scanned' is the number of messages read before
+    they were filtered.
+    """
+    if path.endswith(LogArchive.SUFFIX):
+        columns = LogArchive.read_columns(path, addresses, start, end)
+        columns['address'] = ['{:04X}'.format(a) for a in columns['address']]
+        return columns
+    columns = {'time': [], 'address': [], 'msg_type': [], 'command': [], 'value': [], 'scanned': 0}
+    for record in LogReader.records(path, start, end):
+        columns['scanned'] += 1
+        if addresses is not None and record.address.upper() not in addresses:
+            continue
+        columns['time'].append(record.time_str)
+        columns['address'].append(record.address)
+        columns['msg_type'].append(record.msg_type)
+        columns['command'].append(record.command)
+        columns['value'].append(record.value)
+    return columns
+
+
+def message_at(columns, i):
+    """Construct the FhtMessage from the i-th row of columns."""
+    msg_type = columns['msg_type'][i]
+    command = columns['command'][i]
+    if not isinstance(msg_type, str):
+        msg_type = '{:02X}'.format(msg_type)
+        command = '{:02X}'.format(command)
+    t = columns['time'][i]
+    if isinstance(t, str):
+        t = datetime.datetime.fromisoformat(t)
+    else:
+        t = LogArchive.to_datetime(t)
+    return FhtMessage(columns['address'][i], msg_type, command, columns['value'][i], t)
+
+
+def analyze_log(task):
+    """
+    Compute partial statistics of one message log.
+
+    :param task: tuple (data directory, log name, RoomIds, upper-case addresses or None,
+                 start or None, end or None)
+    Returns dictionary with counts and list of report lines, to be merged by merge_stats.
+    """
+    data_dir, log, ids, addresses, start, end = task
+    columns = read_columns(os.path.join(data_dir, log), addresses, start, end)
+    result = FhtAnalyzer.AnalyzeMessages(columns)
+    stats = {'scanned': columns['scanned'], 'count': len(columns['value']), 'room': {}, 'type': {}, 'command': {}}
+    report = []
+    for i, value in enumerate(columns['value']):
+        if len(value) > 2:
+            report.append(str(message_at(columns, i)))
+    for address in columns['address']:
+        room = ids.get(address)
+        if room is not None:
+            stats['room'][room] = stats['room'].get(room, 0) + 1
         else:
-            print('Unknown address: %s at %s' % (msg.address, log))
-        for k in ['type', 'command']:
-            if pmsg[k] not in stats[k]:
-                stats[k][pmsg[k]] = 0
-            stats[k][pmsg[k]] += 1
-        for k in interest:
-            for kw in interest[k]:
-                if pmsg[k] == kw:
-                    print("Interesting message of field %s with value %s on line %s in file %s" % (k, kw, l, log))
-
-print(stats)
+            report.append('Unknown address: %s at %s' % (address, log))
+    for k in ['type', 'command']:
+        for code, name in enumerate(names[k]):
+            count = result[k].count(code)
+            if count:
+                stats[k][name] = count
+    for k in interest:
+        codes = set(names[k].index(kw) for kw in interest[k])
+        for i, code in enumerate(result[k]):
+            if code in codes:
+                msg = message_at(columns, i)
+                l = "[%s] %s %s %s %s" % (msg.time.isoformat(), msg.address, msg.msg_type, msg.command, msg.value)
+                report.append("Interesting message of field %s with value %s on line %s in file %s" %
+                              (k, names[k][code], l, log))
+    return stats, report
+
+
+def merge_stats(stats, partial):
+    """Add partial statistics of one log to stats."""
+    stats['scanned'] += partial['scanned']
+    stats['count'] += partial['count']
+    for k in ['room', 'type', 'command']:
+        for key, count in partial[k].items():
+            stats[k][key] = stats[k].get(key, 0) + count
+
+
+def parse_time(s):
+    """Parse the time given on command line, either date or date and time in ISO format."""
+    return datetime.datetime.fromisoformat(s)
+
+
+def main(argv=None):
+    """
+    Print the statistics of the messages in the logs, and the messages worth a look.
+
+    The statistics are the counts of the messages by room, type and command, of the messages
+    matching --from, --to and --room. The number of messages scanned (read from the logs before
+    the filtering) and the rate of scanning go to stderr.
+    """
+    parser = argparse.ArgumentParser(description="Collect statistics from the FHT message logs.")
+    parser.add_argument('--data', default='../data', help="directory with the message logs")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="number of processes analyzing the logs, 0 for one per CPU")
+    parser.add_argument('--from', dest='start', type=parse_time, help="only messages from this time on")
+    parser.add_argument('--to', dest='end', type=parse_time, help="only messages before this time")
+    parser.add_argument('--room', action='append', help="only messages of this room (can be repeated)")
+    args = parser.parse_args(argv)
+
+    ids = RoomIds(os.path.join(args.data, 'known_ids.txt'))
+    stats = {
+        'scanned': 0,
+        'count': 0,
+        'room': {},
+        'type': {},
+        'command': {}
+    }
+    for room in ids.rooms:
+        if args.room is None or room in args.room:
+            stats['room'][room] = 0
+    addresses = None
+    if args.room is not None:
+        addresses = set(a for room in args.room for a in ids.rooms.get(room, ()))
+
+    logs = find_logs(args.data, args.start, args.end)
+    tasks = [(args.data, log, ids, addresses, args.start, args.end) for log in logs]
+    started = time.perf_counter()
+    if args.jobs == 1:
+        results = map(analyze_log, tasks)
+        pool = None
+    else:
+        pool = Pool(args.jobs or None)
+        results = pool.imap(analyze_log, tasks)
+    # imap returns the results in the order of tasks, so the output does not depend on scheduling
+    for partial, report in results:
+        for line in report:
+            print(line)
+        merge_stats(stats, partial)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - started
+
+    scanned = stats.pop('scanned')
+    for k in ['room', 'type', 'command']:
+        stats[k] = dict(sorted(stats[k].items()))
+    print(stats)
+    print("%d messages in %d logs scanned in %.2f s, %.0f messages/s, %d matched" %
+          (scanned, len(logs), elapsed, scanned / elapsed if elapsed > 0 else 0, stats['count']), file=sys.stderr)
+
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#! /usr/bin/python
+"""
+Weekly programs of the thermostats.
+
+An FHT thermostat reports its weekly program as 28 separate messages, the from and to times of
+two heating periods for every day of the week (types mon-from1 ... sun-to2), plus the day and
+night temperatures and the mode. The HTTP server keeps only the last few messages of each type,
+so Schedules assembles them per room into the decoded program: every message updates one slot
+of the program of its room in place, and the JSON of all programs is built only when requested
+after a change (and at most once a minute otherwise, as staleness depends on the time).
+
+A program is incomplete until all its messages were received, and stale when one of them was
+last received more than stale_after seconds ago. The raw values are saved with the state of
+the HTTP server, see as_saved and load.
+"""
+
+import logging
+from time import time
+from json import dumps
+
+logger = logging.getLogger(__name__)
+
+
+class RoomSchedule:
+    """Weekly program of one room, decoded as its messages arrive."""
+
+    def __init__(self):
+        self.values = [None] * len(Schedules.types)
+        self.times = [0.0] * len(Schedules.types)
+        self.received = 0
+        self.week = {day: [[None, None], [None, None]] for day in Schedules.DAYS}
+        self.decoded = {'mode': None, 'day-temp': None, 'night-temp': None, 'week': self.week}
+
+    def update(self, i, value, t):
+        """Set the value of the i-th of Schedules.types received at time t."""
+        if self.values[i] is None:
+            self.received += 1
+        self.values[i] = value
+        self.times[i] = t
+        if i < Schedules.SLOTS:
+            day, period, bound = Schedules.positions[i]
+            self.week[day][period][bound] = Schedules.CLOCK[value] if 0 <= value < 256 else 'off'
+        elif Schedules.types[i] == 'mode':
+            self.decoded['mode'] = Schedules.MODES.get(value, value)
+        else:
+            self.decoded[Schedules.types[i]] = value / 2.0
+
+    def as_dict(self, now):
+        """
+        Return the program as dictionary.
+
+        {'mode': 'auto', 'day-temp': 21.0, 'night-temp': 17.0,
+         'week': {'mon': [[from1, to1], [from2, to2]], ...},
+         'complete': bool, 'missing': [types not received yet], 'stale': bool, 'updated': <time>}
+        The times are 'HH:MM', 'off' for an unused period, None if not received yet.
+        """
+        received = [t for v, t in zip(self.values, self.times) if v is not None]
+        result = dict(self.decoded)
+        result['complete'] = self.received == len(Schedules.types)
+        result['missing'] = [name for name, v in zip(Schedules.types, self.values) if v is None]
+        result['stale'] = bool(received) and now - min(received) > Schedules.stale_after
+        result['updated'] = max(received) if received else None
+        return result
+
+
+class Schedules:
+    """Programs of all rooms, fed by HttpServer.update_state."""
+
+    DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+    # the slot types first, in the order of their message types
+    types = tuple('%s-%s' % (day, slot) for day in DAYS for slot in ('from1', 'to1', 'from2', 'to2')) + (
+        'day-temp', 'night-temp', 'mode')
+    SLOTS = 28
+    index = {name: i for i, name in enumerate(types)}
+    MODES = {0: 'auto', 1: 'manual', 2: 'holiday', 3: 'party'}
+    # value of a slot of a period that is not used
+    OFF = 0x90
+    # decoded times of the slots by their values: tens of minutes since midnight as 'HH:MM',
+    # 'off' from OFF on
+    CLOCK = tuple(['%02d:%02d' % divmod(value * 10, 60) for value in range(OFF)] + ['off'] * (256 - OFF))
+    # a program is stale when one of its messages is older than this, in seconds
+    stale_after = 7 * 86400
+    # (day, period, from/to) of the slot types
+    positions = tuple((day, period, bound) for day in DAYS for period in (0, 1) for bound in (0, 1))
+
+    def __init__(self):
+        self.rooms = {}
+        self.version = 0
+        self.cache_key = None
+        self.cache = None
+
+    def add(self, room, msg_type, value, t):
+        """Update the program of the room with the value of the type received at time t."""
+        i = Schedules.index.get(msg_type)
+        if i is None or not isinstance(value, int):
+            return
+        schedule = self.rooms.get(room)
+        if schedule is None:
+            schedule = self.rooms[room] = RoomSchedule()
+        schedule.update(i, value, t)
+        self.version += 1
+
+    def as_dict(self, now=None):
+        """Return {'rooms': {room: program, ...}}, see RoomSchedule.as_dict."""
+        now = time() if now is None else now
+        return {'rooms': {room: s.as_dict(now) for room, s in sorted(self.rooms.items())}}
+
+    def json(self):
+        """Return the programs as JSON (bytes), built again only after a change or a minute."""
+        now = time()
+        key = (self.version, int(now // 60))
+        if key != self.cache_key:
+            self.cache = dumps(self.as_dict(now), separators=(',', ':')).encode('utf-8')
+            self.cache_key = key
+        return self.cache
+
+    def as_saved(self):
+        """Return the raw values for saving, {room: {type: [value, time]}}."""
+        return {room: {name: [v, t] for name, v, t in zip(Schedules.types, s.values, s.times) if v is not None}
+                for room, s in self.rooms.items()}
+
+    def load(self, saved):
+        """Restore the raw values returned by as_saved."""
+        for room, values in saved.items():
+            for name, (value, t) in values.items():
+                self.add(room, name, value, t)
+        logger.info("Weekly programs of %d rooms restored", len(saved))
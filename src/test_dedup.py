@@ -0,0 +1,47 @@
+#! /usr/bin/python
+"""Tests of dedup.py, run with python -m unittest in this directory."""
+
+import unittest
+from message import FhtMessage
+from dedup import RepeatFilter
+
+
+class RepeatFilterTest(unittest.TestCase):
+
+    def test_window(self):
+        f = RepeatFilter(2.0)
+        self.assertFalse(f.is_repeat(FhtMessage('0A01', '00', '26', '2A'), 10.0))
+        # repeated with the flag, relayed without it, lower case
+        self.assertTrue(f.is_repeat(FhtMessage('0A01', '00', 'A6', '2A'), 10.5))
+        self.assertTrue(f.is_repeat(FhtMessage('0A01', '00', '26', '2A'), 11.0))
+        self.assertTrue(f.is_repeat(FhtMessage('0A01', '00', 'a6', '2A'), 11.5))
+        # another value, type or device is another message
+        self.assertFalse(f.is_repeat(FhtMessage('0A01', '00', '26', '2B'), 11.5))
+        self.assertFalse(f.is_repeat(FhtMessage('0A01', '01', '26', '2A'), 11.5))
+        self.assertFalse(f.is_repeat(FhtMessage('0C01', '00', '26', '2A'), 11.5))
+        # the window starts at the message let through, the repetitions do not extend it
+        self.assertFalse(f.is_repeat(FhtMessage('0A01', '00', 'A6', '2A'), 12.0))
+        self.assertEqual((f.passed, f.suppressed), (5, 3))
+        self.assertEqual(f.as_dict(), {'passed': 5, 'suppressed': 3, 'rate': 0.375})
+
+    def test_prune(self):
+        f = RepeatFilter(2.0)
+        for i in range(RepeatFilter.max_seen):
+            f.is_repeat(FhtMessage('0A01', '00', '26', str(i)), 0.0)
+        # full, the old ones are forgotten once, though they are all in the window
+        f.is_repeat(FhtMessage('0C01', '00', '26', '00'), 1.0)
+        self.assertEqual(len(f.seen), RepeatFilter.max_seen + 1)
+        self.assertEqual(f.pruned, 1.0)
+        # not again within the window
+        f.is_repeat(FhtMessage('0C01', '00', '26', '01'), 2.5)
+        self.assertEqual((len(f.seen), f.pruned), (RepeatFilter.max_seen + 2, 1.0))
+        self.assertTrue(f.is_repeat(FhtMessage('0C01', '00', '26', '00'), 2.9))
+        # the messages older than the window are forgotten, the others are still suppressed
+        f.is_repeat(FhtMessage('0C01', '00', '26', '02'), 3.0)
+        self.assertEqual(sorted(f.seen.values()), [2.5, 3.0])
+        self.assertTrue(f.is_repeat(FhtMessage('0C01', '00', '26', '01'), 3.1))
+        self.assertFalse(f.is_repeat(FhtMessage('0A01', '00', '26', '0'), 3.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
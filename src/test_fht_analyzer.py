@@ -0,0 +1,44 @@
+#! /usr/bin/python
+"""Tests of fht_analyzer.py, run with python -m unittest in this directory."""
+
+import unittest
+from message import FhtMessage
+from fht_analyzer import FhtAnalyzer, np
+
+
+class AnalyzeMessagesTest(unittest.TestCase):
+
+    # (type, command, value) as in the text log, malformed ones at the end
+    lines = [(t, c, v) for t in sorted(FhtAnalyzer.message_types) + ['7F']
+             for c in ('26', 'A6', '69', '2F') for v in ('00', '2A', 'ff')] + [
+        ('44', '26', '03'), ('44', '26', '1FF'), ('42', '26', '123'),
+        ('00', 'G6', '10'), ('00', '1', '10'), ('00', '2x', '10'), ('00', '', '10'), ('00', '266', '10'),
+        ('00', '26', 'zz'), ('', '26', '10'), ('xy', '26', '10')]
+
+    def assert_same(self, result, lines):
+        for i, (msg_type, command, value) in enumerate(lines):
+            expected = FhtAnalyzer.AnalyzeMessage(FhtMessage('1234', msg_type, command, value))
+            self.assertEqual(FhtAnalyzer.ResultRow(result, i), expected, (msg_type, command, value))
+
+    def test_strings(self):
+        columns = [list(column) for column in zip(*self.lines)]
+        self.assert_same(FhtAnalyzer.AnalyzeMessages(*columns), self.lines)
+
+    def test_integers(self):
+        # as read from the archives, only well formed messages can be stored there
+        lines = [line for line in self.lines if all(len(c) == 2 for c in line) and 'G6' not in line
+                 and line[1] != '2x' and line[2] != 'zz' and line[0] != 'xy']
+        columns = [[int(c, 16) for c in column] for column in zip(*lines)]
+        self.assert_same(FhtAnalyzer.AnalyzeMessages(*columns), lines)
+        if np is not None:
+            arrays = [np.array(column, dtype=np.uint8) for column in columns]
+            self.assert_same(FhtAnalyzer.AnalyzeMessages(*arrays), lines)
+
+    def test_dict(self):
+        columns = dict(zip(('msg_type', 'command', 'value'), ([c] for c in ('00', 'G6', '10'))))
+        result = FhtAnalyzer.AnalyzeMessages(columns)
+        self.assertEqual(FhtAnalyzer.ResultRow(result, 0).command, 'unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#! /usr/bin/python
+"""Tests of frame_source.py, run with python -m unittest in this directory."""
+
+import unittest
+from frame_source import FrameReader, MultiSource
+
+
+class ChunkPort:
+    """Port returning the chunks one per read, as a serial port returns what arrived."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, n=1):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+def read_all(reader):
+    frames = []
+    while True:
+        received = reader.read_frames()
+        if received is None:
+            return frames
+        frames += received
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    frames = [b'T0A010026A6\r\n', b'T0C01004400\r\n', b'T6004A6692A\r\n']
+
+    def test_chunks(self):
+        data = b''.join(self.frames)
+        # every split, including between \r and \n
+        for size in range(1, len(data) + 1):
+            port = ChunkPort(data[i:i + size] for i in range(0, len(data), size))
+            self.assertEqual(read_all(FrameReader(port)), self.frames, size)
+
+    def test_split_terminator(self):
+        reader = FrameReader(ChunkPort([b'T0A010026A6\r', b'\nT0C01', b'004400\r', b'\n']))
+        self.assertEqual(reader.read_frames(), [])
+        self.assertEqual(reader.read_frames(), self.frames[0:1])
+        self.assertEqual(reader.read_frames(), [])
+        self.assertEqual(reader.read_frames(), self.frames[1:2])
+        self.assertIsNone(reader.read_frames())
+
+    def test_noise(self):
+        noise = bytes(range(32, 127)) * 3
+        chunks = [self.frames[0], noise[:100], noise[100:] + b'\r', b'\n' + self.frames[1], noise + b'\r\n',
+                  self.frames[2]]
+        reader = FrameReader(ChunkPort(chunks), max_frame=64)
+        self.assertEqual(read_all(reader), self.frames)
+        self.assertEqual(reader.dropped, 2)
+        self.assertFalse(reader.discarding)
+        self.assertLessEqual(len(reader.buffer), reader.max_frame)
+
+    def test_rssi(self):
+        port = ChunkPort([b'T0A010026A6' + b'1E\r\n', b'T0C01004400' + b'F0\r\n', b'T6004A6692A' + b'zz\r\n'])
+        reader = FrameReader(port, rssi=True)
+        frames = []
+        rssi_values = []
+        while True:
+            received = reader.read_frames()
+            if received is None:
+                break
+            frames += received
+            rssi_values += reader.rssi_values
+        self.assertEqual(frames, self.frames)
+        self.assertEqual(rssi_values, [-59.0, -82.0, None])
+
+
+class FakeSource:
+    """Source of MultiSource whose frames are passed to merge directly."""
+
+    def __init__(self, device):
+        self.device = device
+        self.reader = None
+
+
+class MultiSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = MultiSource([FakeSource('a'), FakeSource('b')])
+        self.max_seen = MultiSource.max_seen
+
+    def tearDown(self):
+        MultiSource.max_seen = self.max_seen
+
+    def test_merge_window(self):
+        source = self.source
+        frame = FrameReaderTest.frames[0]
+        self.assertEqual(source.merge(0, [frame], 10.0), [frame])
+        # heard by the other receiver later, it is a duplicate
+        self.assertEqual(source.merge(1, [frame], 10.2), [])
+        # sent again by the device, it is left to RepeatFilter
+        self.assertEqual(source.merge(0, [frame], 10.3), [frame])
+        self.assertEqual(source.merge(1, [frame], 10.3 + MultiSource.merge_window), [frame])
+        self.assertEqual(source.merge(1, FrameReaderTest.frames, 11.0), FrameReaderTest.frames)
+        self.assertEqual([(s.frames, s.duplicates) for s in source.stats], [(2, 0), (5, 1)])
+
+    def test_prune(self):
+        MultiSource.max_seen = 4
+        source = self.source
+        frames = [b'T0A0100260%d\r\n' % i for i in range(8)]
+        source.merge(0, frames[0:4], 0.0)
+        # full, the old ones are forgotten once, though they are all in the window
+        source.merge(0, frames[4:5], 0.1)
+        self.assertEqual((len(source.seen), source.pruned), (5, 0.1))
+        source.merge(0, frames[5:6], 0.2)
+        self.assertEqual((len(source.seen), source.pruned), (6, 0.1))
+        self.assertEqual(source.merge(1, frames[0:6], 0.4), [])
+        # the frames older than the window are forgotten, the others are still duplicates
+        source.merge(0, frames[6:7], 0.6)
+        self.assertEqual(sorted(t for t, _ in source.seen.values()), [0.2, 0.6])
+        self.assertEqual(source.merge(1, frames[5:7], 0.65), [])
+        self.assertEqual(source.merge(1, frames[0:1], 0.65), frames[0:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#! /usr/bin/python
+"""Tests of health.py, run with python -m unittest in this directory."""
+
+import os.path
+import datetime
+import tempfile
+import unittest
+from message import RoomIds, FhtMessage
+from health import HealthMonitor, backtest
+
+
+class HealthMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = HealthMonitor()
+        self.monitor.events = []
+
+    def kinds(self):
+        return sorted(kind for _, kind in self.monitor.alerts)
+
+    def test_warnings(self):
+        monitor = self.monitor
+        monitor.add('bad', 'warnings', 1, 'BATT LOW', 100.0)
+        self.assertEqual(monitor.alerts[('bad', 'battery-low')], ['bad', 'battery-low', 100.0, 'BATT LOW'])
+        monitor.add('bad', 'warnings', 0, 'OK', 200.0)
+        self.assertEqual(monitor.alerts, {})
+        self.assertEqual([event for _, event, _ in monitor.events], ['raised', 'cleared'])
+        self.assertEqual(monitor.rooms['bad'].as_dict(300.0)['warning_seconds'], {'BATT LOW': 100})
+
+    def test_silent(self):
+        monitor = self.monitor
+        monitor.add('bad', 'desired-temp', 21.0, 'OK', 100.0)
+        monitor.check(100.0 + HealthMonitor.silent_after - 1)
+        self.assertEqual(monitor.alerts, {})
+        monitor.check(100.0 + HealthMonitor.silent_after)
+        self.assertEqual(monitor.alerts[('bad', 'silent')][2], 100.0)
+        monitor.add('bad', 'desired-temp', 21.0, 'OK', 5000.0)
+        self.assertEqual(monitor.alerts, {})
+
+    def test_window_open(self):
+        monitor = self.monitor
+        monitor.add('bad', 'warnings', 3, 'WINDOW OPEN', 0.0)
+        monitor.check(HealthMonitor.window_after - 1)
+        self.assertEqual(monitor.alerts, {})
+        monitor.check(HealthMonitor.window_after)
+        self.assertEqual(self.kinds(), ['window-open'])
+        monitor.add('bad', 'warnings', 0, 'OK', HealthMonitor.window_after + 60)
+        self.assertEqual(monitor.alerts, {})
+
+    def test_valve_stuck(self):
+        monitor = self.monitor
+        for i in range(HealthMonitor.min_samples):
+            t = 60.0 * i
+            monitor.add('bad', 'desired-temp', 21.0, 'OK', t)
+            monitor.add('bad', 'measured-low', 23.0, 'OK', t)
+            monitor.add('bad', 'measured-high', 0.0, 'OK', t)
+            monitor.add('bad', 'all-valves', 100.0, 'OK', t)
+        self.assertEqual(self.kinds(), ['valve-stuck-open'])
+        for i in range(30):
+            monitor.add('bad', 'all-valves', 0.0, 'OK', 1000.0 + i)
+        self.assertEqual(monitor.alerts, {})
+
+    def test_saved(self):
+        monitor = self.monitor
+        monitor.add('bad', 'warnings', 1, 'BATT LOW', 100.0)
+        monitor.add('kitchen', 'desired-temp', 21.0, 'OK', 100.0)
+        restored = HealthMonitor()
+        restored.load(monitor.as_saved())
+        self.assertEqual(restored.as_dict(200.0), monitor.as_dict(200.0))
+        restored.check(100.0 + HealthMonitor.silent_after)
+        self.assertEqual(sorted(restored.alerts), [('bad', 'battery-low'), ('bad', 'silent'), ('kitchen', 'silent')])
+
+
+class BacktestTest(unittest.TestCase):
+
+    def test_backtest(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(os.path.join(data_dir, 'known_ids.txt'), 'w') as f:
+                f.write('[Kitchen]\n1001\n[Bath]\n1201\n')
+            start = datetime.datetime(2026, 1, 5, 0, 0)
+            with open(os.path.join(data_dir, 'fht_message_log%s.txt' % FhtMessage.rotation_name(start)), 'w') as f:
+                for i in range(100):
+                    t = (start + datetime.timedelta(minutes=2 * i)).isoformat(timespec='microseconds')
+                    f.write(FhtMessage('0A01', '41', '26', '2A', t).line())
+                    if i < 30 or i >= 70:
+                        # Bath is silent for 80 minutes, its battery gets low
+                        f.write(FhtMessage('0C01', '44', '26', '01' if i >= 90 else '00', t).line())
+                    if i < 10:
+                        # a device of the neighbours goes quiet, it is not a room
+                        f.write(FhtMessage('4711', '44', '26', '01', t).line())
+            monitor, count = backtest(data_dir, RoomIds(os.path.join(data_dir, 'known_ids.txt')))
+        self.assertEqual(count, 170)
+        self.assertEqual(sorted(monitor.rooms), ['Bath', 'Kitchen'])
+        events = [(event, room, kind) for _, event, (room, kind, _, _) in monitor.events]
+        self.assertEqual(events, [('raised', 'Bath', 'silent'), ('cleared', 'Bath', 'silent'),
+                                  ('raised', 'Bath', 'battery-low')])
+        self.assertEqual(list(monitor.alerts), [('Bath', 'battery-low')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#! /usr/bin/python
+"""Tests of history.py, run with python -m unittest in this directory."""
+
+import sys
+import json
+import base64
+import unittest
+from array import array
+from history import History, Rollup
+
+
+class RollupTest(unittest.TestCase):
+
+    def test_overfilled_bucket(self):
+        # a replay at full speed puts every message in the same bucket
+        rollup = Rollup(300, 4)
+        for i in range(70000):
+            rollup.add(1000, i % 3)
+        self.assertEqual(rollup.rows(900, 1200), [[900, 0.0, 2.0, 1.0, 70000]])
+
+    def test_buckets(self):
+        rollup = Rollup(300, 2)
+        for t, value in ((0, 1.0), (100, 3.0), (300, 5.0), (650, 7.0)):
+            rollup.add(t, value)
+        # the oldest bucket is overwritten
+        self.assertEqual(rollup.rows(0, 1000), [[300, 5.0, 5.0, 5.0, 1], [600, 7.0, 7.0, 7.0, 1]])
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_query(self):
+        history = History()
+        for t in range(0, 3000, 10):
+            history.add('bad', 'all-valves', t % 100, t)
+        history.add('bad', 'warnings', 1, 3000)
+        result = history.query('bad', 'all-valves', 1000, 1100)
+        self.assertEqual(result['resolution'], 'raw')
+        self.assertEqual(result['points'], [[t, t % 100] for t in range(1000, 1100, 10)])
+        self.assertEqual(history.query('bad', 'all-valves', 0, 600, '5m')['points'][0], [0, 0.0, 90.0, 45.0, 30])
+        self.assertIsNone(history.query('bad', 'warnings', 0, 3000))
+
+    def test_out_of_order(self):
+        history = History()
+        history.add('bad', 'desired-temp', 20.0, 100)
+        history.add('bad', 'desired-temp', 21.0, 50)
+        self.assertEqual(history.query('bad', 'desired-temp', 0, 200)['points'], [[100, 20.0]])
+
+    def test_max_series(self):
+        history = History()
+        for i in range(History.max_series):
+            history.add('room %d' % i, 'desired-temp', 20.0, 100)
+        with self.assertLogs('history', 'WARNING') as logs:
+            history.add('late', 'desired-temp', 20.0, 100)
+            history.add('late', 'desired-temp', 20.0, 200)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIsNone(history.query('late', 'desired-temp', 0, 300))
+
+    def test_saved(self):
+        history = History()
+        for t in range(0, 50000, 30):
+            history.add('bad', 'all-valves', t % 100, t)
+        saved = json.loads(json.dumps(history.as_saved()))
+        restored = History()
+        restored.load(saved)
+        for h in (history, restored):
+            # the newest bucket goes on after the restore
+            h.add('bad', 'all-valves', 7.0, 50100)
+        for resolution in History.RESOLUTIONS:
+            self.assertEqual(restored.query('bad', 'all-valves', 0, 60000, resolution),
+                             history.query('bad', 'all-valves', 0, 60000, resolution))
+        # saved on a machine of the other byte order
+        for _, _, series in saved['series']:
+            for ring in [series['raw']] + [rows for _, rows in series['rollups']]:
+                for i, data in enumerate(ring):
+                    column = array('I' if i == 0 or i == 4 else 'f', base64.b64decode(data))
+                    column.byteswap()
+                    ring[i] = base64.b64encode(column.tobytes()).decode('ascii')
+        saved['byteorder'] = 'big' if sys.byteorder == 'little' else 'little'
+        swapped = History()
+        swapped.load(saved)
+        self.assertEqual(swapped.query('bad', 'all-valves', 0, 50000, '5m'),
+                         history.query('bad', 'all-valves', 0, 50000, '5m'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#! /usr/bin/python
+"""Tests of log_archive.py, run with python -m unittest in this directory."""
+
+import os
+import os.path
+import datetime
+import tempfile
+import unittest
+from message import FhtMessage
+from log_archive import LogArchive
+
+
+def as_tuple(msg):
+    return msg.address, msg.msg_type, msg.command, msg.value, msg.time
+
+
+class LogArchiveTest(unittest.TestCase):
+
+    start = datetime.datetime(2026, 1, 5, 8, 0)
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'fht_message_log20260105-2.fhtc')
+        # small blocks, so that the filters skip some of them
+        self.block_size = LogArchive.BLOCK_SIZE
+        LogArchive.BLOCK_SIZE = 16
+        self.messages = [FhtMessage(address, '%02X' % (i % 256), 'A6', '%02x' % (i % 100),
+                                    self.start + datetime.timedelta(seconds=10 * i, microseconds=i))
+                         for i in range(100) for address in (('0A01', '6004') if i < 50 else ('0A01',))]
+
+    def tearDown(self):
+        LogArchive.BLOCK_SIZE = self.block_size
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        broken = [FhtMessage('0A0', '00', '26', '00', self.start),
+                  FhtMessage('0A01', '00', '26', '123456789', self.start),
+                  FhtMessage('0A01', 'G0', '26', '00', self.start)]
+        with self.assertLogs('log_archive', 'WARNING'):
+            self.assertEqual(LogArchive.write(self.path, self.messages + broken), (len(self.messages), 3))
+        self.assertEqual([as_tuple(msg) for msg in LogArchive.read(self.path)],
+                         [as_tuple(msg) for msg in self.messages])
+
+    def test_empty(self):
+        self.assertEqual(LogArchive.write(self.path, []), (0, 0))
+        self.assertEqual(list(LogArchive.read(self.path)), [])
+        self.assertEqual(LogArchive.read_columns(self.path)['scanned'], 0)
+
+    def test_filters(self):
+        LogArchive.write(self.path, self.messages)
+        since = self.start + datetime.timedelta(seconds=300)
+        until = self.start + datetime.timedelta(seconds=600)
+        for addresses, start, end in ((None, since, None), (None, None, until), (['6004'], None, None),
+                                      (['6004', '0a01'], since, until), (['1234'], None, None),
+                                      (None, until, since)):
+            expected = [as_tuple(msg) for msg in self.messages
+                        if (addresses is None or msg.address in [a.upper() for a in addresses])
+                        and (start is None or msg.time >= start) and (end is None or msg.time < end)]
+            self.assertEqual([as_tuple(msg) for msg in LogArchive.query(self.path, addresses, start, end)],
+                             expected, (addresses, start, end))
+            columns = LogArchive.read_columns(self.path, addresses, start, end)
+            self.assertEqual(list(zip(['{:04X}'.format(a) for a in columns['address']],
+                                      ['{:02X}'.format(t) for t in columns['msg_type']],
+                                      ['{:02X}'.format(c) for c in columns['command']],
+                                      columns['value'], map(LogArchive.to_datetime, columns['time']))),
+                             expected, (addresses, start, end))
+
+    def test_scanned(self):
+        LogArchive.write(self.path, self.messages)
+        self.assertEqual(LogArchive.read_columns(self.path)['scanned'], len(self.messages))
+        # 6004 is only in the first 100 messages, so in the first 7 blocks
+        self.assertEqual(LogArchive.read_columns(self.path, ['6004'])['scanned'], 7 * 16)
+        end = self.start + datetime.timedelta(seconds=5)
+        self.assertEqual(LogArchive.read_columns(self.path, None, None, end)['scanned'], 16)
+
+    def test_compact(self):
+        current = 'fht_message_log%s.txt' % FhtMessage.rotation_name(datetime.datetime.now())
+        logs = ['fht_message_log20260105-2.txt', current]
+        for name in logs:
+            with open(os.path.join(self.dir.name, name), 'w') as f:
+                for msg in self.messages:
+                    f.write(FhtMessage(msg.address, msg.msg_type, msg.command, msg.value,
+                                       msg.time.isoformat(timespec='microseconds')).line())
+        self.assertEqual(LogArchive.compact(self.dir.name, remove=True), [self.path])
+        # the log being written is left alone, the compacted one is removed
+        self.assertEqual(sorted(os.listdir(self.dir.name)), sorted([current, os.path.basename(self.path)]))
+        self.assertEqual([as_tuple(msg) for msg in FhtMessage.read_log(self.path)],
+                         [as_tuple(msg) for msg in self.messages])
+        self.assertEqual(LogArchive.compact(self.dir.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#! /usr/bin/python
+"""Tests of log_reader.py, run with python -m unittest in this directory."""
+
+import os.path
+import datetime
+import tempfile
+import unittest
+from message import FhtMessage
+from log_reader import LogReader
+
+
+class RecordsTest(unittest.TestCase):
+
+    start = datetime.datetime(2026, 1, 5, 8, 0)
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'fht_message_log20260105-2.txt')
+        # the same time repeated, as several messages received at once, and lines that are no messages
+        self.times = [(self.start + datetime.timedelta(seconds=i // 2)).isoformat(timespec='microseconds')
+                      for i in range(1000)]
+        with open(self.path, 'w') as f:
+            for i, t in enumerate(self.times):
+                f.write(FhtMessage('0A01', '00', '26', '%02X' % (i % 256), t).line())
+                if i % 100 == 7:
+                    f.write('\n garbage\n')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def times_since(self, since, until=None):
+        return [record.time_str for record in LogReader.records(self.path, since, until)]
+
+    def test_since(self):
+        for i in (0, 1, 2, 501, 998, 999):
+            self.assertEqual(self.times_since(self.times[i]), self.times[i // 2 * 2:], i)
+        self.assertEqual(self.times_since(datetime.datetime.fromisoformat(self.times[501])), self.times[500:])
+
+    def test_outside(self):
+        self.assertEqual(self.times_since(self.start - datetime.timedelta(days=1)), self.times)
+        self.assertEqual(self.times_since(self.start + datetime.timedelta(days=1)), [])
+        # between two records
+        self.assertEqual(self.times_since(self.times[300][:-1] + '1'), self.times[302:])
+
+    def test_until(self):
+        self.assertEqual(self.times_since(self.times[100], self.times[200]), self.times[100:200])
+        self.assertEqual(self.times_since(None, self.times[0]), [])
+
+    def test_short_log(self):
+        with open(self.path, 'w') as f:
+            f.write(FhtMessage('0A01', '00', '26', '00', self.times[0]).line())
+        self.assertEqual(self.times_since(self.times[0]), self.times[0:1])
+        self.assertEqual(self.times_since(self.times[2]), [])
+
+    def test_record(self):
+        record = next(LogReader.records(self.path, self.times[3]))
+        msg = record.to_message()
+        self.assertEqual((msg.address, msg.msg_type, msg.command, msg.value), ('0A01', '00', '26', '02'))
+        self.assertEqual(msg.time, datetime.datetime.fromisoformat(self.times[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
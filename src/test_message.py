@@ -0,0 +1,79 @@
+#! /usr/bin/python
+"""Tests of message.py, run with python -m unittest in this directory."""
+
+import os
+import os.path
+import tempfile
+import unittest
+from message import RoomIds
+
+
+class RoomIdsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'known_ids.txt')
+        self.mtime = 1000000000
+        self.write('[Kitchen]\n1010\n\n[Bath]\n1201\n1202\n')
+        self.interval = RoomIds.check_interval
+        RoomIds.check_interval = 0.0
+
+    def tearDown(self):
+        RoomIds.check_interval = self.interval
+        self.dir.cleanup()
+
+    def write(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        # a new modification time, however fast the file is written again
+        self.mtime += 10
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def test_lookup(self):
+        ids = RoomIds(self.path)
+        self.assertEqual(ids.rooms, {'Kitchen': ['0A0A'], 'Bath': ['0C01', '0C02']})
+        self.assertEqual(ids.get('0A0A'), 'Kitchen')
+        self.assertEqual(ids.get('0a0a'), 'Kitchen')
+        self.assertEqual(ids.get('0c02'), 'Bath')
+        self.assertIsNone(ids.get('0A0B'))
+        self.assertEqual(ids.get('0a0b', '0a0b'), '0a0b')
+        self.assertTrue('0A0A' in ids)
+
+    def test_reload(self):
+        ids = RoomIds(self.path)
+        self.assertFalse(ids.check())
+        self.write('[Kitchen]\n1010\n1011\n')
+        with self.assertLogs('message', 'WARNING'):
+            self.assertTrue(ids.check())
+        self.assertEqual(ids.get('0a0b'), 'Kitchen')
+        self.assertIsNone(ids.get('0C01'))
+        self.assertFalse(ids.check())
+
+    def test_check_interval(self):
+        RoomIds.check_interval = 3600.0
+        ids = RoomIds(self.path)
+        self.write('[Kitchen]\n1011\n')
+        self.assertFalse(ids.check())
+        self.assertEqual(ids.get('0A0A'), 'Kitchen')
+
+    def test_broken(self):
+        ids = RoomIds(self.path)
+        for text in ('[Kitchen]\n10x0\n', '1010\n'):
+            self.write(text)
+            with self.assertLogs('message', 'ERROR'):
+                self.assertFalse(ids.check())
+            # the old tables are kept whole, the broken file is not read again until it changes
+            self.assertEqual(ids.rooms, {'Kitchen': ['0A0A'], 'Bath': ['0C01', '0C02']})
+            self.assertFalse(ids.check())
+        os.remove(self.path)
+        with self.assertLogs('message', 'ERROR'):
+            self.assertFalse(ids.check())
+        self.assertEqual(ids.get('0c01'), 'Bath')
+        self.write('[Bath]\n1201\n')
+        with self.assertLogs('message', 'WARNING'):
+            self.assertTrue(ids.check())
+        self.assertIsNone(ids.get('0A0A'))
+
+
+if __name__ == '__main__':
+    unittest.main()
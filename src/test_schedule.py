@@ -0,0 +1,62 @@
+#! /usr/bin/python
+"""Tests of schedule.py, run with python -m unittest in this directory."""
+
+import json
+import unittest
+from schedule import Schedules
+
+
+class SchedulesTest(unittest.TestCase):
+
+    def test_slots(self):
+        schedules = Schedules()
+        for msg_type, value in (('mon-from1', 0), ('mon-to1', 48), ('mon-from2', 143), ('mon-to2', Schedules.OFF),
+                                ('sun-from1', 255), ('sun-to1', 256), ('sun-from2', -1), ('sun-to2', 1)):
+            schedules.add('bad', msg_type, value, 100.0)
+        week = schedules.as_dict(200.0)['rooms']['bad']['week']
+        self.assertEqual(week['mon'], [['00:00', '08:00'], ['23:50', 'off']])
+        self.assertEqual(week['sun'], [['off', 'off'], ['off', '00:10']])
+        self.assertEqual(week['tue'], [[None, None], [None, None]])
+
+    def test_values(self):
+        schedules = Schedules()
+        schedules.add('bad', 'day-temp', 42, 100.0)
+        schedules.add('bad', 'night-temp', 35, 100.0)
+        schedules.add('bad', 'mode', 0, 100.0)
+        schedules.add('kitchen', 'mode', 7, 100.0)
+        # not a program, or not decoded to a number
+        schedules.add('bad', 'desired-temp', 42, 100.0)
+        schedules.add('bad', 'mon-from1', 'garbage', 100.0)
+        rooms = schedules.as_dict(200.0)['rooms']
+        self.assertEqual((rooms['bad']['day-temp'], rooms['bad']['night-temp'], rooms['bad']['mode']),
+                         (21.0, 17.5, 'auto'))
+        self.assertEqual(rooms['kitchen']['mode'], 7)
+        self.assertIsNone(rooms['bad']['week']['mon'][0][0])
+
+    def test_complete_and_stale(self):
+        schedules = Schedules()
+        for i, msg_type in enumerate(Schedules.types[:-1]):
+            schedules.add('bad', msg_type, 1, 1000.0 + i)
+        room = schedules.as_dict(2000.0)['rooms']['bad']
+        self.assertEqual((room['complete'], room['missing'], room['stale'], room['updated']),
+                         (False, ['mode'], False, 1000.0 + Schedules.SLOTS + 1))
+        schedules.add('bad', 'mode', 0, 1000.0 + Schedules.stale_after)
+        room = schedules.as_dict(1000.0 + Schedules.stale_after)['rooms']['bad']
+        self.assertEqual((room['complete'], room['missing'], room['stale']), (True, [], False))
+        # stale as soon as the oldest message is, until it is received again
+        self.assertTrue(schedules.as_dict(1000.0 + Schedules.stale_after + 0.5)['rooms']['bad']['stale'])
+        schedules.add('bad', 'mon-from1', 1, 1000.0 + Schedules.stale_after)
+        self.assertFalse(schedules.as_dict(1000.0 + Schedules.stale_after + 0.5)['rooms']['bad']['stale'])
+
+    def test_saved(self):
+        schedules = Schedules()
+        schedules.add('bad', 'mon-to1', 48, 100.0)
+        schedules.add('bad', 'mode', 1, 200.0)
+        restored = Schedules()
+        restored.load(json.loads(json.dumps(schedules.as_saved())))
+        self.assertEqual(restored.as_dict(300.0), schedules.as_dict(300.0))
+        self.assertEqual(json.loads(restored.json()), restored.as_dict())
+
+
+if __name__ == '__main__':
+    unittest.main()